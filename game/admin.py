@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.contrib import admin
+from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
+
+from . import sharding
+from .models import Game, Move
+
+
+class ShardFilter(admin.SimpleListFilter):
+    '''
+    The list of games shows one shard at a time (see sharding.py), the first one by
+    default. Pages of several databases can't be sorted and counted together.
+    '''
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in settings.GAME_SHARDS]
+
+    def queryset(self, request, queryset):
+        if self.value() in settings.GAME_SHARDS:
+            return queryset.using(self.value())
+        return queryset
+
+    def choices(self, changelist):  # no "All", the first shard is the default one
+        selected = self.value() if self.value() in settings.GAME_SHARDS else settings.GAME_SHARDS[0]
+        for alias in settings.GAME_SHARDS:
+            yield {
+                'selected': alias == selected,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}, []),
+                'display': alias,
+            }
+
+
+class MoveFormSet(BaseInlineFormSet):
+    '''The moves of a game come from its shard'''
+
+    def __init__(self, *args, instance=None, queryset=None, **kwargs):
+        if instance is not None and instance._state.db is not None and queryset is not None:
+            queryset = queryset.using(instance._state.db)
+        super().__init__(*args, instance=instance, queryset=queryset, **kwargs)
+
+
+class MoveInline(admin.TabularInline):
+    model = Move
+    formset = MoveFormSet
+    readonly_fields = ['sequence', 'kind', 'x', 'y', 'timestamp']
+    can_delete = False
+    extra = 0
+
+
+@admin.register(Game)
+class GameAdmin(admin.ModelAdmin):
+    list_display = ['id', 'difficulty', 'creation_datetime', 'game_over', 'win', 'end_timer', 'move_count']
+    list_filter = [ShardFilter, 'difficulty', 'game_over', 'win']
+    inlines = [MoveInline]
+
+    def get_object(self, request, object_id, from_field=None):
+        '''From the shard of the game, which its id tells'''
+        try:
+            queryset = self.get_queryset(request).using(sharding.database(object_id))
+            return queryset.get(pk=object_id)
+        except (Game.DoesNotExist, ValidationError, ValueError):
+            return None
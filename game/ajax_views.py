@@ -1,24 +1,106 @@
 import json
 
 from django.core import signing
-from django.http import HttpResponse, HttpResponseBadRequest
-from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.template.loader import render_to_string
 
-from .models import Game
+from . import metrics, solver
+from .models import CellDisplay, Game, MoveKind, StaleGameError
 
 
 signer = signing.Signer()
 
+MAX_BATCH_SIZE = 500
 
+# Compact format of the changed cells, asked for with this Accept header or ?format=diff
+DIFF_VERSION = 1
+DIFF_MEDIA_TYPE = 'application/vnd.minesweeper.diff.v{}+json'.format(DIFF_VERSION)
+
+
+@metrics.timed('sweep')
 def sweep_view(request, signed_id):
     return process_action_request(request, signed_id, Game.sweep_cell)
 
 
+@metrics.timed('flag')
 def flag_view(request, signed_id):
     return process_action_request(request, signed_id, Game.flag_cell)
 
 
+@metrics.timed('chord')
+def chord_view(request, signed_id):
+    return process_action_request(request, signed_id, Game.chord_cell)
+
+
+@metrics.timed('batch')
+def batch_view(request, signed_id):
+    '''
+    Applies several moves with a single load and save of the game. The body is a JSON
+    object like {"moves": [{"action": "sweep", "x": 1, "y": 2}, ...]}, applied in order.
+    The response has every cell changed by any of the moves (once) and the final state.
+    '''
+    if not request.is_ajax() or request.method != 'POST':
+        return HttpResponseBadRequest()
+
+    try:
+        moves = parse_moves(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    with metrics.phase('unsign'):
+        game_id = signer.unsign(signed_id)
+    try:
+        game, (is_game_over, win, cells) = Game.play(game_id, Game.apply_moves, moves)
+    except Game.DoesNotExist:
+        raise Http404
+    except StaleGameError:
+        return HttpResponse(status=409)  # conflict
+    except IndexError:  # a cell out of the board
+        return HttpResponseBadRequest()
+    return action_response(request, is_game_over, win, cells)
+
+
+@metrics.timed('hint')
+def hint_view(request, signed_id):
+    '''
+    A move which is sure to be right (see solver.py), like
+    {"hint": {"action": "sweep", "x": 1, "y": 2}}. The hint is null when there's none.
+    '''
+    if not request.is_ajax():
+        return HttpResponseBadRequest()
+
+    with metrics.phase('unsign'):
+        game_id = signer.unsign(signed_id)
+    try:
+        game = Game.load(game_id)
+    except Game.DoesNotExist:
+        raise Http404
+    with metrics.phase('solve'):
+        move = solver.hint(game)
+    data = {'hint': None}
+    if move is not None:
+        kind, x, y = move
+        data['hint'] = {'action': kind.name, 'x': x, 'y': y}
+    return HttpResponse(json.dumps(data, separators=(',', ':')), content_type='application/json')
+
+
+def parse_moves(body):
+    '''
+    Parses a batch of moves ({"moves": [{"action": "sweep", "x": 1, "y": 2}, ...]}) into
+    the (MoveKind, x, y) list Game.apply_moves takes. Raises ValueError if it's not valid.
+    '''
+    try:
+        moves = [
+            (MoveKind[move['action']], int(move['x']), int(move['y']))
+            for move in json.loads(body.decode('utf-8'))['moves']
+        ]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Invalid moves')
+    if len(moves) > MAX_BATCH_SIZE:
+        raise ValueError('Too many moves')
+    return moves
+
+
 def process_action_request(request, signed_id, action):
     '''
     Both sweep and flag actions are pretty much identical except for the method
@@ -28,20 +110,66 @@ def process_action_request(request, signed_id, action):
     if not request.is_ajax() or not request.POST:
         return HttpResponseBadRequest()
 
-    game_id = signer.unsign(signed_id)
-    game = get_object_or_404(Game, pk=game_id)
-    x = int(request.POST['x'])
-    y = int(request.POST['y'])
-    is_game_over, win, cells = action(game, x, y)
-    data = {
+    with metrics.phase('unsign'):
+        game_id = signer.unsign(signed_id)
+    try:
+        x = int(request.POST['x'])
+        y = int(request.POST['y'])
+        game, (is_game_over, win, cells) = Game.play(game_id, action, x, y)
+    except Game.DoesNotExist:
+        raise Http404
+    except StaleGameError:
+        return HttpResponse(status=409)  # conflict
+    except (IndexError, ValueError, KeyError):  # a cell missing or out of the board
+        return HttpResponseBadRequest()
+    return action_response(request, is_game_over, win, cells)
+
+
+def action_response(request, is_game_over, win, cells):
+    '''
+    By default every changed cell is sent as its rendered cell.html. Clients which ask
+    for the diff format get [x, y, display] lists instead, plus the nearby mine counter
+    for cleared cells, and build the cells themselves (see game.html).
+    '''
+    with metrics.phase('render'):
+        if wants_diff(request):
+            data = diff_data(is_game_over, win, cells)
+            content_type = DIFF_MEDIA_TYPE
+        else:
+            data = {
+                'is_game_over': is_game_over,
+                'win': win,
+                'cells': [
+                    {
+                        'x': cell.x,
+                        'y': cell.y,
+                        'html': render_to_string('cell.html', {'cell': cell})
+                    } for cell in cells
+                ]
+            }
+            content_type = 'application/json'
+        content = json.dumps(data, separators=(',', ':'))
+    return HttpResponse(content, content_type=content_type)
+
+
+def wants_diff(request):
+    return (
+        request.GET.get('format') == 'diff' or
+        DIFF_MEDIA_TYPE in request.META.get('HTTP_ACCEPT', '')
+    )
+
+
+def diff_data(is_game_over, win, cells):
+    return {
         'is_game_over': is_game_over,
         'win': win,
-        'cells': [
-            {
-                'x': cell.x,
-                'y': cell.y,
-                'html': render_to_string('cell.html', {'cell': cell})
-            } for cell in cells
-        ]
+        'version': DIFF_VERSION,
+        'diff': [cell_diff(cell) for cell in cells],
     }
-    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def cell_diff(cell):
+    display = cell.display
+    if display == CellDisplay.cleared:
+        return [cell.x, cell.y, display.value, cell.nearby_mine_counter]
+    return [cell.x, cell.y, display.value]
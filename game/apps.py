@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class GameConfig(AppConfig):
     name = 'game'
+
+    def ready(self):
+        from .database import configure_connection
+        connection_created.connect(configure_connection)
@@ -0,0 +1,107 @@
+'''
+Append-only store of the boards of old finished games (see the archive_games command).
+
+Finished games are never played again and rankings only read the leaderboard, yet their
+boards used to stay in the game table forever. Archiving moves them to two files in
+settings.GAME_ARCHIVE_DIR, so the table stays small:
+
+    boards.dat  the boards in their compact format (see board.py), one after the other
+    boards.idx  one fixed-size record per board: game id, offset and length in boards.dat
+
+A game keeps the number of its record (Game.archive_slot), so reading its board is two
+slices of the memory-mapped files, with no search. The files are only appended to, by
+one archiver at a time (they're locked), and every process maps them once and maps them
+again when they grow past what it mapped.
+
+The boards are written before their records, and the records before the games point at
+them, so a crash in between only leaves some unused bytes at the end of a file.
+'''
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+
+RECORD = struct.Struct('<QQI')  # game id, offset in boards.dat, length
+DATA_FILE = 'boards.dat'
+INDEX_FILE = 'boards.idx'
+
+
+class ArchiveError(Exception):
+    '''The board of a game isn't where its record should be'''
+
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.maps = {}  # file name -> mmap of the whole file when it was mapped
+        self.lock = threading.Lock()  # for the maps
+
+    def append(self, boards):
+        '''
+        Adds a list of (game_id, data) to the archive and returns the slot of each one.
+        The data is only safe once this returns, the files are synced.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(INDEX_FILE), 'ab') as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)  # released when the file is closed
+            index_size = index_file.seek(0, os.SEEK_END)
+            first_slot = index_size // RECORD.size
+            index_file.truncate(first_slot * RECORD.size)  # half a record from a crash
+
+            records = []
+            with open(self._path(DATA_FILE), 'ab') as data_file:
+                offset = data_file.seek(0, os.SEEK_END)
+                for game_id, data in boards:
+                    data_file.write(data)
+                    records.append(RECORD.pack(game_id, offset, len(data)))
+                    offset += len(data)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            index_file.write(b''.join(records))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        return list(range(first_slot, first_slot + len(records)))
+
+    def read(self, game_id, slot):
+        '''The data of the board of a game'''
+        start = slot * RECORD.size
+        record_game_id, offset, length = RECORD.unpack(
+            self._mapped(INDEX_FILE, start + RECORD.size)[start:start + RECORD.size]
+        )
+        if record_game_id != game_id:
+            raise ArchiveError('Slot {} has game {}, not {}'.format(slot, record_game_id, game_id))
+        return self._mapped(DATA_FILE, offset + length)[offset:offset + length]
+
+    def _mapped(self, name, size):
+        '''A map of the file with at least size bytes'''
+        with self.lock:
+            mapped = self.maps.get(name)
+            if mapped is None or len(mapped) < size:
+                try:
+                    with open(self._path(name), 'rb') as archive_file:
+                        # the old map is closed once the reads using it are done with it
+                        mapped = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError) as error:  # ValueError when it's empty
+                    raise ArchiveError('Cannot map {}: {}'.format(name, error))
+                self.maps[name] = mapped
+        if len(mapped) < size:
+            raise ArchiveError('{} is shorter than {} bytes'.format(name, size))
+        return mapped
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+
+_archives = {}
+
+
+def archive():
+    '''The archive of settings.GAME_ARCHIVE_DIR of this process'''
+    directory = settings.GAME_ARCHIVE_DIR
+    if directory not in _archives:
+        _archives[directory] = Archive(directory)
+    return _archives[directory]
@@ -0,0 +1,399 @@
+'''
+Compact binary representation of the board.
+
+Every cell is stored as a single byte:
+    bit 0       has a mine
+    bit 1       has a flag
+    bit 2       hidden
+    bits 4-7    nearby mine counter (0-8)
+
+The safe area ids live in a separate array (0 means "no safe area"), since they don't
+fit in the state byte. When serialized, the ids use the narrowest unsigned width (1, 2
+or 4 bytes) that can hold the biggest id of that board.
+
+Since version 2 the board also keeps an index of the cells of every safe area (built
+once at creation), so sweeping an area only touches the cells of that area. The index
+is stored as offsets into a flat list of cell indices, one slice per area.
+
+Since version 3 boards generated from a seed (see generation.seeded_layout) only store
+the seed and the player's state: the hidden and flag bits of every cell, compressed.
+The mines, counters and safe areas are rebuilt from the seed when the board is read.
+Boards with a fixed layout (e.g. the tests') and big boards, which take longer to
+rebuild than to read, are still stored whole in version 2.
+
+The serialized format starts with its version (one of the *_FORMAT constants), so old
+rows can still be read after the layout changes.
+'''
+import array
+import enum
+import struct
+import sys
+import zlib
+
+
+@enum.unique
+class CellDisplay(enum.IntEnum):
+    '''
+    Represents the different ways a cell can be displayed.
+    There are css classes with a 'cell-' prefix to mach each.
+    '''
+    hidden = 0
+    cleared = 1
+    flagged = 2
+    mine = 3
+
+
+MINE = 0x01
+FLAG = 0x02
+HIDDEN = 0x04
+COUNTER_SHIFT = 4
+STATE_MASK = 0x0F
+
+# versions of the serialized format, every one is still read
+CELLS_FORMAT = 1  # the cells and their safe area ids, no longer written
+LAYOUT_FORMAT = 2  # and the index of the safe areas
+SEEDED_FORMAT = 3  # the seed and the player's state
+_HEADER = struct.Struct('<BHHB')  # version, width, height, bytes per safe area id
+_SEEDED_HEADER = struct.Struct('<BHHBQI')  # version, width, height, generator, seed, mines
+MAX_SEEDED_CELLS = 100 * 100  # bigger boards store their layout
+_TYPECODES = {1: 'B', 2: 'H', 4: 'I' if array.array('I').itemsize == 4 else 'L'}
+
+# bytes.translate tables to split the state bytes without looping in python
+_MINE_TABLE = bytes(value & MINE for value in range(256))
+_COUNTER_TABLE = bytes(value >> COUNTER_SHIFT for value in range(256))
+_STATE_TABLE = bytes(value & STATE_MASK for value in range(256))
+_SHIFTED_COUNTER_TABLE = bytes((value << COUNTER_SHIFT) & 0xFF for value in range(256))
+_PLAYER_TABLE = bytes(value & (FLAG | HIDDEN) for value in range(256))
+_HIDE_TABLE = bytes(value | HIDDEN for value in range(256))
+
+
+def area_array(values=()):
+    return array.array(_TYPECODES[4], values)
+
+
+def _pack_array(values, size):
+    packed = array.array(_TYPECODES[size], values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_array(data, offset, count, size):
+    values = array.array(_TYPECODES[size])
+    values.frombytes(data[offset:offset + count * size])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if len(values) != count:
+        raise ValueError('Truncated board data')
+    return area_array(values), offset + count * size
+
+
+class Cell:
+    '''
+    A view over one cell of a Board. It has the same attributes the old pickled Cell
+    objects had, so the templates and the game logic can keep using them.
+    Cells are cheap to create and they don't hold any state by themselves.
+    '''
+    __slots__ = ('_board', '_index', 'x', 'y')
+
+    def __init__(self, board, x, y):
+        self._board = board
+        self._index = y * board.width + x
+        self.x, self.y = x, y
+
+    def _get_bit(self, bit):
+        return bool(self._board.cells[self._index] & bit)
+
+    def _set_bit(self, bit, value):
+        if value:
+            self._board.cells[self._index] |= bit
+        else:
+            self._board.cells[self._index] &= ~bit
+
+    @property
+    def hidden(self):
+        return self._get_bit(HIDDEN)
+
+    @hidden.setter
+    def hidden(self, value):
+        self._set_bit(HIDDEN, value)
+
+    @property
+    def has_mine(self):
+        return self._get_bit(MINE)
+
+    @has_mine.setter
+    def has_mine(self, value):
+        self._set_bit(MINE, value)
+
+    @property
+    def has_flag(self):
+        return self._get_bit(FLAG)
+
+    @has_flag.setter
+    def has_flag(self, value):
+        self._set_bit(FLAG, value)
+
+    @property
+    def nearby_mine_counter(self):
+        return self._board.cells[self._index] >> COUNTER_SHIFT
+
+    @nearby_mine_counter.setter
+    def nearby_mine_counter(self, value):
+        cells = self._board.cells
+        cells[self._index] = (cells[self._index] & STATE_MASK) | (value << COUNTER_SHIFT)
+
+    @property
+    def safe_area_id(self):
+        return self._board.safe_areas[self._index] or None
+
+    @property
+    def display(self):
+        if self.has_flag:
+            return CellDisplay.flagged
+        if self.hidden:
+            return CellDisplay.hidden
+        if self.has_mine:
+            return CellDisplay.mine
+        return CellDisplay.cleared
+
+    def __eq__(self, other):
+        if not isinstance(other, Cell):
+            return NotImplemented
+        return self._board is other._board and self._index == other._index
+
+    def __hash__(self):
+        return hash(self._index)
+
+    def __repr__(self):
+        if self.has_mine:
+            return 'B'
+        elif self.nearby_mine_counter == 0:
+            return 'Z{}'.format(self.safe_area_id)
+        else:
+            return 'N{}'.format(self.nearby_mine_counter)
+
+
+class _Row:
+    __slots__ = ('_board', '_y')
+
+    def __init__(self, board, y):
+        self._board, self._y = board, y
+
+    def __getitem__(self, x):
+        if not 0 <= x < self._board.width:
+            raise IndexError('x={} is out of the board'.format(x))
+        return Cell(self._board, x, self._y)
+
+    def __len__(self):
+        return self._board.width
+
+    def __iter__(self):
+        for x in range(self._board.width):
+            yield Cell(self._board, x, self._y)
+
+
+class Board:
+    '''
+    Matrix of cells backed by flat arrays. board[y][x] returns a Cell view, just like
+    the list of lists this class replaces.
+
+    generator and seed are set on the boards whose layout comes from a seed (see
+    generation.seeded_layout). They are None when the layout was placed by hand.
+    '''
+    __slots__ = (
+        'width', 'height', 'cells', 'safe_areas', 'area_offsets', 'area_members',
+        'generator', 'seed',
+    )
+
+    def __init__(self, width, height, cells=None, safe_areas=None):
+        self.width, self.height = width, height
+        size = width * height
+        self.cells = bytearray([HIDDEN]) * size if cells is None else cells
+        self.set_safe_areas(area_array([0]) * size if safe_areas is None else safe_areas)
+        self.generator = self.seed = None
+
+    def __getitem__(self, y):
+        if not 0 <= y < self.height:
+            raise IndexError('y={} is out of the board'.format(y))
+        return _Row(self, y)
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield _Row(self, y)
+
+    def cell(self, index):
+        return Cell(self, index % self.width, index // self.width)
+
+    def neighbours(self, x, y):
+        '''The (up to 8) cells around a cell'''
+        return [
+            Cell(self, nx, ny)
+            for ny in range(max(y - 1, 0), min(y + 2, self.height))
+            for nx in range(max(x - 1, 0), min(x + 2, self.width))
+            if nx != x or ny != y
+        ]
+
+    def place_mines(self, indices):
+        '''Sets the mine bit of the cells at the given flat indices (y * width + x)'''
+        cells = self.cells
+        for index in indices:
+            if cells[index] & MINE:
+                raise ValueError('Duplicate mines are not allowed')
+            cells[index] |= MINE
+
+    def mines(self):
+        '''Flat bytes with 1 where there's a mine and 0 otherwise'''
+        return bytes(self.cells.translate(_MINE_TABLE))
+
+    def mine_indices(self):
+        mines = self.mines()
+        index = mines.find(1)
+        while index != -1:
+            yield index
+            index = mines.find(1, index + 1)
+
+    def count(self, mask, value):
+        '''Number of cells whose state bits selected by mask are equal to value'''
+        table = bytes(int(state & mask == value) for state in range(256))
+        return self.cells.translate(table).count(1)
+
+    def counters(self):
+        '''Flat bytes with the nearby_mine_counter of every cell'''
+        return bytes(self.cells.translate(_COUNTER_TABLE))
+
+    def set_counters(self, counters):
+        # OR-ing both byte strings as big integers keeps the whole thing in C
+        state = int.from_bytes(self.cells.translate(_STATE_TABLE), 'little')
+        shifted = int.from_bytes(bytes(counters).translate(_SHIFTED_COUNTER_TABLE), 'little')
+        self.cells = bytearray((state | shifted).to_bytes(len(self.cells), 'little'))
+
+    def set_safe_areas(self, safe_areas, area_offsets=None, area_members=None):
+        '''Sets the safe area ids, building the index of each area's cells if not given'''
+        if area_offsets is None:
+            area_offsets, area_members = self._area_index(safe_areas)
+        self.safe_areas = safe_areas
+        self.area_offsets, self.area_members = area_offsets, area_members
+
+    def area_indices(self, area_id):
+        '''Flat indices of the cells of a safe area'''
+        return self.area_members[self.area_offsets[area_id - 1]:self.area_offsets[area_id]]
+
+    def reveal(self, indices):
+        '''Clears the hidden bit of the given cells. Returns the ones which were hidden'''
+        cells = self.cells
+        revealed = []
+        for index in indices:
+            if cells[index] & HIDDEN:
+                cells[index] &= ~HIDDEN
+                revealed.append(self.cell(index))
+        return revealed
+
+    def to_bytes(self):
+        if self.seed is not None and len(self.cells) <= MAX_SEEDED_CELLS:
+            return self._to_seeded_bytes()
+        biggest_area_id = len(self.area_offsets) - 1
+        area_size = next(size for size in (1, 2, 4) if biggest_area_id < 1 << (8 * size))
+        index_size = self._index_size(self.width, self.height)
+        header = _HEADER.pack(LAYOUT_FORMAT, self.width, self.height, area_size)
+        return b''.join((
+            header,
+            self.cells,
+            _pack_array(self.safe_areas, area_size),
+            _pack_array(self.area_offsets, index_size),
+            _pack_array(self.area_members, index_size),
+        ))
+
+    def _to_seeded_bytes(self):
+        mine_count = self.cells.translate(_MINE_TABLE).count(1)
+        header = _SEEDED_HEADER.pack(
+            SEEDED_FORMAT, self.width, self.height, self.generator, self.seed, mine_count
+        )
+        return header + zlib.compress(bytes(self.cells.translate(_PLAYER_TABLE)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        version, width, height, area_size = _HEADER.unpack_from(data)
+        if version == SEEDED_FORMAT:
+            return cls._from_seeded_bytes(data)
+        if version not in (CELLS_FORMAT, LAYOUT_FORMAT):
+            raise ValueError('Unknown board format version {}'.format(version))
+
+        size = width * height
+        offset = _HEADER.size
+        cells = bytearray(data[offset:offset + size])
+        if len(cells) != size:
+            raise ValueError('Truncated board data')
+        offset += size
+        safe_areas, offset = _unpack_array(data, offset, size, area_size)
+
+        board = cls.__new__(cls)
+        board.width, board.height, board.cells = width, height, cells
+        board.generator = board.seed = None
+        if version == CELLS_FORMAT:  # no index of the safe areas yet
+            board.set_safe_areas(safe_areas)
+        else:
+            index_size = cls._index_size(width, height)
+            area_count = max(safe_areas, default=0)
+            area_offsets, offset = _unpack_array(data, offset, area_count + 1, index_size)
+            area_members, offset = _unpack_array(data, offset, area_offsets[-1], index_size)
+            board.set_safe_areas(safe_areas, area_offsets, area_members)
+        return board
+
+    @classmethod
+    def _from_seeded_bytes(cls, data):
+        from .generation import seeded_layout  # it imports this module
+
+        _, width, height, generator, seed, mine_count = _SEEDED_HEADER.unpack_from(data)
+        try:
+            player = zlib.decompress(data[_SEEDED_HEADER.size:])
+        except zlib.error:
+            raise ValueError('Corrupted board data')
+        if len(player) != width * height:
+            raise ValueError('Truncated board data')
+
+        return cls.from_layout(seeded_layout(generator, seed, width, height, mine_count), player)
+
+    @classmethod
+    def from_layout(cls, layout, player=None):
+        '''
+        A board with the mines, counters and safe areas of layout (a board without hidden
+        or flag bits, see generation.seeded_layout) and the hidden and flag bits of player,
+        which are all hidden when it's None.
+        '''
+        board = cls.__new__(cls)
+        board.width, board.height = layout.width, layout.height
+        if player is None:
+            board.cells = bytearray(layout.cells.translate(_HIDE_TABLE))
+        else:
+            cells = int.from_bytes(layout.cells, 'little') | int.from_bytes(player, 'little')
+            board.cells = bytearray(cells.to_bytes(len(layout.cells), 'little'))
+        # the safe areas never change, so they're shared with the layout
+        board.set_safe_areas(layout.safe_areas, layout.area_offsets, layout.area_members)
+        board.generator, board.seed = layout.generator, layout.seed
+        return board
+
+    @staticmethod
+    def _area_index(safe_areas):
+        members_by_area = [[] for _ in range(max(safe_areas, default=0) + 1)]
+        for index, area_id in enumerate(safe_areas):
+            if area_id:
+                members_by_area[area_id].append(index)
+
+        area_offsets, area_members = area_array([0]), area_array()
+        for members in members_by_area[1:]:
+            area_members.extend(members)
+            area_offsets.append(len(area_members))
+        return area_offsets, area_members
+
+    @staticmethod
+    def _index_size(width, height):
+        return 2 if width * height <= 0xFFFF else 4
+
+    def __reduce__(self):
+        # pickle (e.g. the cache framework) gets the compact format too
+        return self.from_bytes, (self.to_bytes(),)
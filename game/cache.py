@@ -0,0 +1,304 @@
+'''
+Write-behind cache of the games being played.
+
+A game is played click by click for minutes, and every click used to load the game from
+the database and save it back. With settings.GAME_CACHE_ENABLED, Game.play and
+Game.load go through this cache instead:
+
+    * Every process keeps the games it played recently in memory, in an LRU of
+      settings.GAME_CACHE_SIZE games.
+    * The latest copy of every game also lives in a cache backend shared by all the
+      processes (settings.CACHES['games'], files by default), along with a stamp which
+      changes on every move. The local copy is only used while its stamp is the shared
+      one, so a click served by another uwsgi process is never missed. A local hit only
+      reads the stamp, there's no query and no unpickling of the game.
+    * The moves are saved to the database (see Game.save_moves) every
+      settings.GAME_CACHE_FLUSH_INTERVAL seconds, when the game is evicted from the LRU,
+      when it ends and when the process exits. Only the process which made the last move
+      of a game flushes it. If the game was saved behind its back meanwhile (e.g. its
+      shared copy expired and another process played it from the database), the moves
+      are applied again over the saved game, they were already shown to the player.
+
+Moves of the same game are serialized across processes with flock() on a lock file in
+settings.GAME_CACHE_LOCK_DIR, which is atomic and released by the kernel if a process
+dies holding it. The games share LOCK_STRIPES files, picked by their id, so the files
+don't pile up with the games. All the processes have to run on one machine for that,
+which is also what the file backend of the shared copies needs.
+'''
+import atexit
+import collections
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+
+from . import metrics
+from .models import Game, MoveKind, StaleGameError
+
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 5  # seconds
+LOCK_STRIPES = 1024  # lock files, games with the same id modulo this share one
+
+
+class GameCache:
+    def __init__(self, backend, size, flush_interval, timeout, lock_dir):
+        self.backend = backend
+        self.size = size
+        self.flush_interval = flush_interval  # seconds, None to only flush on demand
+        self.timeout = timeout  # seconds the games stay in the shared backend
+        self.lock_dir = lock_dir
+        self.games = collections.OrderedDict()  # pk -> (stamp, game), least recent first
+        self.dirty = set()  # pk of the games with moves to flush
+        self.evicted = {}  # pk -> (stamp, game), out of the LRU but not flushed yet
+        self.lock = threading.RLock()  # for the three above (the flusher is another thread)
+        self._flusher = None
+        self._held = threading.local()  # stripes locked by each thread, see _locked
+
+    def play(self, pk, action, *args):
+        '''Same as Game.play, over the cached copy of the game'''
+        pk = int(pk)  # the views pass it as a string, the same game in games and dirty
+        self._start_flusher()
+        with self._flushing_evicted(), self._locked(pk):
+            with metrics.phase('fetch'):
+                game = self._get(pk)
+            move_count = game.move_count
+            try:
+                with metrics.phase('logic'):
+                    result = action(game, *args)
+            except StaleGameError:  # the database changed behind the cache's back
+                # the moves of this action fail, the ones before were already answered
+                answered = [move for move in game._pending_moves if move.sequence <= move_count]
+                self._forget(pk)
+                if answered:
+                    self._publish(pk, self._rebase(pk, answered))
+                raise
+            except Exception:
+                # this copy could be half changed, but the shared one is still fine
+                self._reload(pk)
+                raise
+            if game.move_count != move_count:
+                with metrics.phase('save'):
+                    self._publish(pk, game)
+        return game, result
+
+    def load(self, pk):
+        '''Same as Game.load, over the cached copy of the game'''
+        pk = int(pk)
+        with self._flushing_evicted(), self._locked(pk), metrics.phase('fetch'):
+            return self._get(pk)
+
+    def flush(self, pk):
+        '''Saves the moves of a game to the database, if this process made the last one'''
+        pk = int(pk)
+        with self._locked(pk):
+            with self.lock:
+                entry = self.games.get(pk)
+                local = entry is not None
+                if not local:
+                    entry = self.evicted.get(pk)
+            if entry is not None:
+                self._flush_entry(pk, *entry, local=local)
+            with self.lock:  # only now, the moves are kept if saving them fails
+                self.evicted.pop(pk, None)
+                self.dirty.discard(pk)
+
+    def flush_all(self):
+        with self.lock:
+            dirty = list(self.dirty)
+        for pk in dirty:
+            try:
+                self.flush(pk)
+            except Exception:
+                logger.exception('Could not flush game %s', pk)
+
+    def _get(self, pk):
+        stamp = self.backend.get(self._stamp_key(pk))
+        with self.lock:
+            entry = self.games.get(pk)
+            if entry is not None and stamp == entry[0]:
+                self.games.move_to_end(pk)
+                return entry[1]
+            if entry is None:
+                entry = self.evicted.get(pk)
+
+        if stamp is None and entry is not None:
+            # the shared copy expired (or was culled), so another process may have played
+            # the game from the database since. Ours is saved first and then reloaded
+            with self.lock:
+                dirty = pk in self.dirty
+            if dirty:
+                self._flush_entry(pk, *entry, local=False)
+            with self.lock:
+                self.games.pop(pk, None)
+                self.evicted.pop(pk, None)
+                self.dirty.discard(pk)
+
+        if stamp is not None:
+            shared = self.backend.get(self._game_key(pk))
+            if shared is not None and shared[0] == stamp:
+                self._store(pk, *shared)
+                return shared[1]
+
+        game = Game.objects.using(Game.database(pk)).get(pk=pk)
+        game.replay_journal()
+        self._publish(pk, game)
+        return game
+
+    def _publish(self, pk, game, local=True):
+        '''Makes this copy of the game the latest one for every process'''
+        stamp = uuid.uuid4().hex
+        game._write_behind = True  # see Game.save_moves
+        self.backend.set_many({
+            self._game_key(pk): (stamp, game),
+            self._stamp_key(pk): stamp,
+        }, self.timeout)
+        if local:
+            self._store(pk, stamp, game)
+
+    def _store(self, pk, stamp, game):
+        with self.lock:
+            self.games[pk] = (stamp, game)
+            self.games.move_to_end(pk)
+            self.evicted.pop(pk, None)
+            if game._pending_moves:
+                self.dirty.add(pk)
+            else:
+                self.dirty.discard(pk)
+            while len(self.games) > self.size:
+                evicted_pk, entry = self.games.popitem(last=False)
+                if evicted_pk in self.dirty:  # see _flushing_evicted
+                    self.evicted[evicted_pk] = entry
+
+    def _flush_entry(self, pk, stamp, game, local=True):
+        if self.backend.get(self._stamp_key(pk)) not in (None, stamp):
+            return  # somebody else played it since, it's theirs to flush
+        game._write_behind = False
+        try:
+            game.save_moves()
+        except StaleGameError:  # changed in the database behind the cache's back
+            logger.warning('Game %s changed while it was cached', pk)
+            self._forget(pk)
+            game = self._rebase(pk, game._pending_moves)
+        # without the pending moves now, so nobody saves them again
+        self._publish(pk, game, local)
+
+    def _rebase(self, pk, moves):
+        '''
+        Applies some moves again over the game saved in the database and saves them.
+        Returns the game. Raises StaleGameError if it keeps changing meanwhile.
+        '''
+        for _ in range(settings.GAME_CONFLICT_RETRIES + 1):
+            game = Game.objects.using(Game.database(pk)).get(pk=pk)
+            game.replay_journal()
+            try:
+                game.apply_moves([(MoveKind(move.kind), move.x, move.y) for move in moves])
+            except StaleGameError:
+                continue
+            return game
+        logger.error('Game %s keeps changing, %s moves are lost', pk, len(moves))
+        raise StaleGameError('Too many concurrent changes to game {}'.format(pk))
+
+    def _reload(self, pk):
+        with self.lock:
+            self.games.pop(pk, None)
+            self.dirty.discard(pk)  # nothing left here to flush
+        shared = self.backend.get(self._game_key(pk))
+        if shared is not None:
+            self._store(pk, *shared)  # still ours to flush if it was
+
+    def _forget(self, pk):
+        with self.lock:
+            self.games.pop(pk, None)
+            self.evicted.pop(pk, None)
+            self.dirty.discard(pk)
+        self.backend.delete_many([self._game_key(pk), self._stamp_key(pk)])
+
+    @contextlib.contextmanager
+    def _flushing_evicted(self):
+        '''
+        Flushes the games evicted from the LRU on the way out, once the game which evicted
+        them is unlocked: a thread never waits for a lock while it holds another one
+        '''
+        try:
+            yield
+        finally:
+            with self.lock:
+                evicted = list(self.evicted)
+            for pk in evicted:
+                try:
+                    self.flush(pk)
+                except Exception:  # still dirty, flushed again with the others
+                    logger.exception('Could not flush game %s', pk)
+
+    @contextlib.contextmanager
+    def _locked(self, pk):
+        stripe = int(pk) % LOCK_STRIPES
+        held = self._held.__dict__.setdefault('stripes', set())
+        if stripe in held:  # e.g. evicting a game of the same stripe while playing
+            yield
+            return
+        os.makedirs(self.lock_dir, exist_ok=True)
+        path = os.path.join(self.lock_dir, 'games-{}.lock'.format(stripe))
+        with open(path, 'a') as lock_file:  # closing it releases the lock
+            deadline = time.time() + LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() > deadline:
+                        raise StaleGameError('Game {} is locked'.format(pk))
+                    time.sleep(0.005)
+            held.add(stripe)
+            try:
+                yield
+            finally:
+                held.discard(stripe)
+
+    def _start_flusher(self):
+        with self.lock:
+            if self._flusher is not None or self.flush_interval is None:
+                return
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush_all)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()  # this thread has its own connection
+            self.flush_all()
+
+    @staticmethod
+    def _game_key(pk):
+        return 'game:{}'.format(pk)
+
+    @staticmethod
+    def _stamp_key(pk):
+        return 'game-stamp:{}'.format(pk)
+
+
+_hot_games = None
+
+
+def hot_games():
+    '''The cache of this process'''
+    global _hot_games
+    if _hot_games is None:
+        _hot_games = GameCache(
+            caches['games'],
+            settings.GAME_CACHE_SIZE,
+            settings.GAME_CACHE_FLUSH_INTERVAL,
+            settings.GAME_CACHE_TIMEOUT,
+            settings.GAME_CACHE_LOCK_DIR,
+        )
+    return _hot_games
@@ -0,0 +1,21 @@
+'''
+Tuning of the SQLite connections for many processes writing at once (uwsgi runs 4 and
+every click is a write).
+
+settings.SQLITE_PRAGMAS run on every new connection. The defaults turn on the
+write-ahead log, so reads never wait for the writer and the writer never waits for the
+reads, and only sync it at checkpoints (synchronous=NORMAL: a power cut can lose the
+last moves, but never corrupt the database). The database is read through mmap. How
+long a write waits for the lock before "database is locked" is the timeout in
+DATABASES['default']['OPTIONS'].
+'''
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    '''Receiver of connection_created (see apps.py)'''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
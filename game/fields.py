@@ -0,0 +1,35 @@
+from base64 import b64encode
+
+from django.db import models
+
+from . import metrics
+from .board import Board
+
+
+class BoardField(models.BinaryField):
+    '''
+    Stores a Board in a binary column using its compact format (see board.py).
+    This replaces the pickled matrix of Cell objects we used to have.
+    '''
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        with metrics.phase('board_load'):
+            return Board.from_bytes(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Board):
+            return value
+        return Board.from_bytes(super().to_python(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, Board):
+            value = value.to_bytes()
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        if value is None:
+            return None
+        return b64encode(value.to_bytes()).decode('ascii')
@@ -1,13 +1,21 @@
 from django import forms
 from crispy_forms import helper, layout
 
-from .models import Game
+from .models import Game, Difficulty
+from .no_guess import MAX_CELLS as MAX_NO_GUESS_CELLS
 
 
 class CreateGameForm(forms.ModelForm):
+    custom_fields = ['width', 'height', 'mine_count']
+
     class Meta:
         model = Game
-        fields = ['difficulty']
+        fields = ['difficulty', 'width', 'height', 'mine_count', 'no_guess']
+        help_texts = {
+            'width': 'Custom games only',
+            'height': 'Custom games only',
+            'mine_count': 'Custom games only',
+        }
 
     def __init__(self, *args, action='', **kwargs):
         super().__init__(*args, **kwargs)
@@ -18,3 +26,25 @@ class CreateGameForm(forms.ModelForm):
         self.helper.form_method = 'post'
         self.helper.form_action = action
         self.helper.add_input(layout.Submit('submit', 'Start new game'))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('difficulty') != Difficulty.custom.value:
+            for field in self.custom_fields:  # not used, no point on validating them
+                self.errors.pop(field, None)
+                cleaned_data[field] = None
+            return cleaned_data  # the presets are small enough for no_guess
+
+        for field in self.custom_fields:
+            if cleaned_data.get(field) is None and field not in self.errors:
+                self.add_error(field, 'This field is required for custom games.')
+        width, height = cleaned_data.get('width'), cleaned_data.get('height')
+        mine_count = cleaned_data.get('mine_count')
+        if width and height and mine_count and mine_count >= width * height:
+            self.add_error('mine_count', 'There must be less than {} mines.'.format(width * height))
+        no_guess = cleaned_data.get('no_guess')
+        if width and height and no_guess and width * height > MAX_NO_GUESS_CELLS:
+            self.add_error('no_guess', 'Only boards of up to {} cells can be no-guess.'.format(
+                MAX_NO_GUESS_CELLS
+            ))
+        return cleaned_data
@@ -0,0 +1,211 @@
+'''
+Board generation engine.
+
+The nearby mine counters are a 3x3 convolution of the mine matrix and the safe areas
+are labeled with a two-pass union-find (see
+https://en.wikipedia.org/wiki/Connected-component_labeling). Everything works over
+flat row-major arrays instead of Cell objects.
+
+NumPy is used for the convolution when it's installed. Otherwise a pure python version
+is used. Both return exactly the same counters.
+
+The mines of a game are placed from a seed by a versioned algorithm (see seeded_mines),
+so the layout of a board can be rebuilt from the seed instead of being stored.
+'''
+import functools
+import random
+import re
+
+from .board import Board, area_array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_EMPTY_RUN = re.compile(rb'\x00+')
+_NUMBERED = re.compile(rb'[^\x00]')
+
+GENERATOR = 1  # the algorithm of new boards (see seeded_mines)
+LAYOUT_CACHE_SIZE = 256  # layouts kept by seeded_layout
+
+
+def neighbour_counts(mines, width, height):
+    '''
+    mines is a flat bytes-like object with 1 where there's a mine and 0 otherwise.
+    Returns a bytes object with the number of mines around each cell. Cells with
+    a mine have a counter of 0.
+    '''
+    if numpy is not None:
+        return _neighbour_counts_numpy(mines, width, height)
+    return _neighbour_counts_python(mines, width, height)
+
+
+def _neighbour_counts_numpy(mines, width, height):
+    grid = numpy.frombuffer(bytes(mines), dtype=numpy.uint8).reshape(height, width)
+    padded = numpy.pad(grid, 1, mode='constant')
+    counts = numpy.zeros_like(grid)
+    for dy in range(3):
+        for dx in range(3):
+            if dx != 1 or dy != 1:
+                counts += padded[dy:dy + height, dx:dx + width]
+    counts[grid != 0] = 0
+    return counts.tobytes()
+
+
+def _neighbour_counts_python(mines, width, height):
+    # The 3x3 box filter is separable: add up each row horizontally first, then add
+    # the horizontal sums of the rows above and below
+    mines = bytes(mines)
+    horizontal = [[0] * width]
+    for y in range(height):
+        padded = [0] + list(mines[y * width:(y + 1) * width]) + [0]
+        horizontal.append([a + b + c for a, b, c in zip(padded, padded[1:], padded[2:])])
+    horizontal.append([0] * width)
+
+    counts = bytearray()
+    for y in range(height):
+        row_mines = mines[y * width:(y + 1) * width]
+        counts.extend(
+            0 if mine else above + middle + below  # the cell itself has no mine
+            for mine, above, middle, below in zip(
+                row_mines, horizontal[y], horizontal[y + 1], horizontal[y + 2]
+            )
+        )
+    return bytes(counts)
+
+
+def label_safe_areas(mines, counts, width, height):
+    '''
+    Labels the safe areas of a board. Returns the safe area id of every cell (0 when it
+    isn't in one) plus the index of the cells of every area (see Board.set_safe_areas).
+
+    Safe areas are 4-connected groups of cells without mines nearby, plus their border of
+    numbered cells. Ids are handed out in row-major order of the first cell of each area
+    and a border cell shared by several areas belongs to the one with the lowest id.
+    This matches the numbering of the recursive DFS this replaces, without recursion.
+
+    The union-find works over runs of consecutive empty cells of each row rather than
+    over single cells, and the runs are found with a regex, so big open areas are cheap.
+    '''
+    size = width * height
+    # mines have a counter of 0, so this is 0 only for cells without mines or mines nearby
+    blocked = (int.from_bytes(bytes(mines), 'little') | int.from_bytes(bytes(counts), 'little'))
+    blocked = blocked.to_bytes(size, 'little')
+    counts = bytes(counts)
+    parent = []  # union-find forest over the provisional labels of the runs
+
+    def find(label):
+        root = label
+        while parent[root] != root:
+            root = parent[root]
+        while parent[label] != root:  # path compression
+            parent[label], label = root, parent[label]
+        return root
+
+    # First pass: provisional labels, merging with the overlapping runs of the row above.
+    # The root of every set is kept as its lowest label, which is the label of the first
+    # run of the area in row-major order
+    runs = []
+    previous_row = []
+    for row_start in range(0, size, width):
+        current_row = []
+        j = 0
+        for match in _EMPTY_RUN.finditer(blocked, row_start, row_start + width):
+            start, end = match.span()
+            while j < len(previous_row) and previous_row[j][1] + width <= start:
+                j += 1
+            label = None
+            k = j
+            while k < len(previous_row) and previous_row[k][0] + width < end:
+                other = find(previous_row[k][2])
+                if label is None:
+                    label = other
+                elif other != label:
+                    root = min(label, other)
+                    parent[max(label, other)] = root
+                    label = root
+                k += 1
+            if label is None:
+                label = len(parent)
+                parent.append(label)
+            current_row.append((start, end, label))
+        runs.extend(current_row)
+        previous_row = current_row
+
+    # Second pass: final ids, in the order the areas first appear
+    labels = area_array([0]) * size
+    area_ids = {}
+    area_runs = []
+    for start, end, label in runs:
+        area_id = area_ids.setdefault(find(label), len(area_ids) + 1)
+        labels[start:end] = area_array([area_id]) * (end - start)
+        area_runs.append((start, end, area_id))
+
+    # Border cells (with nearby mines) take the lowest id of the areas next to them
+    borders = {}
+    for start, end, area_id in area_runs:
+        neighbours = []
+        if start % width and counts[start - 1]:
+            neighbours.append(start - 1)
+        if end % width and counts[end]:
+            neighbours.append(end)
+        for offset in (-width, width):
+            if 0 <= start + offset < size:
+                neighbours.extend(
+                    match.start()
+                    for match in _NUMBERED.finditer(counts, start + offset, end + offset)
+                )
+        for index in neighbours:
+            if borders.get(index, area_id) >= area_id:
+                borders[index] = area_id
+
+    members_by_area = [[] for _ in range(len(area_ids) + 1)]
+    for start, end, area_id in area_runs:
+        members_by_area[area_id].append(range(start, end))
+    for index, area_id in borders.items():
+        labels[index] = area_id
+        members_by_area[area_id].append((index,))
+
+    area_offsets, area_members = area_array([0]), area_array()
+    for chunks in members_by_area[1:]:
+        for chunk in chunks:
+            area_members.extend(chunk)
+        area_offsets.append(len(area_members))
+    return labels, area_offsets, area_members
+
+
+def new_seed():
+    return random.SystemRandom().getrandbits(63)  # it fits in a signed 64 bits column
+
+
+def seeded_mines(generator, seed, width, height, mine_count):
+    '''
+    Flat indices of the mines of a board, always the same for the same arguments.
+    Once boards are saved with a generator its results can't change, so a different
+    algorithm (or a python version whose random.sample picks differently) needs a new id.
+    '''
+    if generator == 1:
+        # random sampling without replacement keeps the number of mines (no collisions)
+        return random.Random(seed).sample(range(width * height), mine_count)
+    raise ValueError('Unknown board generator {}'.format(generator))
+
+
+def build_layout(generator, seed, width, height, mine_count):
+    '''
+    The mines, counters and safe areas of a seeded board, as a Board without hidden or
+    flag bits. See Board.from_layout to play it.
+    '''
+    layout = Board(width, height, cells=bytearray(width * height))
+    layout.place_mines(seeded_mines(generator, seed, width, height, mine_count))
+    layout.set_counters(neighbour_counts(layout.mines(), width, height))
+    layout.set_safe_areas(*label_safe_areas(layout.mines(), layout.counters(), width, height))
+    layout.generator, layout.seed = generator, seed
+    return layout
+
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def seeded_layout(generator, seed, width, height, mine_count):
+    '''Same as build_layout, memoized since every load of a game needs it. Don't change it'''
+    return build_layout(generator, seed, width, height, mine_count)
@@ -0,0 +1,80 @@
+'''
+Moves the boards of old finished games out of the database of every shard, into the
+archive (see game/archive.py), and clears them in the game table. The games stay
+playable to look at: they read their board back from the archive when they're loaded.
+
+The games are read in batches of --batch-size with .iterator(), so the boards of only
+one batch are in memory at a time, and every batch is updated in its own short
+transaction. It's meant to run every now and then, e.g. daily from cron. SQLite doesn't
+give the freed space back to the disk until --vacuum.
+'''
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from game.archive import archive
+from game.models import Game
+
+
+class Command(BaseCommand):
+    help = 'Archives the boards of the games finished before the cutoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            help='Archives the games finished more than this many days ago. '
+                 'settings.GAME_ARCHIVE_AFTER_DAYS by default'
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--vacuum', action='store_true',
+            help='Rebuilds the SQLite database afterwards, so its file shrinks'
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.GAME_ARCHIVE_AFTER_DAYS
+        if days < 0 or options['batch_size'] < 1:
+            raise CommandError('The days must be positive and the batches not empty')
+
+        cutoff = timezone.now() - timedelta(days=days)
+        archived = archived_bytes = 0
+        for database in settings.GAME_SHARDS:
+            games, board_bytes = self.archive_shard(database, cutoff, options['batch_size'])
+            archived += games
+            archived_bytes += board_bytes
+            if options['vacuum'] and connections[database].vendor == 'sqlite':
+                with connections[database].cursor() as cursor:
+                    cursor.execute('VACUUM')
+        if options['verbosity'] >= 1:
+            self.stdout.write('Archived {} games ({} bytes of boards)'.format(
+                archived, archived_bytes
+            ))
+
+    def archive_shard(self, database, cutoff, batch_size):
+        '''Returns the games archived and the size of their boards'''
+        games = Game.objects.using(database).filter(
+            game_over=True, archive_slot__isnull=True, board__isnull=False,
+            last_action__lt=cutoff,  # the end of a game is its last action
+        ).order_by('pk')
+        archived = archived_bytes = last_pk = 0
+        while True:
+            boards = [
+                (pk, board.to_bytes()) for pk, board in
+                games.filter(pk__gt=last_pk).values_list('pk', 'board')[:batch_size].iterator()
+            ]
+            if not boards:
+                break
+            slots = archive().append(boards)
+            with transaction.atomic(using=database):
+                for (pk, _), slot in zip(boards, slots):
+                    # skipped if the game was archived meanwhile, its new record is unused
+                    games.filter(pk=pk).update(board=None, archive_slot=slot)
+            archived += len(boards)
+            archived_bytes += sum(len(data) for _, data in boards)
+            last_pk = boards[-1][0]
+        return archived, archived_bytes
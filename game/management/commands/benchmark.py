@@ -0,0 +1,195 @@
+'''
+Micro-benchmarks of the board engine, without HTTP or (mostly) the database.
+
+Every case runs --repeat times per board size and keeps the best and the median time,
+plus the peak memory allocated by one extra run under tracemalloc. The results are JSON.
+Given a --baseline (the output of an earlier run), the command fails when a case got
+slower or bigger than the baseline by more than --threshold.
+'''
+import contextlib
+import json
+import pickle
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from game import generation
+from game.board import Board
+from game.models import Difficulty, Game
+
+
+DEFAULT_SIZES = [9, 16, 22, 100, 300, 1000]
+MINE_DENSITY = 99 / (22 * 22)  # same as hard games
+
+
+def build_game(size, rng):
+    '''Like Game.create, but the game is not saved'''
+    mine_count = max(1, int(size * size * MINE_DENSITY))
+    game = Game(
+        difficulty=Difficulty.custom.value, width=size, height=size, mine_count=mine_count
+    )
+    game.board = Board(size, size)
+    game._place_mines(rng.sample(range(size * size), mine_count))
+    game._identify_safe_areas()
+    game.hidden_safe_cells, game.flagged_mines, game.wrong_flags = game._count_cells()
+    return game
+
+
+def copy_game(game, board_bytes):
+    copy = Game(
+        difficulty=game.difficulty, width=game.width, height=game.height,
+        mine_count=game.mine_count, hidden_safe_cells=game.hidden_safe_cells,
+        flagged_mines=game.flagged_mines, wrong_flags=game.wrong_flags,
+        creation_datetime=timezone.now(),  # only saving sets it
+    )
+    copy.board = Board.from_bytes(board_bytes)
+    return copy
+
+
+def cases(size, rng):
+    '''
+    Yields (name, setup, run) for every case. setup() isn't timed and its result is
+    passed to run().
+    '''
+    game = build_game(size, rng)
+    board_bytes = game.board.to_bytes()
+    pickled_board = pickle.dumps(game.board)
+    mine_indices = list(game.board.mine_indices())
+    offsets = game.board.area_offsets
+    biggest_area = max(
+        range(1, len(offsets)), key=lambda area: offsets[area] - offsets[area - 1], default=None
+    )
+
+    def fresh_game():
+        return copy_game(game, board_bytes)
+
+    def without_safe_areas():
+        unsaved = fresh_game()
+        unsaved.board.set_safe_areas(Board(size, size).safe_areas)
+        return unsaved
+
+    def create(_):
+        with contextlib.ExitStack() as stack:
+            for database in settings.GAME_SHARDS:  # it goes to any of them
+                stack.enter_context(transaction.atomic(using=database))
+            Game.create(
+                difficulty=Difficulty.custom, width=size, height=size, mine_count=game.mine_count
+            )
+            for database in settings.GAME_SHARDS:
+                transaction.set_rollback(True, using=database)  # nothing is left behind
+
+    def place_mines(unsaved):
+        unsaved._place_mines(mine_indices)
+
+    def move(action, index):
+        # commit=False keeps the database out of it (see Game.save_moves)
+        return lambda unsaved: getattr(unsaved, action)(index % size, index // size, commit=False)
+
+    def empty_game():
+        unsaved = Game()
+        unsaved.board = Board(size, size)
+        return unsaved
+
+    yield 'create', lambda: None, create
+    yield 'place_mines', empty_game, place_mines
+    yield 'identify_safe_areas', without_safe_areas, Game._identify_safe_areas
+    if biggest_area is not None:
+        first_cell = game.board.area_indices(biggest_area)[0]
+        yield 'sweep_safe_area', fresh_game, move('sweep_cell', first_cell)
+    yield 'sweep_mine', fresh_game, move('sweep_cell', mine_indices[0])
+    yield 'flag_cell', fresh_game, move('flag_cell', mine_indices[0])
+    yield 'check_winning_state', fresh_game, Game._check_for_winning_state
+    yield 'pickle_board', lambda: game.board, pickle.dumps
+    yield 'unpickle_board', lambda: pickled_board, pickle.loads
+
+
+def measure(setup, run, repeat):
+    times = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        run(argument)
+        times.append(time.perf_counter() - start)
+
+    argument = setup()
+    tracemalloc.start()
+    try:
+        run(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'best_s': min(times),
+        'median_s': statistics.median(times),
+        'peak_kib': peak / 1024,
+    }
+
+
+def regressions(results, baseline, threshold):
+    '''Descriptions of the results worse than the baseline by more than the threshold'''
+    found = []
+    for case, sizes in sorted(results.items()):
+        for size, result in sorted(sizes.items(), key=lambda item: int(item[0])):
+            expected = baseline.get(case, {}).get(size)
+            if expected is None:
+                continue
+            for metric in ('best_s', 'peak_kib'):
+                if result[metric] > expected[metric] * (1 + threshold):
+                    found.append('{} {}x{} {}: {:.6g} (baseline {:.6g})'.format(
+                        case, size, size, metric, result[metric], expected[metric]
+                    ))
+    return found
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the board engine and checks the results against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', type=int, action='append', dest='sizes',
+            help='Board width and height (can be repeated). {} by default'.format(DEFAULT_SIZES)
+        )
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File for the JSON results. stdout by default')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+        parser.add_argument(
+            '--threshold', type=float, default=0.25,
+            help='Fails when a result is worse than the baseline by more than this fraction'
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        results = {}
+        for size in options['sizes'] or DEFAULT_SIZES:
+            if options['verbosity'] >= 2:
+                self.stderr.write('{}x{}'.format(size, size))
+            for name, setup, run in cases(size, rng):
+                results.setdefault(name, {})[str(size)] = measure(setup, run, options['repeat'])
+
+        output = json.dumps({
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': generation.numpy is not None,
+            },
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)['results']
+            found = regressions(results, baseline, options['threshold'])
+            if found:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(found))
@@ -0,0 +1,108 @@
+'''
+Deletes the unfinished games nobody played for a while, with their moves.
+
+Many games are never finished: players leave, and bots post the create form. A game is
+abandoned when neither its last snapshot (Game.last_action) nor any move of its journal
+is newer than the cutoff.
+
+Every shard (see game/sharding.py) is collected in turn. Its games are checked in ranges
+of --batch-size primary keys, each in its own short transaction, so the write lock of
+SQLite is never held for long and the clicks of the players wait for it a few
+milliseconds at most. The range is walked through the primary key index, so no other
+index is needed. SQLite reuses the freed pages for new games. With --loop it keeps
+collecting forever (see deployment/supervisor-app.conf).
+'''
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+from django.db.models import Max, Min, Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from game.models import Game, Move
+
+
+class Command(BaseCommand):
+    help = 'Deletes the unfinished games without moves since the cutoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=float,
+            help='Games idle for longer than this are deleted. '
+                 'settings.GAME_ABANDONED_AFTER_HOURS by default'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=200, help='Primary keys checked per transaction'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.01,
+            help='Seconds between transactions, so waiting requests get the database'
+        )
+        parser.add_argument(
+            '--loop', type=float, metavar='SECONDS',
+            help='Keeps collecting, every this many seconds'
+        )
+
+    def handle(self, *args, **options):
+        hours = options['hours']
+        if hours is None:
+            hours = settings.GAME_ABANDONED_AFTER_HOURS
+        if hours < 0 or options['batch_size'] < 1:
+            raise CommandError('The hours must be positive and the batches not empty')
+
+        try:
+            while True:
+                close_old_connections()
+                cutoff = timezone.now() - timedelta(hours=hours)
+                games = rows = board_bytes = 0
+                for database in settings.GAME_SHARDS:
+                    shard_games, shard_rows, shard_bytes = self.collect(
+                        database, cutoff, options['batch_size'], options['pause']
+                    )
+                    games += shard_games
+                    rows += shard_rows
+                    board_bytes += shard_bytes
+                if options['verbosity'] >= 1:
+                    self.stdout.write(
+                        'Deleted {} abandoned games: {} rows with their moves, '
+                        '{} bytes of boards'.format(games, rows, board_bytes)
+                    )
+                if options['loop'] is None:
+                    break
+                time.sleep(options['loop'])
+        except KeyboardInterrupt:
+            pass
+
+    def collect(self, database, cutoff, batch_size, pause):
+        '''Returns the games and rows deleted from a shard and the size of their boards'''
+        games = rows = board_bytes = 0
+        bounds = Game.objects.using(database).aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return games, rows, board_bytes
+
+        for start in range(bounds['first'], bounds['last'] + 1, batch_size):
+            with transaction.atomic(using=database):
+                idle = Game.objects.using(database).filter(
+                    pk__gte=start, pk__lt=start + batch_size,
+                    game_over=False, last_action__lt=cutoff,
+                )
+                candidates = list(idle.values_list('pk', flat=True))
+                if not candidates:
+                    continue
+                # the moves after the last snapshot are only in the journal
+                played = Move.objects.using(database).filter(
+                    game__in=candidates, timestamp__gte=cutoff
+                ).values_list('game', flat=True).distinct()
+                abandoned_pks = set(candidates) - set(played)
+                abandoned = idle.filter(pk__in=abandoned_pks)
+                size = abandoned.aggregate(size=Sum(Length('board')))['size']
+                # the boards aren't loaded, deleting needs the primary keys only
+                deleted, _ = abandoned.only('pk').delete()
+            games += len(abandoned_pks)
+            rows += deleted
+            board_bytes += size or 0
+            time.sleep(pause)
+        return games, rows, board_bytes
@@ -0,0 +1,110 @@
+'''
+Keeps the pool of ready boards of every shard full (see game.models.PooledBoard).
+
+The boards are generated in a pool of processes, since generation is CPU bound, and
+saved in small batches so the database is never locked for long. With --loop it keeps
+refilling the pool forever, which is how it runs in production (see
+deployment/supervisor-app.conf).
+'''
+import os
+import time
+from concurrent import futures
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from game.models import Difficulty, Game, PooledBoard
+
+
+SAVE_BATCH_SIZE = 20
+
+
+def configurations():
+    '''(width, height, mine_count) of every size kept in the pool'''
+    sizes = []
+    for difficulty in Difficulty:
+        if difficulty != Difficulty.custom:
+            board_size, mine_count = Game._get_board_configuration(difficulty)
+            sizes.append((board_size, board_size, mine_count))
+    for size in settings.GAME_BOARD_POOL_CUSTOM:
+        if tuple(size) not in sizes:
+            sizes.append(tuple(size))
+    return sizes
+
+
+def generate(size):
+    '''Runs in the pool of processes. Returns the board in its compact format'''
+    return Game.generate_board(*size).to_bytes()
+
+
+class Command(BaseCommand):
+    help = 'Generates boards ahead of time until the pool of every size is full'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--depth', type=int,
+            help='Boards of every size in every shard. settings.GAME_BOARD_POOL_DEPTH by default'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Processes generating boards. 1 generates them in this process'
+        )
+        parser.add_argument(
+            '--loop', type=float, metavar='SECONDS',
+            help='Keeps refilling the pool, checking it every this many seconds'
+        )
+
+    def handle(self, *args, **options):
+        depth = options['depth']
+        if depth is None:
+            depth = settings.GAME_BOARD_POOL_DEPTH
+        if depth < 0 or options['processes'] < 1:
+            raise CommandError('The depth must be positive and there must be one process')
+
+        if options['processes'] == 1:  # e.g. in the tests
+            pool = None
+        else:
+            connections.close_all()  # the processes don't need the database
+            pool = futures.ProcessPoolExecutor(options['processes'])
+        try:
+            while True:
+                close_old_connections()
+                for database in settings.GAME_SHARDS:
+                    for size in configurations():
+                        self.fill(database, size, depth, pool, options['verbosity'])
+                if options['loop'] is None:
+                    break
+                time.sleep(options['loop'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def fill(self, database, size, depth, pool, verbosity):
+        width, height, mine_count = size
+        boards_of_shard = PooledBoard.objects.using(database)
+        missing = depth - boards_of_shard.filter(
+            width=width, height=height, mine_count=mine_count
+        ).count()
+        if missing <= 0:
+            return
+        if pool is None:
+            boards = map(generate, [size] * missing)
+        else:
+            boards = pool.map(generate, [size] * missing, chunksize=max(1, missing // 32))
+
+        batch = []
+        for board in boards:
+            batch.append(PooledBoard(
+                width=width, height=height, mine_count=mine_count, board=board
+            ))
+            if len(batch) == SAVE_BATCH_SIZE:
+                boards_of_shard.bulk_create(batch)
+                batch = []
+        boards_of_shard.bulk_create(batch)
+        if verbosity >= 1:
+            self.stdout.write('Added {} boards of {}x{} with {} mines to {}'.format(
+                missing, width, height, mine_count, database
+            ))
@@ -0,0 +1,270 @@
+'''
+Simulates players to measure how the app behaves under load.
+
+Every player creates a game through the create view, opens it and plays it through the
+sweep and flag views with some think time between clicks, starting a new game when one
+ends. Players run in a pool of threads (or processes) against the test client, which
+goes straight to the views in this process, or against a running server (--url).
+
+With the test client the games go to the databases of the settings, like the ones of a
+server would: they're deleted afterwards (unless --keep), but the boards they took from
+the pool (see fill_board_pool) are gone. Run it with the settings of a copy to keep the
+pool of a real database.
+
+The summary is JSON: throughput, latency percentiles per endpoint and per difficulty,
+and the errors, including the "database is locked" ones.
+'''
+import http.cookiejar
+import json
+import logging
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent import futures
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import OperationalError, connections
+from django.test import Client
+
+from game import sharding
+from game.models import Difficulty, Game
+from game.views import signer
+
+
+ENDPOINTS = ['create', 'match', 'sweep', 'flag']
+
+
+class TestClientTransport:
+    '''Requests through the test client, in this process'''
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, path, data=None, ajax=False):
+        extra = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'} if ajax else {}
+        if method == 'GET':
+            response = self.client.get(path, **extra)
+        else:
+            response = self.client.post(path, data, **extra)
+        return response.status_code, response.get('Location', '')
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # the redirection of the create view has the url of the game
+
+
+class HttpTransport:
+    '''Requests to a running server, with its cookies and csrf token like a browser'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirects()
+        )
+
+    def request(self, method, path, data=None, ajax=False):
+        url = self.base_url + path
+        headers = {'Referer': url}
+        if ajax:
+            headers['X-Requested-With'] = 'XMLHttpRequest'
+        body = None
+        if method == 'POST':
+            csrf_token = next((c.value for c in self.cookies if c.name == 'csrftoken'), '')
+            headers['X-CSRFToken'] = csrf_token
+            body = urllib.parse.urlencode(dict(data, csrfmiddlewaretoken=csrf_token)).encode()
+        request = urllib.request.Request(url, body, headers, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, response.headers.get('Location', '')
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get('Location', '')
+
+
+def run_player(number, options):
+    '''
+    Plays until the player made options['moves'] moves. Returns the samples, as
+    (endpoint, difficulty, seconds, status, error) tuples, and the ids of the games.
+    '''
+    rng = random.Random(options['seed'] + number)
+    if options['url']:
+        transport = HttpTransport(options['url'])
+    else:
+        transport = TestClientTransport()
+    samples, game_ids = [], []
+
+    def timed(endpoint, difficulty, method, path, data=None, ajax=False):
+        start = time.perf_counter()
+        error = None
+        try:
+            status, location = transport.request(method, path, data, ajax)
+        except OperationalError as exception:  # only with the test client
+            status, location = 500, ''
+            error = 'lock' if 'locked' in str(exception) else 'database'
+        except Exception as exception:
+            status, location = 500, ''
+            error = type(exception).__name__
+        if error is None and status >= 500:
+            error = 'server'
+        samples.append((endpoint, difficulty.name, time.perf_counter() - start, status, error))
+        return status, location
+
+    transport.request('GET', reverse('game:create'))  # the csrf cookie
+    moves = 0
+    while moves < options['moves']:
+        difficulty = rng.choice(options['difficulties'])
+        status, location = timed(
+            'create', difficulty, 'POST', reverse('game:create'), {'difficulty': difficulty.value}
+        )
+        if status != 302:
+            continue
+        signed_id = urllib.parse.urlparse(location).path.rstrip('/').split('/')[-1]
+        game_ids.append(int(signer.unsign(signed_id)))
+        timed('match', difficulty, 'GET', reverse('game:match', args=(signed_id,)))
+
+        size, _ = Game._get_board_configuration(difficulty)
+        hidden = [(x, y) for x in range(size) for y in range(size)]
+        rng.shuffle(hidden)
+        while hidden and moves < options['moves']:
+            if options['think_time']:
+                time.sleep(rng.expovariate(1000 / options['think_time']))
+            x, y = hidden.pop()
+            endpoint = 'flag' if rng.random() < options['flag_ratio'] else 'sweep'
+            url = reverse('game:' + endpoint, args=(signed_id,))
+            timed(endpoint, difficulty, 'POST', url, {'x': x, 'y': y}, ajax=True)
+            moves += 1
+            if endpoint == 'sweep' and rng.random() < options['give_up_ratio']:
+                break  # players don't always finish their games
+    return samples, game_ids
+
+
+def _run_player_in_process(number, options):
+    connections.close_all()  # don't share the parent's connections
+    return run_player(number, options)
+
+
+def percentile(sorted_values, fraction):
+    '''Nearest-rank percentile'''
+    if not sorted_values:
+        return None
+    index = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(samples):
+    latencies = sorted(seconds * 1000 for _, _, seconds, _, _ in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample[4] is not None),
+        'conflicts': sum(1 for sample in samples if sample[3] == 409),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1] if latencies else None,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Simulates concurrent players and reports throughput and latencies as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=10)
+        parser.add_argument('--moves', type=int, default=50, help='Moves of every player')
+        parser.add_argument(
+            '--difficulty', action='append', dest='difficulties',
+            choices=[x.name for x in Difficulty if x != Difficulty.custom],
+            help='Difficulty of the games (can be repeated). All but custom by default'
+        )
+        parser.add_argument('--workers', type=int, help='Pool size. One per player by default')
+        parser.add_argument('--processes', action='store_true', help='Processes, not threads')
+        parser.add_argument(
+            '--url',
+            help='Base url of a running server. Without it the test client plays on the '
+                 'configured databases and takes boards from their pool'
+        )
+        parser.add_argument('--think-time', type=float, default=200, help='Mean ms between clicks')
+        parser.add_argument('--flag-ratio', type=float, default=0.15)
+        parser.add_argument('--give-up-ratio', type=float, default=0.02)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help="Don't delete the games afterwards")
+        parser.add_argument('--output', help='File for the JSON summary. stdout by default')
+
+    def handle(self, *args, **options):
+        if options['players'] < 1 or options['moves'] < 1:
+            raise CommandError('There must be at least one player and one move')
+        player_options = {
+            'url': options['url'],
+            'moves': options['moves'],
+            'difficulties': [
+                Difficulty[name]
+                for name in options['difficulties'] or
+                [x.name for x in Difficulty if x != Difficulty.custom]
+            ],
+            'think_time': options['think_time'],
+            'flag_ratio': options['flag_ratio'],
+            'give_up_ratio': options['give_up_ratio'],
+            'seed': options['seed'],
+        }
+        workers = options['workers'] or options['players']
+
+        request_logger = logging.getLogger('django.request')
+        if options['verbosity'] < 2:  # the errors are counted in the summary anyway
+            request_logger.disabled = True
+        start = time.perf_counter()
+        if workers == 1:  # in this thread, e.g. in the tests
+            results = [run_player(n, player_options) for n in range(options['players'])]
+        else:
+            if options['processes']:
+                connections.close_all()
+                pool, function = futures.ProcessPoolExecutor(workers), _run_player_in_process
+            else:
+                pool, function = futures.ThreadPoolExecutor(workers), run_player
+            with pool:
+                results = list(pool.map(
+                    function, range(options['players']), [player_options] * options['players']
+                ))
+        duration = time.perf_counter() - start
+        request_logger.disabled = False
+
+        samples = [sample for player_samples, _ in results for sample in player_samples]
+        summary = {
+            'options': {
+                key: value for key, value in options.items()
+                if key in ('players', 'moves', 'difficulties', 'workers', 'processes', 'url',
+                           'think_time', 'flag_ratio', 'give_up_ratio', 'seed')
+            },
+            'duration_s': duration,
+            'throughput_rps': len(samples) / duration,
+            'lock_errors': sum(1 for sample in samples if sample[4] == 'lock'),
+            'total': summarize(samples),
+            'endpoints': {
+                endpoint: summarize([sample for sample in samples if sample[0] == endpoint])
+                for endpoint in ENDPOINTS
+            },
+            'difficulties': {
+                difficulty.name: summarize([s for s in samples if s[1] == difficulty.name])
+                for difficulty in player_options['difficulties']
+            },
+        }
+
+        if not options['keep'] and not options['url']:
+            game_ids = {}  # by shard
+            for _, player_game_ids in results:
+                for pk in player_game_ids:
+                    game_ids.setdefault(sharding.database(pk), []).append(pk)
+            for database, pks in game_ids.items():
+                for i in range(0, len(pks), 500):  # SQLite takes up to 999 parameters
+                    Game.objects.using(database).filter(pk__in=pks[i:i + 500]).delete()
+
+        output = json.dumps(summary, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
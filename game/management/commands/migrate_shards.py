@@ -0,0 +1,25 @@
+'''
+Runs migrate on every database of settings.GAME_SHARDS (see game/sharding.py), the
+default one first, so deploying doesn't have to know how many shards there are (see
+deployment/Dockerfile). Then it sets where the ids of every shard go on again, which
+SQLite forgets when a migration rebuilds the game table of an empty shard.
+'''
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from game import sharding
+
+
+class Command(BaseCommand):
+    help = 'Migrates the default database and every shard of the games'
+
+    def handle(self, *args, **options):
+        for database in settings.GAME_SHARDS:
+            if options['verbosity'] >= 1:
+                self.stdout.write('Migrating {}'.format(database))
+            call_command(
+                'migrate', database=database, interactive=False,
+                verbosity=options['verbosity'], stdout=self.stdout,
+            )
+            sharding.start_ids(database)
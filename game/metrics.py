@@ -0,0 +1,278 @@
+'''
+Timings of the requests and counters of the games, exposed at /metrics in the text
+format of Prometheus.
+
+Every timed request (see timed) is split into phases, e.g. checking the signed id,
+fetching the game, loading the board, the game logic, saving and rendering. The code
+marks them with `with metrics.phase('save'):`. Phases can be nested, and a phase only
+gets the time not spent in the phases inside it, so the phases of a request add up to
+its total time. Whatever isn't in any phase is counted as 'other'.
+
+The numbers are kept in memory by every process and written to its own file in
+settings.GAME_METRICS_DIR about once a second, named after a random id of the process so
+a new process never takes over the file of an old one with the same pid. /metrics adds
+up the files of all the processes (uwsgi runs several). When a process exits, its
+numbers are added to RETIRED_FILE and its file is removed, so the files don't pile up
+as uwsgi respawns its workers and the counters never go back. When the setting is None,
+phase() and timed() do nothing but check it.
+'''
+import atexit
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DUMP_INTERVAL = 1  # seconds
+RETIRED_FILE = 'retired.json'  # the numbers of the processes which exited
+
+_local = threading.local()
+
+
+class _NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ('name', 'start', 'children')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        _local.stack.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        _local.stack.pop()
+        if _local.stack:
+            _local.stack[-1].children += elapsed
+        phases = _local.phases
+        phases[self.name] = phases.get(self.name, 0) + elapsed - self.children
+
+
+def phase(name):
+    '''Times a phase of the current request. Does nothing outside timed requests'''
+    if settings.GAME_METRICS_DIR is None or not getattr(_local, 'stack', None):
+        return _NULL_PHASE
+    return _Phase(name)
+
+
+def timed(endpoint):
+    '''Decorator of the views whose requests are split into phases'''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if settings.GAME_METRICS_DIR is None:
+                return view(*args, **kwargs)
+            _local.stack, _local.phases = [], {}
+            request_phase = _Phase('other')
+            try:
+                with request_phase:
+                    return view(*args, **kwargs)
+            finally:
+                phases, _local.stack = _local.phases, None
+                total = sum(phases.values())
+                registry.observe('game_request_seconds', {'endpoint': endpoint}, total)
+                for name, seconds in phases.items():
+                    labels = {'endpoint': endpoint, 'phase': name}
+                    registry.observe('game_request_phase_seconds', labels, seconds)
+                registry.dump_if_due()
+        return wrapper
+    return decorator
+
+
+def count(name, **labels):
+    '''Adds one to a counter, e.g. count('game_games_won_total', difficulty='easy')'''
+    if settings.GAME_METRICS_DIR is not None:
+        registry.inc(name, labels)
+        registry.dump_if_due()
+
+
+class Registry:
+    '''The numbers of this process'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self._reset()
+
+    def _reset(self):
+        '''Starts from zero in a new process, which the uwsgi workers are after the fork'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.file_name = 'metrics-{}-{}.json'.format(self.pid, uuid.uuid4().hex)
+            self.counters = {}  # (name, labels) -> value
+            self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+            self.last_dump = 0
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._reset()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._reset()
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def dump_if_due(self):
+        if time.time() - self.last_dump >= DUMP_INTERVAL:
+            self.dump()
+
+    def dump(self):
+        directory = settings.GAME_METRICS_DIR
+        if directory is None:
+            return
+        with self.lock:
+            self._reset()
+            self.last_dump = time.time()
+            data = _serialize(self.counters, self.histograms)
+            file_name = self.file_name
+        os.makedirs(directory, exist_ok=True)
+        _write(os.path.join(directory, file_name), data)
+
+    def retire(self):
+        '''
+        At exit, adds the numbers of this process to RETIRED_FILE and removes its file.
+        The retired file lists the files it has the numbers of, so collect doesn't count
+        them twice while they're being removed.
+        '''
+        directory = settings.GAME_METRICS_DIR
+        if directory is None or self.pid != os.getpid():
+            return  # nothing counted in this process
+        self.dump()
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        with open(retired_path + '.lock', 'a') as lock_file:  # one process at a time
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired = _read(retired_path) or {'counters': [], 'histograms': [], 'files': []}
+            own = _read(os.path.join(directory, self.file_name))
+            counters, histograms = _add_up([retired, own] if own else [retired])
+            data = _serialize(counters, histograms)
+            # the files removed for good can't be counted anymore
+            data['files'] = [
+                name for name in retired['files']
+                if os.path.exists(os.path.join(directory, name))
+            ] + [self.file_name]
+            _write(retired_path, data)
+        os.remove(os.path.join(directory, self.file_name))
+
+
+def _serialize(counters, histograms):
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, values] for (name, labels), values in histograms.items()],
+    }
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'w') as metrics_file:
+        json.dump(data, metrics_file)
+    os.replace(path + '.tmp', path)  # so it's never read half written
+
+
+def _read(path):
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return None  # e.g. removed meanwhile
+
+
+def _add_up(files):
+    counters, histograms = {}, {}
+    for data in files:
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in data['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    return counters, histograms
+
+
+registry = Registry()
+atexit.register(registry.retire)
+
+
+def collect(directory):
+    '''Adds up the numbers of every process, running or retired'''
+    registry.dump()
+    processes = {}
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.json') and file_name != RETIRED_FILE:
+            data = _read(os.path.join(directory, file_name))
+            if data is not None:
+                processes[file_name] = data
+    # read last, it has the numbers of any file removed since they were listed
+    retired = _read(os.path.join(directory, RETIRED_FILE))
+    if retired is None:
+        return _add_up(processes.values())
+    files = [data for name, data in processes.items() if name not in retired['files']]
+    return _add_up(files + [retired])
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels, extra=()):
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels + extra) + '}'
+
+
+def render(counters, histograms):
+    '''The text exposition format of Prometheus'''
+    lines = []
+    for metric in sorted({name for name, _ in counters}):
+        lines.append('# TYPE {} counter'.format(metric))
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+    for metric in sorted({name for name, _ in histograms}):
+        lines.append('# TYPE {} histogram'.format(metric))
+        for (name, labels), values in sorted(histograms.items()):
+            if name != metric:
+                continue
+            for bound, value in zip(BUCKETS, values):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, (('le', bound),)), value
+                ))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels, (('le', '+Inf'),)), values[-1]
+            ))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), values[-2]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    directory = settings.GAME_METRICS_DIR
+    if directory is None:
+        raise Http404
+    os.makedirs(directory, exist_ok=True)
+    return HttpResponse(render(*collect(directory)), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import pickle
+import struct
+from base64 import b64decode
+
+from django.db import migrations
+import game.fields
+
+
+class _LegacyCell:
+    '''Stand-in for the Cell class that used to be pickled in game.models'''
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) == ('game.models', 'Cell'):
+            return _LegacyCell
+        return super().find_class(module, name)
+
+
+# the version 1 format of game/board.py, which it still reads. It's frozen here, so the
+# changes of Board since don't change what this migration writes
+_HEADER = struct.Struct('<BHHB')  # version, width, height, bytes per safe area id
+_AREA_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+MINE, FLAG, HIDDEN, COUNTER_SHIFT = 0x01, 0x02, 0x04, 4
+
+
+def _convert_legacy_board(value):
+    '''
+    Converts the base64 pickled matrix of Cells (see picklefield's dbsafe_encode)
+    into a packed board. Games created without a board are stored as None.
+    '''
+    matrix = _LegacyUnpickler(io.BytesIO(b64decode(value))).load()
+    if not matrix:
+        return None
+
+    cells, safe_areas = bytearray(), []
+    for row in matrix:
+        for legacy_cell in row:
+            cells.append(
+                (MINE if legacy_cell.has_mine else 0) |
+                (FLAG if legacy_cell.has_flag else 0) |
+                (HIDDEN if legacy_cell.hidden else 0) |
+                legacy_cell.nearby_mine_counter << COUNTER_SHIFT
+            )
+            safe_areas.append(legacy_cell.safe_area_id or 0)
+    area_size = next(size for size in (1, 2, 4) if max(safe_areas) < 1 << (8 * size))
+    area_format = '<{}{}'.format(len(safe_areas), _AREA_FORMATS[area_size])
+    header = _HEADER.pack(1, len(matrix[0]), len(matrix), area_size)
+    return b''.join((header, bytes(cells), struct.pack(area_format, *safe_areas)))
+
+
+def pack_boards(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    # Raw SQL on purpose: the historical model would try to unpickle the old column
+    # and the Cell class it references doesn't exist anymore
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT id, board FROM {}'.format(Game._meta.db_table))
+        rows = cursor.fetchall()
+        unreadable = []
+        for game_id, value in rows:
+            if not value:
+                continue
+            try:
+                board = _convert_legacy_board(value)
+            except Exception:  # anything unpickling garbage raises
+                unreadable.append(game_id)
+                continue
+            cursor.execute(
+                'UPDATE {} SET packed_board = %s WHERE id = %s'.format(Game._meta.db_table),
+                [board, game_id]
+            )
+    if unreadable:  # they'd be games without a board
+        raise RuntimeError(
+            'The boards of the games {} cannot be read. Fix or delete them and migrate '
+            'again'.format(unreadable)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_auto_20160529_2355'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='packed_board',
+            field=game.fields.BoardField(null=True),
+        ),
+        migrations.RunPython(pack_boards),
+        migrations.RemoveField(
+            model_name='game',
+            name='board',
+        ),
+        migrations.RenameField(
+            model_name='game',
+            old_name='packed_board',
+            new_name='board',
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 20:36
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def fill_board_configuration(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    configuration = {0: (3, 2), 1: (9, 10), 2: (16, 40), 3: (22, 99)}
+    for difficulty, (board_size, mine_count) in configuration.items():
+        Game.objects.filter(difficulty=difficulty).update(
+            width=board_size, height=board_size, mine_count=mine_count
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0011_packed_board'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(2), django.core.validators.MaxValueValidator(1000)]),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='mine_count',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(2), django.core.validators.MaxValueValidator(1000)]),
+        ),
+        migrations.AlterField(
+            model_name='game',
+            name='difficulty',
+            field=models.IntegerField(choices=[(0, 'Super Easy'), (1, 'Easy'), (2, 'Normal'), (3, 'Hard'), (4, 'Custom')], default=1, null=True),
+        ),
+        migrations.RunPython(fill_board_configuration, migrations.RunPython.noop),
+    ]
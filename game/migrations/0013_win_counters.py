@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 20:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_cells(apps, schema_editor):
+    from game.board import FLAG, HIDDEN, MINE
+
+    Game = apps.get_model('game', 'Game')
+    for game in Game.objects.exclude(board__isnull=True).iterator():
+        Game.objects.filter(pk=game.pk).update(
+            hidden_safe_cells=game.board.count(MINE | HIDDEN, HIDDEN),
+            flagged_mines=game.board.count(MINE | FLAG, MINE | FLAG),
+            wrong_flags=game.board.count(MINE | FLAG, FLAG),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0012_custom_games'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='flagged_mines',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='hidden_safe_cells',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='wrong_flags',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_cells, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 20:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_game_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='move',
+            name='kind',
+            field=models.IntegerField(choices=[(0, 'Sweep'), (1, 'Flag'), (2, 'Chord')]),
+        ),
+    ]
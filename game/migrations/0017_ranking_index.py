@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 20:53
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_move_chord'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='game',
+            index_together=set([('difficulty', 'win', 'game_over', 'end_timer')]),
+        ),
+    ]
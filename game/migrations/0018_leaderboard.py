@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 20:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_leaderboard(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    LeaderboardEntry = apps.get_model('game', 'LeaderboardEntry')
+    won_games = Game.objects.filter(win=True, game_over=True).exclude(difficulty=4)  # custom
+    LeaderboardEntry.objects.bulk_create(
+        LeaderboardEntry(game_id=game_id, difficulty=difficulty, end_timer=end_timer)
+        for game_id, difficulty, end_timer in won_games.values_list(
+            'id', 'difficulty', 'end_timer'
+        ).iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0017_ranking_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('difficulty', models.IntegerField()),
+                ('end_timer', models.PositiveIntegerField()),
+                ('game', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entry', to='game.Game')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='leaderboardentry',
+            index_together=set([('difficulty', 'end_timer', 'game')]),
+        ),
+        migrations.RunPython(fill_leaderboard, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import game.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_leaderboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledBoard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('mine_count', models.PositiveIntegerField()),
+                ('board', game.fields.BoardField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='pooledboard',
+            index_together=set([('width', 'height', 'mine_count')]),
+        ),
+    ]
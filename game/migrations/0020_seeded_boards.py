@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0019_board_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='generator',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='seed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
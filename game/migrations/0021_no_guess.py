@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0020_seeded_boards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='no_guess',
+            field=models.BooleanField(default=False, help_text='Never needs a guess. The first area is opened for you'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0021_no_guess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='archive_slot',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
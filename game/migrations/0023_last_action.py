@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_last_action(apps, schema_editor):
+    # the moves since the last snapshot have their own timestamps, the sweeper checks them
+    Game = apps.get_model('game', 'Game')
+    Game.objects.update(last_action=models.F('creation_datetime'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0022_archive_slot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='last_action',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_last_action, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:30
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations
+
+
+def start_ids(apps, schema_editor):
+    # the ids of every shard start at its own offset (see game/sharding.py)
+    from game.sharding import first_id
+    connection = schema_editor.connection
+    if connection.alias not in settings.GAME_SHARDS:
+        return
+    start = first_id(connection.alias)
+    if not start:
+        return
+    if connection.vendor != 'sqlite':  # see sharding.check_backends
+        raise ImproperlyConfigured(
+            'Database {} of GAME_SHARDS is not SQLite, set GAME_SHARD_COUNT to 1'.format(
+                connection.alias
+            )
+        )
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'game_game'")
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('game_game', %s)", [start]
+            )
+        elif row[0] < start:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = 'game_game'", [start])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0023_last_action'),
+    ]
+
+    operations = [
+        migrations.RunPython(start_ids, migrations.RunPython.noop, hints={'shards': True}),
+    ]
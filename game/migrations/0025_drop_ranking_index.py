@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 21:58
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+RANKING_INDEX = ('difficulty', 'win', 'game_over', 'end_timer')
+
+
+# The schema editor of SQLite drops an index by rebuilding the whole table, which also
+# forgets where the ids of a shard start (see 0024_shard_ids). The index is dropped by
+# name instead
+def drop_ranking_index(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, Game._meta.db_table)
+    for name, details in constraints.items():
+        if details['index'] and not details['unique'] and details['columns'] == list(RANKING_INDEX):
+            schema_editor.execute(schema_editor.sql_delete_index % {
+                'name': schema_editor.quote_name(name),
+            })
+
+
+def create_ranking_index(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    fields = [Game._meta.get_field(name) for name in RANKING_INDEX]
+    schema_editor.execute(schema_editor._create_index_sql(Game, fields, suffix='_idx'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0024_shard_ids'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(
+                    drop_ranking_index, create_ranking_index, hints={'shards': True}
+                ),
+            ],
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='game',
+                    index_together=set([]),
+                ),
+            ],
+        ),
+    ]
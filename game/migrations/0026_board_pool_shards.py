@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 23:12
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+def create_pools(apps, schema_editor):
+    # every shard has its own pool of boards now (see PooledBoard.claim). The shards
+    # created since have it already, 0019_board_pool made it there
+    PooledBoard = apps.get_model('game', 'PooledBoard')
+    connection = schema_editor.connection
+    if connection.alias not in settings.GAME_SHARDS[1:]:
+        return
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+    if PooledBoard._meta.db_table not in tables:
+        schema_editor.create_model(PooledBoard)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0025_drop_ranking_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_pools, migrations.RunPython.noop, hints={'shards': True}),
+    ]
@@ -1,23 +1,17 @@
-import random
 import enum
+import random
 
+from django.conf import settings
 from django.core import signing
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
-from picklefield.fields import PickledObjectField
 
-
-@enum.unique
-class CellDisplay(enum.IntEnum):
-    '''
-    Represents the different ways a cell can be displayed.
-    There are css classes with a 'cell-' prefix to mach each.
-    '''
-    hidden = 0
-    cleared = 1
-    flagged = 2
-    mine = 3
+from . import generation, metrics, sharding
+from .archive import archive
+from .board import Board, Cell, CellDisplay, FLAG, HIDDEN, MINE, MAX_SEEDED_CELLS  # NOQA
+from .fields import BoardField
 
 
 @enum.unique
@@ -26,39 +20,28 @@ class Difficulty(enum.IntEnum):
     easy = 1
     normal = 2
     hard = 3
+    custom = 4
 
 
-class Cell:
-    def __init__(self, x, y):
-        self.x, self.y = x, y
-        self.hidden = True
-        self.has_mine = False
-        self.has_flag = False
-        self.nearby_mine_counter = 0
-        self.safe_area_id = None
-
-    @property
-    def display(self):
-        if self.has_flag:
-            return CellDisplay.flagged
-        if self.hidden:
-            return CellDisplay.hidden
-        if self.has_mine:
-            return CellDisplay.mine
-        return CellDisplay.cleared
-
-    def __repr__(self):
-        if self.has_mine:
-            return 'B'
-        elif self.nearby_mine_counter == 0:
-            return 'Z{}'.format(self.safe_area_id)
-        else:
-            return 'N{}'.format(self.nearby_mine_counter)
+@enum.unique
+class MoveKind(enum.IntEnum):
+    sweep = 0
+    flag = 1
+    chord = 2
+
+
+class StaleGameError(Exception):
+    '''The game was changed by another request since it was loaded'''
+
+
+CUSTOM_MIN_SIZE = 2
+CUSTOM_MAX_SIZE = 1000
+CLAIM_WINDOW = 16  # pooled boards of a size claimers pick from (see PooledBoard.claim)
 
 
 class Game(models.Model):
     creation_datetime = models.DateTimeField(auto_now_add=True)
-    board = PickledObjectField()  # matrix of cells
+    board = BoardField(null=True)  # matrix of cells (see board.py)
     difficulty = models.IntegerField(
         choices=(
             (x.value, x.name.title().replace('_', ' '))
@@ -68,134 +51,425 @@ class Game(models.Model):
     game_over = models.BooleanField(default=False)
     win = models.BooleanField(default=False)
     end_timer = models.PositiveIntegerField(default=0)
+    # Only chosen by the player on custom games. Otherwise they come from the difficulty
+    width = models.PositiveIntegerField(
+        null=True, blank=True,
+        validators=[MinValueValidator(CUSTOM_MIN_SIZE), MaxValueValidator(CUSTOM_MAX_SIZE)]
+    )
+    height = models.PositiveIntegerField(
+        null=True, blank=True,
+        validators=[MinValueValidator(CUSTOM_MIN_SIZE), MaxValueValidator(CUSTOM_MAX_SIZE)]
+    )
+    mine_count = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
+    # Running counters updated by every move, so the winning state is checked in O(1)
+    hidden_safe_cells = models.PositiveIntegerField(default=0)
+    flagged_mines = models.PositiveIntegerField(default=0)
+    wrong_flags = models.PositiveIntegerField(default=0)
+    # Moves already applied to the saved board. Newer moves are only in the journal (see Move)
+    move_count = models.PositiveIntegerField(default=0)
+    # Bumped on every snapshot. Used to detect concurrent writes (see _save_snapshot)
+    version = models.PositiveIntegerField(default=0)
+    # The board is rebuilt from these (see generation.seeded_mines), so the layout of a
+    # game can be reproduced. They're None when the mines were placed by hand
+    seed = models.BigIntegerField(null=True, blank=True)
+    generator = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Every cell can be worked out from the area opened at the start (see no_guess.py)
+    no_guess = models.BooleanField(
+        default=False, help_text='Never needs a guess. The first area is opened for you'
+    )
+    # Record of the board in the archive once the game is archived (see archive.py). The
+    # board column is cleared then
+    archive_slot = models.PositiveIntegerField(null=True, blank=True)
+    # Time of the last move saved in a snapshot (or of the creation). The moves after it
+    # have their own timestamps in the journal. Used to find abandoned games (see the
+    # collect_abandoned_games command)
+    last_action = models.DateTimeField(default=timezone.now)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_moves = []  # moves not saved to the journal yet (see save_moves)
+        self._write_behind = False  # the moves are saved by the cache (see cache.py)
 
-    @property
-    def board_size(self):
-        return len(self.board)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        '''Archived games get their board from the archive, wherever they're loaded'''
+        game = super().from_db(db, field_names, values)
+        fields = game.__dict__  # deferred fields aren't there, and stay deferred
+        if 'board' in fields and fields['board'] is None and fields.get('archive_slot') is not None:
+            game._read_archived_board()
+        return game
 
-    @property
-    def mine_count(self):
-        return self._get_board_configuration(self.difficulty)[1]
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        # a deferred board is loaded on its own, without the archive_slot to find it with
+        if fields is not None and 'board' in fields and self.board is None and (
+                self.archive_slot is not None):
+            self._read_archived_board()
+
+    def _read_archived_board(self):
+        with metrics.phase('archive'):
+            self.board = Board.from_bytes(archive().read(self.pk, self.archive_slot))
 
     @classmethod
-    def create(cls, *, difficulty=Difficulty.normal):
-        '''
-        Initializes the board using random sampling without replacement for the mines.
-        This allows for random mines while keeping the number of mines (no collitions).
-        '''
-        board_size, mine_count = cls._get_board_configuration(difficulty)
-        game = cls(difficulty=difficulty.value)
-        game.board = [
-            [Cell(x, y) for x in range(board_size)]
-            for y in range(board_size)
-        ]
-        all_cells = sum(game.board, [])  # flatten matrix
-        cells_with_mines = random.sample(all_cells, mine_count)
-        for cell in cells_with_mines:
-            game._place_mine(cell)
+    def create(cls, *, difficulty=Difficulty.normal, width=None, height=None, mine_count=None,
+               no_guess=False):
+        '''
+        Takes a ready board from the pool (see PooledBoard), or generates one when the pool
+        of its size is empty. The width, height and mine_count are only used by custom games.
 
-        game._identify_safe_areas()
-        game.save()
+        no_guess games search for a board which needs no guessing (see no_guess.py) and
+        open its first area. When none is found in time it's a regular game instead. Boards
+        over no_guess.MAX_CELLS can't be no_guess.
+
+        The game is saved in the next shard (see sharding.py), and its board comes from the
+        pool of that shard. Raises sharding.ShardError if it got an id of another shard.
+        '''
+        if difficulty != Difficulty.custom:
+            board_size, mine_count = cls._get_board_configuration(difficulty)
+            width = height = board_size
+        if not 0 < mine_count < width * height:
+            raise ValueError('There must be between 1 and {} mines'.format(width * height - 1))
+
+        game = cls(difficulty=difficulty.value, width=width, height=height, mine_count=mine_count)
+        database = sharding.next_database()
+        start = None
+        if no_guess:
+            from .no_guess import find_board  # it imports this module
+            # raises ValueError over no_guess.MAX_CELLS
+            with metrics.phase('no_guess'):
+                found = find_board(width, height, mine_count)
+            if found is None:
+                metrics.count('game_no_guess_timeouts_total', difficulty=difficulty.name)
+            else:
+                seed, start = found
+                game.board = cls.generate_board(width, height, mine_count, seed)
+                game.no_guess = True
+        if start is None:
+            game.board = PooledBoard.claim(width, height, mine_count, using=database)
+        if game.board is None:
+            metrics.count('game_board_pool_misses_total', difficulty=difficulty.name)
+            game.board = cls.generate_board(width, height, mine_count)
+        game.seed, game.generator = game.board.seed, game.board.generator
+        game.hidden_safe_cells, game.flagged_mines, game.wrong_flags = game._count_cells()
+        if start is not None:
+            game.creation_datetime = timezone.now()  # only saving sets it, sweeping needs it
+            game._sweep(start % width, start // width)
+        with transaction.atomic(using=database):  # no game with the id of another shard
+            game.save(using=database)
+            sharding.check_id(game.pk, database)
+        metrics.count('game_games_created_total', difficulty=difficulty.name)
         return game
 
+    @classmethod
+    def generate_board(cls, width, height, mine_count, seed=None):
+        '''
+        Places the mines from a seed, a random one by default, with the current algorithm
+        (see generation.py). Small boards are saved as the seed and rebuilt when loaded
+        (see board.py), so their layout is kept in the cache loading uses.
+        '''
+        if seed is None:
+            seed = generation.new_seed()
+        arguments = (generation.GENERATOR, seed, width, height, mine_count)
+        if width * height <= MAX_SEEDED_CELLS:
+            layout = generation.seeded_layout(*arguments)
+        else:
+            layout = generation.build_layout(*arguments)
+        return Board.from_layout(layout)
+
     @classmethod
     def _non_random_create(cls, board_size, mine_placement, difficulty=Difficulty.normal):
         '''
         This method is useful for testing specific scenarios on the unit tests.
         '''
-        game = cls(difficulty=difficulty.value)
-        game.board = [
-            [Cell(x, y) for x in range(board_size)]
-            for y in range(board_size)
-        ]
+        game = cls(
+            difficulty=difficulty.value, width=board_size, height=board_size,
+            mine_count=len(mine_placement)
+        )
+        game.board = Board(board_size, board_size)
+        mine_indices = []
         for x, y in mine_placement:
             if x < 0 or y < 0:
                 raise IndexError('Negative indices not allowed in the board. x={}, y={}'.format(x, y))
-            cell = game.board[y][x]
-            game._place_mine(cell)
+            if x >= board_size or y >= board_size:
+                raise IndexError('Mine out of the board. x={}, y={}'.format(x, y))
+            mine_indices.append(y * board_size + x)
+        game._place_mines(mine_indices)
 
         game._identify_safe_areas()
+        game.hidden_safe_cells, game.flagged_mines, game.wrong_flags = game._count_cells()
         game.save()
         return game
 
-    def flag_cell(self, x, y):
+    @classmethod
+    def play(cls, pk, action, *args):
+        '''
+        Loads the game, replays its journal and calls action(game, *args), e.g.
+        Game.play(pk, Game.sweep_cell, x, y). Returns the game and the action's result.
+
+        Requests are not serialized (uwsgi runs several processes), so if another request
+        changed the game in the meantime, the action is applied again over a fresh copy of
+        the game, up to settings.GAME_CONFLICT_RETRIES times. StaleGameError is raised
+        after that. Nothing is locked while the game is loaded and played. The only
+        transaction is the one saving the moves (see save_moves), and the journal and the
+        versioning make it fail when the game changed meanwhile. So SQLite is only locked
+        for writing while the moves are written.
+
+        With settings.GAME_CACHE_ENABLED the game comes from the cache of the games being
+        played instead, and its moves are saved later (see cache.py).
+        '''
+        if settings.GAME_CACHE_ENABLED:
+            from .cache import hot_games  # it imports this module
+            return hot_games().play(pk, action, *args)
+
+        for _ in range(settings.GAME_CONFLICT_RETRIES + 1):
+            try:
+                with metrics.phase('fetch'):
+                    game = cls.objects.using(cls.database(pk)).get(pk=pk)
+                game.replay_journal()
+                with metrics.phase('logic'):
+                    return game, action(game, *args)
+            except StaleGameError:
+                continue
+        raise StaleGameError('Too many concurrent changes to game {}'.format(pk))
+
+    @classmethod
+    def database(cls, pk):
+        '''
+        Alias of the shard of a game (see sharding.py). Raises Game.DoesNotExist for the
+        ids of shards which aren't configured, e.g. after GAME_SHARD_COUNT went down.
+        '''
+        try:
+            return sharding.database(pk)
+        except ValueError as error:
+            raise cls.DoesNotExist(str(error))
+
+    @classmethod
+    def load(cls, pk):
+        '''Loads a game to display it, with the moves made since its last snapshot'''
+        if settings.GAME_CACHE_ENABLED:
+            from .cache import hot_games
+            return hot_games().load(pk)
+        with metrics.phase('fetch'):
+            game = cls.objects.using(cls.database(pk)).get(pk=pk)
+        game.replay_journal()
+        return game
+
+    def apply_moves(self, moves):
+        '''
+        Applies a list of (MoveKind, x, y) in order and saves them all at once.
+        Returns the game over state and every cell changed by any of the moves.
+        '''
+        actions = {
+            MoveKind.sweep: self.sweep_cell,
+            MoveKind.flag: self.flag_cell,
+            MoveKind.chord: self.chord_cell,
+        }
+        changed_cells = set()
+        for kind, x, y in moves:
+            _, _, cells = actions[kind](x, y, commit=False)
+            changed_cells.update(cells)  # cells are views, they show their latest state
+        self.save_moves()
+        return self.game_over, self.win, changed_cells
+
+    def flag_cell(self, x, y, commit=True):
         '''
         Flags a cell unless the game is over or the cell has already being cleared.
         Checks if the end of game has been reached (See _check_for_winning_state)
         Returns the game over state and the cells to update (one or zero in this case)
+        The move isn't saved until save_moves() is called when commit is False.
         '''
-        cell = self.board[y][x]
-        if self.game_over or cell.display == CellDisplay.cleared:
-            return self.game_over, self.win, []
-
-        cell.has_flag = not cell.has_flag
-        self._check_for_winning_state()
-        self.save()
-        return self.game_over, self.win, [cell]
-
-    def sweep_cell(self, x, y):
+        cells = self._flag(x, y)
+        if cells:
+            self._record_move(MoveKind.flag, x, y)
+        if commit:
+            self.save_moves()
+        return self.game_over, self.win, cells
+
+    def sweep_cell(self, x, y, commit=True):
         '''
         Sweeps a cell unless the game is over or the cell has a flag or it's already cleared.
         This operation results in one of four scenarios:
             * The cell has a mine:
-                Game over. Reveal all cells
+                Game over. Reveal all mines
             * The cell has nearby mine/s:
                 Reveal only that cell and show the number of nearby mines
             * The cell is in a "safe area":
                 Reveal that area including the edges showing the number of
-                nearby mines (this has been precalculated at the creation of the board)
+                nearby mines (this has been precalculated at the creation of the board,
+                including the list of cells of every area, so only those cells are touched)
             * The cell is the last cell to reveal and all mines have been flagged:
                 You win!
 
         Checks if the end of game has been reached (See _check_for_winning_state)
         Returns the game over state and the cells to update (zero or more cells)
+        The move isn't saved until save_moves() is called when commit is False.
+        '''
+        cells = self._sweep(x, y)
+        if cells:
+            self._record_move(MoveKind.sweep, x, y)
+        if commit:
+            self.save_moves()
+        return self.game_over, self.win, cells
+
+    def chord_cell(self, x, y, commit=True):
+        '''
+        Sweeps every hidden neighbour without a flag of a cleared number, but only when it
+        has as many flags around as its nearby_mine_counter. Safe areas are revealed like
+        in sweep_cell and a wrong flag means one of the sweeps hits a mine (game over).
+        This saves players the one request per neighbour they would need otherwise.
+
+        Checks if the end of game has been reached (See _check_for_winning_state)
+        Returns the game over state and the cells to update (zero or more cells)
+        The move isn't saved until save_moves() is called when commit is False.
+        '''
+        cells = self._chord(x, y)
+        if cells:
+            self._record_move(MoveKind.chord, x, y)
+        if commit:
+            self.save_moves()
+        return self.game_over, self.win, cells
+
+    def save_moves(self):
         '''
+        Appends the pending moves to the journal, which is a tiny insert. The whole row
+        (including the board) is only written as a snapshot every
+        settings.GAME_SNAPSHOT_INTERVAL moves and when the game ends. Loading a game takes
+        the snapshot and replays the moves after it (see replay_journal).
+        '''
+        if not self._pending_moves or (self._write_behind and not self.game_over):
+            return
+        moves = self._pending_moves  # kept if saving fails, see cache.GameCache._rebase
+        interval = settings.GAME_SNAPSHOT_INTERVAL
+        previous_move_count = moves[0].sequence - 1
+        try:
+            with metrics.phase('save'), transaction.atomic(using=self._state.db):
+                Move.objects.using(self._state.db).bulk_create(moves)
+                if self.game_over or self.move_count // interval > previous_move_count // interval:
+                    self._save_snapshot()
+        except IntegrityError:  # someone else already took these sequence numbers
+            raise StaleGameError('Moves after {} of game {} already exist'.format(
+                previous_move_count, self.pk
+            ))
+        self._pending_moves = []
+        if self.game_over:  # no moves come after this one
+            metrics.count(
+                'game_games_won_total' if self.win else 'game_games_lost_total',
+                difficulty=Difficulty(self.difficulty).name,
+            )
+
+    def replay_journal(self):
+        '''
+        Applies the moves done since the board was last saved. Call this after loading
+        a game that is going to be displayed or played (see save_moves).
+        '''
+        if self.game_over:  # the board is always saved when the game ends
+            return
+        actions = {
+            MoveKind.sweep: self._sweep,
+            MoveKind.flag: self._flag,
+            MoveKind.chord: self._chord,
+        }
+        with metrics.phase('replay'):
+            for move in self.moves.filter(sequence__gt=self.move_count).order_by('sequence'):
+                actions[move.kind](move.x, move.y, now=move.timestamp)
+                self.move_count = move.sequence
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._update_leaderboard()
+
+    def get_absolute_url(self):
+        return match_url(self.id)
+
+    def _flag(self, x, y, now=None):
+        cell = self.board[y][x]
+        if self.game_over or cell.display == CellDisplay.cleared:
+            return []
+
+        cell.has_flag = not cell.has_flag
+        change = 1 if cell.has_flag else -1
+        if cell.has_mine:
+            self.flagged_mines += change
+        else:
+            self.wrong_flags += change
+        self._check_for_winning_state(now)
+        return [cell]
+
+    def _sweep(self, x, y, now=None):
         cell = self.board[y][x]
         if self.game_over or cell.has_flag or not cell.hidden:
-            return self.game_over, self.win, []
+            return set()
 
         cell.hidden = False
         cells_revealed = {cell}
         is_game_over = cell.has_mine
         inside_safe_area = cell.safe_area_id is not None and cell.nearby_mine_counter == 0
 
-        if is_game_over or inside_safe_area:
-            safe_area_id = cell.safe_area_id
-            for x in range(self.board_size):
-                for y in range(self.board_size):
-                    cell = self.board[y][x]
-                    clicked_on_safe_area = inside_safe_area and cell.safe_area_id == safe_area_id
-                    if is_game_over or clicked_on_safe_area:
-                        cell.hidden = False
-                        cells_revealed.add(cell)
+        if is_game_over:
+            cells_revealed.update(self.board.reveal(self.board.mine_indices()))
+        elif inside_safe_area:
+            cells_revealed.update(self.board.reveal(self.board.area_indices(cell.safe_area_id)))
 
+        self.hidden_safe_cells -= sum(1 for cell in cells_revealed if not cell.has_mine)
         self.game_over = is_game_over
         if is_game_over:
-            self._set_end_timer()
-        self._check_for_winning_state()
-        self.save()
-        return self.game_over, self.win, cells_revealed
+            self._set_end_timer(now)
+        self._check_for_winning_state(now)
+        return cells_revealed
 
-    def get_absolute_url(self):
-        signer = signing.Signer()
-        signed_id = signer.sign(self.id)
-        return reverse('game:match', args=(signed_id,))
+    def _chord(self, x, y, now=None):
+        cell = self.board[y][x]
+        if self.game_over or cell.display != CellDisplay.cleared or not cell.nearby_mine_counter:
+            return set()
+
+        neighbours = self.board.neighbours(x, y)
+        if sum(1 for neighbour in neighbours if neighbour.has_flag) != cell.nearby_mine_counter:
+            return set()
+
+        cells_revealed = set()
+        for neighbour in neighbours:
+            cells_revealed.update(self._sweep(neighbour.x, neighbour.y, now))
+        return cells_revealed
+
+    def _record_move(self, kind, x, y):
+        self.move_count += 1
+        self._pending_moves.append(
+            Move(game=self, sequence=self.move_count, kind=kind.value, x=x, y=y)
+        )
 
-    def _place_mine(self, cell):
+    def _save_snapshot(self):
+        '''Saves the whole row unless somebody else saved it since it was loaded'''
+        self.last_action = timezone.now()
+        values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields if not field.primary_key
+        }
+        values['version'] = self.version + 1
+        updated = Game.objects.using(self._state.db).filter(
+            pk=self.pk, version=self.version
+        ).update(**values)
+        if not updated:
+            raise StaleGameError('Game {} is not at version {}'.format(self.pk, self.version))
+        self.version += 1
+        self._update_leaderboard()
+
+    def _update_leaderboard(self):
+        '''Adds the game to the leaderboard once _check_for_winning_state marks a win'''
+        if self.win and self.game_over and self.difficulty != Difficulty.custom:
+            LeaderboardEntry.objects.using(self._state.db).get_or_create(game=self, defaults={
+                'difficulty': self.difficulty,
+                'end_timer': self.end_timer,
+            })
+
+    def _place_mines(self, indices):
         '''
-        Places a mine at cell. All surrounding cells have their nearby_mine_counter attribute
-        increased.
+        Places the mines at the given flat indices (y * width + x). The nearby_mine_counter
+        of every cell is then computed at once as a 3x3 convolution (see generation.py).
         '''
-        if cell.has_mine:
-            raise ValueError('Duplicate mines are not allowed')
-
-        cell.has_mine = True
-        for i in range(max(0, cell.x - 1), min(cell.x + 2, self.board_size)):
-            for j in range(max(0, cell.y - 1), min(cell.y + 2, self.board_size)):
-                if self.board[j][i].has_mine:
-                    continue
-                self.board[j][i].nearby_mine_counter += 1
-        cell.nearby_mine_counter = 0
+        self.board.place_mines(indices)
+        self.board.set_counters(generation.neighbour_counts(
+            self.board.mines(), self.board.width, self.board.height
+        ))
 
     def _identify_safe_areas(self):
         '''
@@ -203,58 +477,50 @@ class Game(models.Model):
         Safe areas are defined as contiguous cells which have no mines or nearby mines.
         These are the big areas which are revealed on the game when sweeping one of those cells.
 
-        The point of this method is avoid the expensive DFS calculation to reveal the area while
-        the game is being played. Instead, the total cost is N^2 (it could be brought to
-        O(number of cells in the area) by using more memory and a more complicated structure).
+        The point of this method is avoid the expensive area search while the game is being
+        played. The labeling is a two-pass union-find over the whole board (see generation.py),
+        which doesn't recurse, so big open boards don't hit the recursion limit. It also builds
+        the list of cells of every area, so sweeping an area doesn't need to scan the board.
         '''
-        direction_vectors = [(1, 0), (-1, 0), (0, -1), (0, 1)]  # up down left right
-
-        # this is a DFS algorithm, not great. Improve this.
-        # See https://en.wikipedia.org/wiki/Connected-component_labeling
-        def mark_area(x, y, area_id):
-            if not (0 <= x < self.board_size and 0 <= y < self.board_size):
-                return
-            cell = self.board[y][x]
-
-            if cell.has_mine or cell.safe_area_id is not None:
-                return
-
-            cell.safe_area_id = area_id
-            if cell.nearby_mine_counter == 0:
-                for dx, dy in direction_vectors:
-                    mark_area(x + dx, y + dy, area_id)
-
-        area_id = 0
-        for y in range(self.board_size):
-            for x in range(self.board_size):
-                cell = self.board[y][x]
-                if not cell.has_mine and cell.safe_area_id is None and cell.nearby_mine_counter == 0:
-                    area_id += 1
-                    mark_area(x, y, area_id)
+        self.board.set_safe_areas(*generation.label_safe_areas(
+            self.board.mines(), self.board.counters(), self.board.width, self.board.height
+        ))
 
-    def _check_for_winning_state(self):
+    def _check_for_winning_state(self, now=None):
         '''
         Checks if the end of game has been reached (all mines have been flagged and
-        the rest of the cells have been cleared)
+        the rest of the cells have been cleared). This only looks at the running counters.
+        With settings.GAME_CHECK_COUNTERS they are checked against a full recount first.
         '''
+        if settings.GAME_CHECK_COUNTERS:
+            counters = (self.hidden_safe_cells, self.flagged_mines, self.wrong_flags)
+            if counters != self._count_cells():
+                raise AssertionError('Game counters {} out of sync with the board {}'.format(
+                    counters, self._count_cells()
+                ))
+
         if self.game_over:
             return
 
-        for y in range(self.board_size):
-            for x in range(self.board_size):
-                cell = self.board[y][x]
-                if cell.has_mine and not cell.has_flag:
-                    return
-                if not cell.has_mine and cell.hidden:
-                    return
-        self.game_over = self.win = True
-        self._set_end_timer()
+        if self.hidden_safe_cells == 0 and self.flagged_mines == self.mine_count:
+            self.game_over = self.win = True
+            self._set_end_timer(now)
+
+    def _count_cells(self):
+        '''Recounts the hidden safe cells, flagged mines and wrong flags on the board'''
+        return (
+            self.board.count(MINE | HIDDEN, HIDDEN),
+            self.board.count(MINE | FLAG, MINE | FLAG),
+            self.board.count(MINE | FLAG, FLAG),
+        )
 
-    def _set_end_timer(self):
-        self.end_timer = int((timezone.now() - self.creation_datetime).total_seconds())
+    def _set_end_timer(self, now=None):
+        now = now or timezone.now()
+        self.end_timer = int((now - self.creation_datetime).total_seconds())
 
     @classmethod
     def _get_board_configuration(cls, difficulty):
+        '''Board size and mine count of every difficulty but custom'''
         configuration = {
             Difficulty.super_easy: (3, 2),
             Difficulty.easy: (9, 10),
@@ -270,3 +536,103 @@ class Game(models.Model):
             '|' + ''.join('{:2}'.format(cell.nearby_mine_counter) for cell in row) + '|'
             for row in self.board
         )
+
+
+def match_url(game_id):
+    signer = signing.Signer()
+    signed_id = signer.sign(game_id)
+    return reverse('game:match', args=(signed_id,))
+
+
+class PooledBoard(models.Model):
+    '''
+    Boards generated ahead of time, so creating a game doesn't have to wait for the
+    generation (which takes seconds on big custom boards). The fill_board_pool command
+    keeps settings.GAME_BOARD_POOL_DEPTH boards of every difficulty and of every size in
+    settings.GAME_BOARD_POOL_CUSTOM, in every shard: creating a game only writes to the
+    shard the game goes to.
+    '''
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    mine_count = models.PositiveIntegerField()
+    board = BoardField()
+
+    class Meta:
+        index_together = [('width', 'height', 'mine_count')]
+
+    @classmethod
+    def claim(cls, width, height, mine_count, using=None, attempts=3):
+        '''
+        Takes a board out of the pool of a shard (the default database unless using says
+        otherwise), or returns None if there's none of that size.
+        The board belongs to whoever deletes its row, so two requests never get the same one.
+        Each request picks at random among the oldest CLAIM_WINDOW boards, so concurrent
+        ones seldom go for the same row.
+        '''
+        boards = cls.objects.using(using)
+        pool = boards.filter(width=width, height=height, mine_count=mine_count)
+        with metrics.phase('claim'):
+            pks = list(pool.order_by('pk').values_list('pk', flat=True)[:CLAIM_WINDOW])
+        for pk in random.sample(pks, min(attempts, len(pks))):
+            with metrics.phase('claim'):
+                pooled = pool.filter(pk=pk).first()
+                deleted = pooled is not None and boards.filter(pk=pk).delete()[0]
+            if deleted:
+                return pooled.board
+        return None  # busy, generating one is quicker than waiting
+
+    def __str__(self):
+        return '{}x{} with {} mines'.format(self.width, self.height, self.mine_count)
+
+
+class LeaderboardEntry(models.Model):
+    '''
+    One row per won game (but custom ones). It's a copy of the few fields the ranking needs,
+    so the ranking never reads the big rows of Game, and the rank of a time is a count
+    over the (difficulty, end_timer) index.
+    '''
+    game = models.OneToOneField(Game, related_name='leaderboard_entry', on_delete=models.CASCADE)
+    difficulty = models.IntegerField()
+    end_timer = models.PositiveIntegerField()
+
+    class Meta:
+        index_together = [('difficulty', 'end_timer', 'game')]
+
+    def rank(self):
+        '''
+        Position in the ranking of its difficulty, among the games of every shard. Games
+        with the same time share it.
+        '''
+        return sum(
+            LeaderboardEntry.objects.using(database).filter(
+                difficulty=self.difficulty, end_timer__lt=self.end_timer
+            ).count()
+            for database in settings.GAME_SHARDS
+        ) + 1
+
+    def get_absolute_url(self):
+        return match_url(self.game_id)
+
+    def __str__(self):
+        return '{}: {} seconds'.format(Difficulty(self.difficulty).name, self.end_timer)
+
+
+class Move(models.Model):
+    '''
+    Append-only journal of the moves of every game. Besides rebuilding the board between
+    snapshots (see Game.save_moves), it keeps the exact history of every game.
+    '''
+    game = models.ForeignKey(Game, related_name='moves', on_delete=models.CASCADE)
+    sequence = models.PositiveIntegerField()
+    kind = models.IntegerField(choices=((x.value, x.name.title()) for x in MoveKind))
+    x = models.PositiveIntegerField()
+    y = models.PositiveIntegerField()
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [('game', 'sequence')]
+
+    def __str__(self):
+        return '{} #{}: {} ({}, {})'.format(
+            self.game_id, self.sequence, MoveKind(self.kind).name, self.x, self.y
+        )
@@ -0,0 +1,141 @@
+'''
+Boards which can be cleared without guessing.
+
+A candidate is a random seed (see generation.seeded_layout). Its game starts by opening
+its biggest safe area, then the solver (see solver.py) sweeps every cell it proves safe
+until it's stuck. The candidate is kept when no safe cell is left hidden. Most hard
+candidates are rejected, so they are tried in batches in a pool of processes, until one
+is found or settings.GAME_NO_GUESS_TIME_BUDGET runs out. Boards over MAX_CELLS aren't
+searched, the solver is too slow for them.
+'''
+import os
+import time
+from concurrent import futures
+
+from django.conf import settings
+
+from . import generation, solver
+from .board import COUNTER_SHIFT, HIDDEN, MINE, Board
+
+
+CANDIDATES_PER_TASK = 8
+MAX_CELLS = solver.MAX_HINT_CELLS  # and the hints would be off anyway
+
+_executor = None
+
+
+def start_cell(layout):
+    '''Index of the first cell of the biggest safe area, or None if there are none'''
+    offsets = layout.area_offsets
+    if len(offsets) < 2:
+        return None
+    biggest = max(range(1, len(offsets)), key=lambda area: offsets[area] - offsets[area - 1])
+    return layout.area_indices(biggest)[0]
+
+
+def sweep(board, index):
+    area_id = board.safe_areas[index]
+    if area_id and not board.cells[index] >> COUNTER_SHIFT:  # no mines nearby
+        board.reveal(board.area_indices(area_id))
+    else:
+        board.reveal([index])
+
+
+def clears_without_guessing(layout, start):
+    '''
+    Whether the solver clears every safe cell of the layout after sweeping start. The
+    solver gives up on big groups of cells (see solver.py), so what it finds depends on
+    the order of the sweeps. Candidates which pass sweeping everything it finds at once
+    are played again the way the hints do, a single safe cell at a time, so the hints
+    alone always clear the game. That's slower, but few candidates get that far.
+    '''
+    return _clears(layout, start, all_at_once=True) and _clears(layout, start, all_at_once=False)
+
+
+def _clears(layout, start, all_at_once):
+    board = Board.from_layout(layout)
+    sweep(board, start)
+    while True:
+        numbers, hidden = solver.visible_state(board)
+        safe, _ = solver.deduce(board.width, board.height, numbers, hidden)
+        if not safe:
+            break
+        if all_at_once:
+            for index in solver.indices(safe):
+                sweep(board, index)
+        else:  # the lowest one, like solver.hint
+            sweep(board, (safe & -safe).bit_length() - 1)
+    return board.count(MINE | HIDDEN, HIDDEN) == 0
+
+
+def search(width, height, mine_count, seeds, deadline):
+    '''
+    Runs in the pool of processes. The first (seed, start) which needs no guessing, or
+    None once deadline (a time.time()) is past, even with seeds left
+    '''
+    for seed in seeds:
+        if time.time() > deadline:
+            return None
+        layout = generation.build_layout(generation.GENERATOR, seed, width, height, mine_count)
+        start = start_cell(layout)
+        if start is not None and clears_without_guessing(layout, start):
+            return seed, start
+    return None
+
+
+def find_board(width, height, mine_count):
+    '''
+    (seed, start) of a board which needs no guessing once start is swept, or None if
+    none was found within settings.GAME_NO_GUESS_TIME_BUDGET seconds.
+    '''
+    if width * height > MAX_CELLS:
+        raise ValueError('No-guess boards have at most {} cells'.format(MAX_CELLS))
+    # wall clock time, the processes of the pool check it too
+    deadline = time.time() + settings.GAME_NO_GUESS_TIME_BUDGET
+
+    def candidates():
+        return [generation.new_seed() for _ in range(CANDIDATES_PER_TASK)]
+
+    if settings.GAME_NO_GUESS_PROCESSES == 0:  # in this process, e.g. in the tests
+        while time.time() < deadline:
+            found = search(width, height, mine_count, candidates(), deadline)
+            if found is not None:
+                return found
+        return None
+
+    pool = executor()
+    pending = {
+        pool.submit(search, width, height, mine_count, candidates(), deadline)
+        for _ in range(processes() * 2)  # keep every process busy
+    }
+    try:
+        while pending:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None
+            done, pending = futures.wait(
+                pending, timeout, return_when=futures.FIRST_COMPLETED
+            )
+            for future in done:
+                found = future.result()
+                if found is not None:
+                    return found
+                pending.add(
+                    pool.submit(search, width, height, mine_count, candidates(), deadline)
+                )
+        return None
+    finally:
+        for future in pending:
+            future.cancel()  # the running ones stop after their batch or the deadline
+
+
+def processes():
+    return settings.GAME_NO_GUESS_PROCESSES or os.cpu_count()
+
+
+def executor():
+    '''The pool of processes of this process, started on first use'''
+    global _executor
+    if _executor is None:
+        _executor = futures.ProcessPoolExecutor(processes())
+    return _executor
@@ -0,0 +1,40 @@
+'''
+Fast HTML rendering of the board.
+
+Rendering cell.html once per cell means a template include for every cell, which is
+most of the time spent rendering a big board. However, there are only a few dozen
+different cells (the state bits plus the nearby mine counter, see board.py). So
+cell.html is rendered once for each of those, with placeholders instead of the
+coordinates, and the board is built from those fragments.
+'''
+import functools
+
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .board import Board
+
+# Rendered in place of the coordinates and turned into format fields afterwards
+_X, _Y = 'XCOORDX', 'YCOORDY'
+
+# game.html has this where the board rows go (see GameView.render_to_response)
+BOARD_MARKER = mark_safe('<!-- board rows -->')
+
+
+@functools.lru_cache(maxsize=None)
+def cell_fragment(state):
+    '''Format string of the cell.html of every cell with this state byte'''
+    cell = Board(1, 1, bytearray([state]))[0][0]
+    cell.x, cell.y = _X, _Y
+    html = render_to_string('cell.html', {'cell': cell})
+    return html.replace('{', '{{').replace('}', '}}').replace(_X, '{x}').replace(_Y, '{y}')
+
+
+def board_rows(board):
+    '''Yields the html of every row of the board'''
+    width, cells = board.width, board.cells
+    for y in range(board.height):
+        row = cells[y * width:(y + 1) * width]
+        yield '<tr>{}</tr>\n'.format(''.join(
+            cell_fragment(state).format(x=x, y=y) for x, state in enumerate(row)
+        ))
@@ -0,0 +1,139 @@
+'''
+Games spread over several SQLite files (settings.GAME_SHARDS, database aliases), so the
+writes of different games don't wait for each other's lock.
+
+Every shard numbers its games from its own range of ids, shard n from n << SHARD_SHIFT
+(see the 0024_shard_ids migration), so the id of a game, which is what its url signs,
+tells its shard without any lookup. The games of the first shard (the default database)
+keep the ids they always had. A game's moves and leaderboard entry live in its shard,
+and so does a pool of boards for the games created there (see PooledBoard.claim). The
+rest of the tables are in the default database.
+
+SQLite keeps where the ids go on in sqlite_sequence, and forgets it for an empty table
+when a migration rebuilds it. So Game.create checks the id of every new game (see
+check_id), and migrate_shards sets where they start again (see start_ids). Shards are
+only supported on SQLite (see check_backends).
+
+New games go to every shard in turn. Queries by id go to database(pk), and instances
+remember theirs (instance._state.db), which ShardRouter hands to Django for their saves
+and relations. The leaderboard is read from every shard and merged (see merged). The
+admin shows one shard at a time (see admin.py).
+'''
+import heapq
+import itertools
+import random
+
+from django.conf import settings
+from django.core import checks
+from django.db import connections
+
+
+SHARD_SHIFT = 40  # ids per shard, far more games than SQLite would ever hold
+SHARDED_MODELS = {'game', 'move', 'leaderboardentry', 'pooledboard'}
+
+# every process starts at a different shard
+_next_shard = itertools.count(random.randrange(1 << 16))
+
+
+def database(pk):
+    '''Alias of the database of a game'''
+    shard = int(pk) >> SHARD_SHIFT
+    if shard >= len(settings.GAME_SHARDS):
+        raise ValueError('Game {} is in shard {}, which is not configured'.format(pk, shard))
+    return settings.GAME_SHARDS[shard]
+
+
+def first_id(alias):
+    '''The ids of the games of a shard start after this one'''
+    return settings.GAME_SHARDS.index(alias) << SHARD_SHIFT
+
+
+class ShardError(Exception):
+    '''A game got an id out of the range of its shard'''
+
+
+def check_id(pk, alias):
+    '''Raises ShardError unless the id is one of the shard's'''
+    if database(pk) != alias:
+        raise ShardError(
+            'Game {} was saved in {} but its id is of {}. Run manage.py migrate_shards '
+            'to set the ids of the shards again'.format(pk, alias, database(pk))
+        )
+
+
+def start_ids(alias):
+    '''Makes the next ids of a shard start at its first one, if they're lower'''
+    start = first_id(alias)
+    if not start:
+        return
+    with connections[alias].cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'game_game'")
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('game_game', %s)", [start]
+            )
+        elif row[0] < start:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = 'game_game'", [start])
+
+
+@checks.register()
+def check_backends(app_configs, **kwargs):
+    '''The ranges of ids of the shards are set in sqlite_sequence'''
+    if len(settings.GAME_SHARDS) < 2:
+        return []
+    return [
+        checks.Error(
+            'Database {} of GAME_SHARDS is not SQLite'.format(alias),
+            hint='Shards are only supported on SQLite, set GAME_SHARD_COUNT to 1',
+            id='game.E001',
+        )
+        for alias in settings.GAME_SHARDS
+        if settings.DATABASES[alias]['ENGINE'] != 'django.db.backends.sqlite3'
+    ]
+
+
+def next_database():
+    '''Alias of the database of the next new game'''
+    shards = settings.GAME_SHARDS
+    return shards[next(_next_shard) % len(shards)]
+
+
+def merged(querysets, key, limit):
+    '''The first limit objects of some querysets sorted by key, e.g. one per shard'''
+    return list(itertools.islice(
+        heapq.merge(*(queryset[:limit] for queryset in querysets), key=key), limit
+    ))
+
+
+class ShardRouter:
+    '''
+    Keeps the sharded tables (and only those) in the shards other than the default
+    database, and the data migrations out of them, since new shards have no data. The
+    migrations meant for the shards have the 'shards' hint.
+
+    Reads and writes of an instance (e.g. saving it, or following its relations) go to
+    the shard of its game. Querysets without an instance go to the default database
+    unless they say otherwise with using().
+    '''
+
+    def db_for_read(self, model, instance=None, **hints):
+        if model._meta.model_name not in SHARDED_MODELS or instance is None:
+            return None
+        if instance._state.db is not None:
+            return instance._state.db
+        game_id = instance.pk if instance._meta.model_name == 'game' else getattr(
+            instance, 'game_id', None
+        )
+        return None if game_id is None else database(game_id)
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.GAME_SHARDS[0] or db not in settings.GAME_SHARDS:
+            return None
+        if app_label != 'game':
+            return False
+        if model_name is None:
+            return hints.get('shards', False)
+        return model_name in SHARDED_MODELS
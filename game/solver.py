@@ -0,0 +1,237 @@
+'''
+Finds the cells which are provably safe or provably mines from what the player can see:
+the numbers of the cleared cells. Flags are not trusted, they could be wrong.
+
+Sets of cells are python ints used as bitsets (bit y * width + x is a cell), so the
+rules below are a few integer operations per number:
+
+    * A number whose hidden neighbours are all mines, or which has all its mines
+      accounted for, settles its hidden neighbours.
+    * When the hidden neighbours of a number A are a subset of those of a number B,
+      the difference has B - A mines.
+
+When the rules find nothing, every group of hidden cells next to the numbers (the cells
+of different groups don't share any number) is solved by enumerating its mine
+placements. Cells which are safe (or mines) in every placement are settled. Groups
+bigger than MAX_ENUMERATION_CELLS are skipped, and all the groups together get
+MAX_ENUMERATION_NODES steps, so a hint never takes long. The total number of mines
+isn't used.
+'''
+import functools
+
+from .board import COUNTER_SHIFT, FLAG, HIDDEN, MINE
+from .models import MoveKind
+
+
+MAX_ENUMERATION_CELLS = 24
+MAX_ENUMERATION_NODES = 10000
+MAX_HINT_CELLS = 100 * 100  # the bitsets span the whole board, so huge ones are slow
+
+# bytes.translate tables giving '1' or '0' per cell, which int(..., 2) turns into a bitset
+_HIDDEN_DIGITS = bytes(ord('1') if value & HIDDEN else ord('0') for value in range(256))
+_FLAG_DIGITS = bytes(ord('1') if value & FLAG else ord('0') for value in range(256))
+_NUMBER_DIGITS = bytes(
+    ord('1') if not value & (HIDDEN | MINE) and value >> COUNTER_SHIFT else ord('0')
+    for value in range(256)
+)
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def indices(bits):
+    '''The cells of a bitset, lowest first'''
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def bitset(cells, digits):
+    '''A bitset of the cells whose state byte maps to '1' in the digits table'''
+    return int(bytes(cells).translate(digits)[::-1] or b'0', 2)
+
+
+@functools.lru_cache(maxsize=8)
+def neighbourhoods(width, height):
+    '''Bitset of the (up to 8) cells around every cell, by index'''
+    masks = []
+    for y in range(height):
+        for x in range(width):
+            row = 7 << x >> 1 if x else 3
+            if x == width - 1:
+                row &= ~(1 << (x + 1))
+            bits = 0
+            for row_y in range(max(y - 1, 0), min(y + 2, height)):
+                bits |= row << (row_y * width)
+            masks.append(bits & ~(1 << (y * width + x)))
+    return masks
+
+
+def visible_state(board):
+    '''
+    (numbers, hidden) of a board: the nearby mine counter of every cleared cell with a
+    hidden neighbour, by index, and the bitset of the hidden cells.
+    '''
+    hidden = bitset(board.cells, _HIDDEN_DIGITS)
+    masks = neighbourhoods(board.width, board.height)
+    numbers = {}
+    for index in indices(bitset(board.cells, _NUMBER_DIGITS)):
+        if masks[index] & hidden:
+            numbers[index] = board.cells[index] >> COUNTER_SHIFT
+    return numbers, hidden
+
+
+def deduce(width, height, numbers, hidden, enumerate_groups=True):
+    '''
+    Returns the bitsets (safe, mines) of the hidden cells proven to be safe or mines,
+    given the numbers (counter by index of cleared cells) and the hidden cells.
+    '''
+    masks = neighbourhoods(width, height)
+    constraints = {index: (masks[index] & hidden, counter) for index, counter in numbers.items()}
+    safe = mines = 0
+    budget = [MAX_ENUMERATION_NODES]  # steps left to _enumerate
+    while True:
+        known = safe | mines
+        reduced = {}
+        for index, (cells, counter) in constraints.items():
+            unknown = cells & ~(safe | mines)
+            if not unknown:
+                continue
+            missing = counter - popcount(cells & mines)
+            if missing == 0:
+                safe |= unknown
+            elif missing == popcount(unknown):
+                mines |= unknown
+            else:
+                reduced[index] = (unknown, missing)
+        if safe | mines != known:
+            continue
+        found_safe, found_mines = _subset_rule(reduced, width)
+        if not found_safe and not found_mines and enumerate_groups:
+            for group in _groups(reduced):
+                found_safe, found_mines = _enumerate(group, budget)
+                if found_safe or found_mines:
+                    break  # the rules may do the rest
+            else:
+                enumerate_groups = False
+        if not found_safe and not found_mines:
+            return safe, mines
+        safe |= found_safe
+        mines |= found_mines
+
+
+def _subset_rule(constraints, width):
+    safe = mines = 0
+    for index, (cells, counter) in constraints.items():
+        # numbers further than 2 cells away don't share any hidden cell
+        for dy in (-2, -1, 0, 1, 2):
+            for dx in (-2, -1, 0, 1, 2):
+                other = constraints.get(index + dy * width + dx)
+                if other is None or other[0] == cells or other[0] & ~cells:
+                    continue
+                difference = cells & ~other[0]  # other is a subset of this one
+                missing = counter - other[1]
+                if missing == 0:
+                    safe |= difference
+                elif missing == popcount(difference):
+                    mines |= difference
+    return safe, mines
+
+
+def _groups(constraints):
+    '''
+    Splits the constraints into groups which don't share any cell, smallest first. The
+    constraints of a group are in the order they are reached from the first one, so
+    neighbouring constraints are close (see _enumerate).
+    '''
+    remaining = list(constraints.values())
+    groups = []
+    while remaining:
+        group = [remaining.pop()]
+        cells = group[0][0]
+        for constraint in group:  # it grows while it's iterated
+            linked = [other for other in remaining if other[0] & constraint[0]]
+            for other in linked:
+                remaining.remove(other)
+                cells |= other[0]
+            group.extend(linked)
+        groups.append((popcount(cells), group))
+    groups.sort(key=lambda group: group[0])
+    return [group for _, group in groups]
+
+
+def _enumerate(constraints, budget):
+    '''
+    (safe, mines) of a group of constraints, by trying every placement of its mines.
+    Nothing is settled when the group is too big or the steps in budget run out.
+    '''
+    # in the order of the constraints, so they're complete (and checked) early
+    group, cells = 0, []
+    for bits, _ in constraints:
+        cells.extend(indices(bits & ~group))
+        group |= bits
+    if len(cells) > MAX_ENUMERATION_CELLS:
+        return 0, 0
+
+    constraints_of_cell = [
+        [i for i, (bits, _) in enumerate(constraints) if bits >> cell & 1] for cell in cells
+    ]
+    unassigned = [popcount(bits) for bits, _ in constraints]
+    missing = [counter for _, counter in constraints]
+    placement = []
+    seen = {'mine': 0, 'safe': 0}
+
+    def search(position):
+        budget[0] -= 1
+        if budget[0] < 0:
+            return False
+        if position == len(cells):
+            for cell, is_mine in zip(cells, placement):
+                seen['mine' if is_mine else 'safe'] |= 1 << cell
+            return True
+        for is_mine in (0, 1):
+            feasible = True
+            for i in constraints_of_cell[position]:
+                unassigned[i] -= 1
+                missing[i] -= is_mine
+                if missing[i] < 0 or missing[i] > unassigned[i]:
+                    feasible = False
+            if feasible:
+                placement.append(is_mine)
+                finished = search(position + 1)
+                placement.pop()
+            for i in constraints_of_cell[position]:
+                unassigned[i] += 1
+                missing[i] += is_mine
+            if feasible and not finished:
+                return False
+        return True
+
+    if not search(0) or not seen['mine'] | seen['safe']:
+        return 0, 0  # too many steps, or no placement at all (the numbers are wrong)
+    return group & ~seen['mine'], group & ~seen['safe']
+
+
+def hint(game):
+    '''
+    One move which is sure to be right, as (MoveKind, x, y), or None. Safe cells are
+    swept first, then mines are flagged, then wrong flags are taken back (flagging a
+    flagged cell removes the flag). Boards over MAX_HINT_CELLS don't get hints.
+    '''
+    if game.game_over or len(game.board.cells) > MAX_HINT_CELLS:
+        return None
+    board = game.board
+    numbers, hidden = visible_state(board)
+    safe, mines = deduce(board.width, board.height, numbers, hidden)
+    flags = bitset(board.cells, _FLAG_DIGITS)
+    for kind, bits in (
+        (MoveKind.sweep, safe & ~flags),
+        (MoveKind.flag, mines & ~flags),
+        (MoveKind.flag, safe & flags),
+    ):
+        if bits:
+            index = (bits & -bits).bit_length() - 1
+            return kind, index % board.width, index // board.width
+    return None
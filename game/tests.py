@@ -1,10 +1,46 @@
+import asyncio
+import base64
+import importlib
+import io
+import json
+import os
+import pickle
 import random
+import re
+import struct
+import tempfile
+import time
+import unittest
+from concurrent import futures
+from datetime import timedelta
+from unittest import mock
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import OperationalError, connection, connections
+from django.test import TestCase, override_settings
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 
-from .models import Game
+from minesweeper import websocket
+from . import archive, cache, generation, metrics, no_guess, rendering, sharding, solver
+from .ajax_views import DIFF_MEDIA_TYPE
+from .board import LAYOUT_FORMAT, MINE, SEEDED_FORMAT, Board, CellDisplay, area_array
+from .models import (
+    Game, Difficulty, LeaderboardEntry, Move, MoveKind, PooledBoard, StaleGameError
+)
 from .forms import CreateGameForm
+from .views import signer
+
+
+class ShardedTestCase(TestCase):
+    '''Cleans every shard, for the tests of Game.create, which saves to every shard in turn'''
+    multi_db = True
 
 
 class BoardTests(TestCase):
@@ -93,6 +129,283 @@ class BoardTests(TestCase):
         ]
 
 
+class GenerationTests(TestCase):
+    def test_same_as_recursive_dfs(self):
+        for seed in range(300):
+            rng = random.Random(seed)
+            width, height = rng.randint(1, 15), rng.randint(1, 15)
+            mine_count = rng.randint(0, width * height // 3)
+            mines = bytearray(width * height)
+            for i in rng.sample(range(width * height), mine_count):
+                mines[i] = 1
+
+            counts = generation._neighbour_counts_python(mines, width, height)
+            self.assertEqual(list(counts), self.reference_counts(mines, width, height))
+            safe_areas, area_offsets, area_members = generation.label_safe_areas(
+                mines, counts, width, height
+            )
+            self.assertEqual(list(safe_areas), self.reference_safe_areas(mines, counts, width, height))
+
+            board = Board(width, height)
+            board.set_safe_areas(safe_areas, area_offsets, area_members)
+            for area_id in range(1, max(safe_areas, default=0) + 1):
+                self.assertEqual(
+                    sorted(board.area_indices(area_id)),
+                    [i for i, other_id in enumerate(safe_areas) if other_id == area_id]
+                )
+
+    @unittest.skipIf(generation.numpy is None, 'NumPy is not installed')
+    def test_numpy_counts(self):
+        rng = random.Random(0)
+        mines = bytes(rng.random() < 0.2 for _ in range(30 * 17))
+        self.assertEqual(
+            generation._neighbour_counts_numpy(mines, 30, 17),
+            generation._neighbour_counts_python(mines, 30, 17)
+        )
+
+    def test_big_open_board(self):
+        # the old recursive DFS hit the recursion limit on this one
+        game = Game._non_random_create(200, [(0, 0)])
+        self.assertEqual(game.board[199][199].safe_area_id, 1)
+        self.assertEqual(game.board[1][1].safe_area_id, 1)
+
+    def reference_counts(self, mines, width, height):
+        counts = []
+        for y in range(height):
+            for x in range(width):
+                counts.append(0 if mines[y * width + x] else sum(
+                    mines[j * width + i]
+                    for i in range(max(0, x - 1), min(x + 2, width))
+                    for j in range(max(0, y - 1), min(y + 2, height))
+                ))
+        return counts
+
+    def reference_safe_areas(self, mines, counts, width, height):
+        '''The recursive DFS _identify_safe_areas used to have'''
+        areas = [None] * (width * height)
+
+        def mark_area(x, y, area_id):
+            if not (0 <= x < width and 0 <= y < height):
+                return
+            i = y * width + x
+            if mines[i] or areas[i] is not None:
+                return
+            areas[i] = area_id
+            if counts[i] == 0:
+                for dx, dy in [(1, 0), (-1, 0), (0, -1), (0, 1)]:
+                    mark_area(x + dx, y + dy, area_id)
+
+        area_id = 0
+        for y in range(height):
+            for x in range(width):
+                i = y * width + x
+                if not mines[i] and areas[i] is None and counts[i] == 0:
+                    area_id += 1
+                    mark_area(x, y, area_id)
+        return [area or 0 for area in areas]
+
+
+class BoardStorageTests(ShardedTestCase):
+
+    def test_round_trip(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.sweep_cell(0, 0)
+        game.flag_cell(4, 2)
+
+        board = Board.from_bytes(game.board.to_bytes())
+        self.assertEqual(
+            [[(c.hidden, c.has_mine, c.has_flag, c.nearby_mine_counter, c.safe_area_id) for c in row]
+             for row in board],
+            [[(c.hidden, c.has_mine, c.has_flag, c.nearby_mine_counter, c.safe_area_id) for c in row]
+             for row in game.board]
+        )
+
+    def test_persisted_board(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        game.flag_cell(0, 0)
+        game.save()
+        game = Game.objects.get(pk=game.pk)
+        self.assertTrue(game.board[0][0].has_flag)
+        self.assertTrue(game.board[0][0].has_mine)
+        self.assertEqual(game.board[1][1].nearby_mine_counter, 1)
+        self.assertEqual(game.board[2][2].safe_area_id, 1)
+
+    def test_compact_size(self):
+        game = Game.create(difficulty=Difficulty.hard)
+        # one byte per cell for the state, one for the safe area id (fewer than 256 areas)
+        # and at most two more for the index of the safe areas. The pickled board was ~26KB
+        self.assertLess(len(game.board.to_bytes()), 22 * 22 * 4)
+
+    def test_legacy_board_migration(self):
+        migration = importlib.import_module('game.migrations.0011_packed_board')
+
+        class LegacyCell:  # what game.models used to pickle
+            def __init__(self, **attributes):
+                self.__dict__.update(attributes)
+
+        LegacyCell.__module__, LegacyCell.__qualname__ = 'game.models', 'Cell'
+        matrix = [
+            [LegacyCell(hidden=True, has_mine=True, has_flag=True, nearby_mine_counter=0,
+                        safe_area_id=None),
+             LegacyCell(hidden=False, has_mine=False, has_flag=False, nearby_mine_counter=1,
+                        safe_area_id=300)],
+        ]
+        with mock.patch('game.models.Cell', LegacyCell):
+            value = base64.b64encode(pickle.dumps(matrix))
+
+        board = Board.from_bytes(migration._convert_legacy_board(value))
+        self.assertEqual(
+            [(c.hidden, c.has_mine, c.has_flag, c.nearby_mine_counter, c.safe_area_id)
+             for c in board[0]],
+            [(True, True, True, 0, None), (False, False, False, 1, 300)]
+        )
+        with self.assertRaises(Exception):
+            migration._convert_legacy_board(base64.b64encode(b'not a pickle'))
+
+    def test_wide_safe_area_ids(self):
+        board = Board(300, 1)
+        board.set_safe_areas(area_array(range(1, 301)))
+        board = Board.from_bytes(board.to_bytes())
+        self.assertEqual(board[0][299].safe_area_id, 300)
+        self.assertEqual(list(board.area_indices(300)), [299])
+
+    def cell_states(self, board):
+        return [
+            (c.hidden, c.has_mine, c.has_flag, c.nearby_mine_counter, c.safe_area_id)
+            for row in board for c in row
+        ]
+
+    def test_seeded_round_trip(self):
+        with mock.patch.object(generation, 'new_seed', return_value=1234):
+            game = Game.create(difficulty=Difficulty.hard)
+        mine = next(game.board.mine_indices())
+        game.flag_cell(mine % 22, mine // 22)
+        for index in range(0, 22 * 22, 7):
+            game.sweep_cell(index % 22, index // 22)
+        data = game.board.to_bytes()
+        self.assertEqual(data[0], SEEDED_FORMAT)
+        # the player's bits, compressed. The layout alone takes over two bytes per cell
+        self.assertLess(len(data), 22 * 22 // 2)
+
+        generation.seeded_layout.cache_clear()
+        saved = Game.load(game.pk)
+        self.assertEqual((saved.seed, saved.generator), (game.board.seed, generation.GENERATOR))
+        self.assertEqual(self.cell_states(saved.board), self.cell_states(game.board))
+
+    def test_reproducible_boards(self):
+        board = Game.generate_board(16, 16, 40, seed=1234)
+        generation.seeded_layout.cache_clear()
+        again = Game.generate_board(16, 16, 40, seed=1234)
+        self.assertIsNot(again.cells, board.cells)
+        self.assertEqual(self.cell_states(again), self.cell_states(board))
+        self.assertNotEqual(
+            list(Game.generate_board(16, 16, 40, seed=4321).mine_indices()),
+            list(board.mine_indices())
+        )
+
+    def test_big_seeded_board(self):
+        # bigger boards take longer to rebuild than to read, so their layout is stored
+        board = Game.generate_board(101, 100, 2000)
+        self.assertEqual(board.to_bytes()[0], LAYOUT_FORMAT)
+        self.assertEqual(self.cell_states(Board.from_bytes(board.to_bytes())),
+                         self.cell_states(board))
+
+
+class CustomGameTests(ShardedTestCase):
+
+    def test_create(self):
+        game = Game.create(difficulty=Difficulty.custom, width=30, height=5, mine_count=20)
+        game = Game.load(game.pk)
+        self.assertEqual((len(game.board[0]), len(game.board)), (30, 5))
+        self.assertEqual(sum(cell.has_mine for row in game.board for cell in row), 20)
+        self.assertEqual(game.mine_count, 20)
+
+    def test_custom_fields_script(self):  # only the form of the create page has the fields
+        self.assertContains(self.client.get(reverse('game:create')), 'toggleCustomFields')
+        game = Game._non_random_create(3, [(0, 0)])
+        self.assertNotContains(self.client.get(game.get_absolute_url()), 'toggleCustomFields')
+
+    def test_form_validation(self):
+        form = CreateGameForm({'difficulty': Difficulty.custom.value})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(set(form.errors), {'width', 'height', 'mine_count'})
+
+        form = CreateGameForm({
+            'difficulty': Difficulty.custom.value, 'width': 1001, 'height': 10, 'mine_count': 10
+        })
+        self.assertEqual(set(form.errors), {'width'})
+
+        form = CreateGameForm({
+            'difficulty': Difficulty.custom.value, 'width': 3, 'height': 3, 'mine_count': 9
+        })
+        self.assertEqual(set(form.errors), {'mine_count'})
+
+        form = CreateGameForm({'difficulty': Difficulty.easy.value, 'width': 'foo'})
+        self.assertTrue(form.is_valid())
+
+    def test_sweep_only_touches_revealed_area(self):
+        game = Game._non_random_create(1000, [(500, y) for y in range(1000)])
+        # the index of the safe areas tells which cells to reveal, no board scan
+        _, _, cells = game.sweep_cell(0, 0)
+        self.assertEqual(len(cells), 500 * 1000)
+        self.assertFalse(game.board[999][499].hidden)
+        self.assertTrue(game.board[0][501].hidden)
+
+    def test_mine_reveals_mines(self):
+        game = Game._non_random_create(4, [(0, 0), (3, 3)])
+        game_over, win, cells = game.sweep_cell(0, 0)
+        self.assertTrue(game_over)
+        self.assertEqual({(cell.x, cell.y) for cell in cells}, {(0, 0), (3, 3)})
+
+    def test_create_view(self):
+        response = self.client.post(reverse('game:create'), {
+            'difficulty': Difficulty.custom.value, 'width': 40, 'height': 20, 'mine_count': 50
+        })
+        self.assertEqual(response.status_code, 302)
+        game = Game.load(int(signer.unsign(response.url.split('/')[-2])))
+        self.assertEqual((game.width, game.height, game.mine_count), (40, 20, 50))
+
+
+class BoardPoolTests(ShardedTestCase):
+
+    def test_fill_board_pool(self):
+        with override_settings(GAME_BOARD_POOL_CUSTOM=[(30, 20, 50)]):
+            call_command('fill_board_pool', depth=2, processes=1, stdout=io.StringIO())
+            for database in settings.GAME_SHARDS:  # 4 difficulties and the custom
+                self.assertEqual(PooledBoard.objects.using(database).count(), 10)
+            pooled = PooledBoard.objects.filter(width=30).first()
+            self.assertEqual((pooled.board.width, pooled.board.height), (30, 20))
+            self.assertEqual(len(list(pooled.board.mine_indices())), 50)
+
+            call_command('fill_board_pool', depth=2, processes=1, stdout=io.StringIO())
+            for database in settings.GAME_SHARDS:  # already full
+                self.assertEqual(PooledBoard.objects.using(database).count(), 10)
+
+    @mock.patch.object(sharding, 'next_database', return_value=settings.GAME_SHARDS[-1])
+    def test_create_claims_a_board(self, next_database):
+        call_command('fill_board_pool', depth=2, processes=1, stdout=io.StringIO())
+        board_size, mine_count = Game._get_board_configuration(Difficulty.easy)
+        pool = PooledBoard.objects.using(settings.GAME_SHARDS[-1]).filter(width=board_size)
+        boards = {pooled.board.to_bytes() for pooled in pool.all()}
+
+        game = Game.load(Game.create(difficulty=Difficulty.easy).pk)
+        self.assertIn(game.board.to_bytes(), boards)
+        self.assertEqual(game.hidden_safe_cells, board_size * board_size - mine_count)
+        self.assertEqual(pool.count(), 1)
+        claimed = Game.create(difficulty=Difficulty.easy).board.to_bytes()
+        self.assertEqual({game.board.to_bytes(), claimed}, boards)
+        self.assertEqual(pool.count(), 0)
+
+        game = Game.create(difficulty=Difficulty.easy)  # generated, the pool is empty
+        self.assertEqual(len(list(game.board.mine_indices())), mine_count)
+        for database in settings.GAME_SHARDS[:-1]:  # the other pools are untouched
+            self.assertEqual(PooledBoard.objects.using(database).count(), 8)
+
+    def test_claim_empty_pool(self):
+        self.assertIsNone(PooledBoard.claim(9, 9, 10))
+
+
+@override_settings(GAME_CHECK_COUNTERS=True)
 class GameLogicTests(TestCase):
     def test_game_over(self):
         game = Game._non_random_create(3, [(0, 0)])
@@ -182,6 +495,1072 @@ class GameLogicTests(TestCase):
         self.assertFalse(win)
         self.assertEqual(len(updated_cells), 0)  # no updates from the server
 
+    def test_win(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        self.assertEqual(game.hidden_safe_cells, 8)
+
+        game_over, win, _ = game.flag_cell(0, 0)
+        self.assertEqual(game.flagged_mines, 1)
+        self.assertFalse(game_over)
+
+        game_over, win, _ = game.sweep_cell(2, 2)  # reveals the whole safe area
+        self.assertEqual(game.hidden_safe_cells, 0)
+        self.assertTrue(game_over)
+        self.assertTrue(win)
+
+    def test_wrong_flags(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        game.flag_cell(1, 1)
+        game.sweep_cell(0, 1)
+        self.assertEqual((game.hidden_safe_cells, game.flagged_mines, game.wrong_flags), (7, 0, 1))
+
+        game.flag_cell(1, 1)
+        game.flag_cell(0, 0)
+        self.assertEqual((game.hidden_safe_cells, game.flagged_mines, game.wrong_flags), (7, 1, 0))
+
+        # every counter survives a round trip to the database
+        game = Game.objects.get(pk=game.pk)
+        game.replay_journal()
+        self.assertEqual(game._count_cells(), (7, 1, 0))
+        game_over, win, _ = game.sweep_cell(2, 2)
+        self.assertTrue(win)
+
+    def test_chord(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        game.sweep_cell(1, 1)
+        _, _, updated_cells = game.chord_cell(1, 1)  # no flags around yet
+        self.assertEqual(updated_cells, set())
+
+        game.flag_cell(0, 0)
+        game_over, win, updated_cells = game.chord_cell(1, 1)
+        self.assertEqual(len(updated_cells), 7)  # every neighbour but the flag
+        self.assertTrue(win)
+
+    def test_chord_with_a_wrong_flag(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        game.sweep_cell(1, 1)
+        game.flag_cell(1, 0)
+        game_over, win, updated_cells = game.chord_cell(1, 1)
+        self.assertTrue(game_over)
+        self.assertFalse(win)
+        self.assertIn(game.board[0][0], updated_cells)
+
+    def test_chord_only_on_numbers(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        game.flag_cell(0, 0)
+        for x, y in [(1, 1), (0, 0)]:  # hidden and flagged
+            self.assertEqual(game.chord_cell(x, y)[2], set())
+        self.assertEqual(game.move_count, 1)
+
+    def test_random_games_keep_counters_in_sync(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            game = Game.create(difficulty=Difficulty.easy)
+            while not game.game_over:  # checked against a full recount on every move
+                action = rng.choice([Game.sweep_cell, Game.flag_cell, Game.chord_cell])
+                action(game, rng.randrange(9), rng.randrange(9))
+
+
+class SolverTests(TestCase):
+    def test_subset_rule(self):
+        # row 0 is hidden, under it a 1 next to the first two cells and a 1 next to all three
+        safe, mines = solver.deduce(3, 2, {3: 1, 4: 1}, 0b111, enumerate_groups=False)
+        self.assertEqual((safe, mines), (0b100, 0))
+
+    def test_enumeration(self):
+        # a 1-2-1 under a hidden row, which no pair of numbers settles on its own
+        hidden = 0b11111 | 1 << 5 | 1 << 9
+        numbers = {6: 1, 7: 2, 8: 1}
+        self.assertEqual(solver.deduce(5, 2, numbers, hidden, enumerate_groups=False), (0, 0))
+        safe, mines = solver.deduce(5, 2, numbers, hidden)
+        self.assertEqual(mines, 1 << 1 | 1 << 3)
+        self.assertEqual(safe, hidden & ~mines)
+
+    def test_deductions_are_right(self):
+        rng = random.Random(0)
+        for _ in range(10):
+            game = Game.create(difficulty=Difficulty.hard)
+            cells = game.board.cells
+            first = rng.choice([i for i in range(22 * 22) if not cells[i] & MINE])
+            game.sweep_cell(first % 22, first // 22, commit=False)
+            while not game.game_over:  # sweep everything the solver finds
+                safe, mines = solver.deduce(22, 22, *solver.visible_state(game.board))
+                for index in solver.indices(mines):
+                    self.assertTrue(cells[index] & MINE)
+                if not safe:
+                    break
+                for index in solver.indices(safe):
+                    self.assertFalse(cells[index] & MINE)
+                    game.sweep_cell(index % 22, index // 22, commit=False)
+            self.assertFalse(game.game_over and not game.win)
+
+    def test_hint_view(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        signed_id = game.get_absolute_url().split('/')[-2]
+        url = reverse('game:hint', args=(signed_id,))
+
+        def get_hint():
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content.decode('utf-8'))['hint']
+
+        self.assertIsNone(get_hint())  # nothing to go on before the first click
+        Game.play(game.pk, Game.sweep_cell, 2, 2)
+        self.assertEqual(get_hint(), {'action': 'flag', 'x': 0, 'y': 0})
+        Game.play(game.pk, Game.flag_cell, 0, 0)
+        self.assertIsNone(get_hint())  # won
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_wrong_flag_hint(self):
+        game = Game._non_random_create(3, [(0, 0), (2, 0)])
+        game.sweep_cell(1, 2)  # the top row is left hidden
+        game.flag_cell(1, 0)  # wrong
+        self.assertEqual(solver.hint(game), (MoveKind.flag, 0, 0))
+        game.flag_cell(0, 0)
+        game.flag_cell(2, 0)
+        self.assertFalse(game.game_over)
+        self.assertEqual(solver.hint(game), (MoveKind.flag, 1, 0))  # take it back
+
+
+@override_settings(GAME_NO_GUESS_PROCESSES=0, GAME_NO_GUESS_TIME_BUDGET=10)
+class NoGuessTests(ShardedTestCase):
+
+    def test_no_guess_game(self):
+        game = Game.create(difficulty=Difficulty.normal, no_guess=True)
+        self.assertTrue(game.no_guess)
+        self.assertLess(game.hidden_safe_cells, 16 * 16 - 40)  # the first area is open
+
+        game = Game.load(game.pk)
+        while True:  # the hints alone clear it
+            move = solver.hint(game)
+            if move is None:
+                break
+            kind, x, y = move
+            self.assertNotEqual(kind, MoveKind.flag if game.board[y][x].has_flag else None)
+            (game.sweep_cell if kind == MoveKind.sweep else game.flag_cell)(x, y)
+        self.assertEqual(game.hidden_safe_cells, 0)
+        self.assertFalse(game.game_over and not game.win)
+
+    def layout(self, mines):
+        layout = Board(4, 4, cells=bytearray(16))
+        layout.place_mines(mines)
+        layout.set_counters(generation.neighbour_counts(layout.mines(), 4, 4))
+        layout.set_safe_areas(*generation.label_safe_areas(
+            layout.mines(), layout.counters(), 4, 4
+        ))
+        return layout
+
+    def test_clears_without_guessing(self):
+        layout = self.layout([0])
+        self.assertTrue(no_guess.clears_without_guessing(layout, no_guess.start_cell(layout)))
+        # mines at (1, 1) and (2, 2). From the open corner, (1, 0) could be the mine as
+        # well as (1, 1), and (3, 2) as well as (2, 2)
+        layout = self.layout([5, 10])
+        self.assertFalse(no_guess.clears_without_guessing(layout, no_guess.start_cell(layout)))
+
+    @override_settings(GAME_NO_GUESS_TIME_BUDGET=0)
+    def test_fallback(self):
+        game = Game.create(difficulty=Difficulty.hard, no_guess=True)
+        self.assertFalse(game.no_guess)
+        self.assertEqual(game.hidden_safe_cells, 22 * 22 - 99)
+
+    @override_settings(GAME_NO_GUESS_PROCESSES=2)
+    def test_process_pool(self):
+        seed, start = no_guess.find_board(9, 9, 10)
+        layout = generation.build_layout(generation.GENERATOR, seed, 9, 9, 10)
+        self.assertEqual(start, no_guess.start_cell(layout))
+        self.assertTrue(no_guess.clears_without_guessing(layout, start))
+
+    def test_size_limit(self):
+        with self.assertRaises(ValueError):
+            Game.create(difficulty=Difficulty.custom, width=101, height=100, mine_count=10,
+                        no_guess=True)
+        form = CreateGameForm({
+            'difficulty': Difficulty.custom.value, 'width': 101, 'height': 100, 'mine_count': 10,
+            'no_guess': 'on',
+        })
+        self.assertEqual(set(form.errors), {'no_guess'})
+
+    def test_deadline(self):
+        seeds = [generation.new_seed() for _ in range(no_guess.CANDIDATES_PER_TASK)]
+        with mock.patch.object(no_guess, 'clears_without_guessing') as clears:
+            self.assertIsNone(no_guess.search(9, 9, 10, seeds, time.time() - 1))
+        clears.assert_not_called()
+
+    def test_create_view(self):
+        response = self.client.post(
+            reverse('game:create'), {'difficulty': Difficulty.easy.value, 'no_guess': 'on'}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Game.load(int(signer.unsign(response.url.split('/')[-2]))).no_guess)
+
+
+@override_settings(GAME_SNAPSHOT_INTERVAL=3, GAME_CHECK_COUNTERS=True)
+class MoveJournalTests(TestCase):
+    def test_moves_are_journaled(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.flag_cell(0, 2)
+        game.sweep_cell(0, 0)
+        game.flag_cell(0, 2)
+        game.sweep_cell(0, 0)  # already cleared, nothing to record
+        self.assertEqual(
+            [(m.sequence, m.kind, m.x, m.y) for m in game.moves.order_by('sequence')],
+            [(1, MoveKind.flag, 0, 2), (2, MoveKind.sweep, 0, 0), (3, MoveKind.flag, 0, 2)]
+        )
+
+    def test_snapshots(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.flag_cell(0, 2)
+        game.flag_cell(1, 2)
+
+        # only the journal has the flags so far
+        stored_game = Game.objects.get(pk=game.pk)
+        self.assertEqual(stored_game.move_count, 0)
+        self.assertFalse(stored_game.board[2][0].has_flag)
+
+        game.sweep_cell(0, 0)  # third move, snapshot
+        stored_game = Game.objects.get(pk=game.pk)
+        self.assertEqual(stored_game.move_count, 3)
+        self.assertTrue(stored_game.board[2][1].has_flag)
+        self.assertFalse(stored_game.board[0][4].hidden)
+
+    def test_replay(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.sweep_cell(0, 0)
+        game.flag_cell(0, 2)
+        game.flag_cell(1, 2)  # snapshot
+        game.flag_cell(2, 2)
+
+        stored_game = Game.objects.get(pk=game.pk)
+        stored_game.replay_journal()
+        self.assertEqual(stored_game.move_count, 4)
+        self.assertEqual(stored_game.board.cells, game.board.cells)
+        self.assertEqual(stored_game._count_cells(), game._count_cells())
+
+        # and the game goes on from there
+        stored_game.sweep_cell(4, 4)
+        self.assertEqual(Move.objects.filter(game=game).count(), 5)
+
+    def test_replay_chord(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.flag_cell(0, 2)
+        game.flag_cell(1, 2)  # snapshot
+        game.sweep_cell(0, 1)
+        game.chord_cell(0, 1)  # sweeps (0, 0), in the safe area above the mines
+
+        game = Game.objects.get(pk=game.pk)
+        self.assertTrue(game.board[0][4].hidden)
+        game.replay_journal()
+        self.assertFalse(game.board[0][4].hidden)
+        self.assertEqual(game.hidden_safe_cells, 10)  # the two rows below the mines
+
+    def test_snapshot_at_game_end(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.sweep_cell(0, 2)
+        stored_game = Game.objects.get(pk=game.pk)
+        self.assertTrue(stored_game.game_over)
+        self.assertEqual(stored_game.move_count, 1)
+
+
+@override_settings(GAME_SNAPSHOT_INTERVAL=2)
+class ConcurrencyTests(TestCase):
+    def setUp(self):
+        self.game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+
+    def load_game(self):
+        game = Game.objects.get(pk=self.game.pk)
+        game.replay_journal()
+        return game
+
+    def test_concurrent_moves(self):
+        first, second = self.load_game(), self.load_game()
+        first.flag_cell(0, 2)
+        with self.assertRaises(StaleGameError):
+            second.flag_cell(1, 2)
+        self.assertEqual(self.load_game()._count_cells()[1], 1)  # only the first flag
+
+    def test_concurrent_snapshots(self):
+        first, second = self.load_game(), self.load_game()
+        first.flag_cell(0, 2)
+        first.flag_cell(1, 2)  # snapshot, version 1
+        self.assertEqual(self.load_game().version, 1)
+        with self.assertRaises(StaleGameError):
+            second._save_snapshot()
+
+    def test_play_retries(self):
+        def sweep_with_a_conflict(game, x, y):
+            attempts.append(game)
+            if len(attempts) == 1:
+                self.load_game().flag_cell(0, 2)  # another request saves a move first
+            return game.sweep_cell(x, y)
+
+        attempts = []
+        game, (game_over, win, cells) = Game.play(self.game.pk, sweep_with_a_conflict, 0, 0)
+        self.assertEqual(len(attempts), 2)
+        self.assertIsNot(attempts[0], attempts[1])  # a fresh copy of the game
+        self.assertEqual(game.move_count, 2)
+        self.assertEqual(
+            [move.kind for move in Move.objects.filter(game=game).order_by('sequence')],
+            [MoveKind.flag, MoveKind.sweep]
+        )
+
+    @override_settings(GAME_CONFLICT_RETRIES=2)
+    def test_play_gives_up(self):
+        action = mock.Mock(side_effect=StaleGameError)
+        with self.assertRaises(StaleGameError):
+            Game.play(self.game.pk, action)
+        self.assertEqual(action.call_count, 3)
+
+    @mock.patch.object(Game, 'sweep_cell', side_effect=StaleGameError)
+    def test_conflict_response(self, sweep_cell):
+        response = self.client.post(
+            reverse('game:sweep', args=(self.game.get_absolute_url().split('/')[-2],)),
+            {'x': 0, 'y': 0}, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(response.status_code, 409)
+
+
+@override_settings(GAME_CACHE_ENABLED=True, GAME_SNAPSHOT_INTERVAL=100)
+class GameCacheTests(TestCase):
+    def setUp(self):
+        self.backend = LocMemCache('games-tests', {})
+        self.backend.clear()
+        self.lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.lock_dir.cleanup)
+        self.hot_games = self.new_cache()
+        patcher = mock.patch.object(cache, '_hot_games', self.hot_games)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+
+    def new_cache(self):
+        '''A cache like the one of another process'''
+        return cache.GameCache(
+            self.backend, size=2, flush_interval=None, timeout=60, lock_dir=self.lock_dir.name
+        )
+
+    def saved_moves(self, game):
+        return [(move.kind, move.x, move.y) for move in Move.objects.filter(game=game)]
+
+    def test_write_behind(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        with self.assertNumQueries(0):
+            game, _ = Game.play(self.game.pk, Game.flag_cell, 1, 2)
+        self.assertEqual(game.flagged_mines, 2)
+        self.assertEqual(self.saved_moves(game), [])
+        self.assertEqual(Game.load(self.game.pk).flagged_mines, 2)
+
+        self.hot_games.flush(self.game.pk)
+        self.assertEqual(self.saved_moves(game), [(MoveKind.flag, 0, 2), (MoveKind.flag, 1, 2)])
+        self.assertEqual(self.hot_games.dirty, set())
+
+    def test_string_id(self):  # as the views pass it
+        Game.play(str(self.game.pk), Game.flag_cell, 0, 2)
+        Game.play(self.game.pk, Game.flag_cell, 1, 2)
+        self.assertEqual(list(self.hot_games.games), [self.game.pk])
+        self.hot_games.flush(str(self.game.pk))
+        self.assertEqual(len(self.saved_moves(self.game)), 2)
+        self.assertEqual(self.hot_games.dirty, set())
+
+    def test_game_end_is_saved(self):
+        game = Game._non_random_create(3, [(0, 0)])
+        Game.play(game.pk, Game.flag_cell, 0, 0)
+        Game.play(game.pk, Game.sweep_cell, 2, 2)
+        self.assertTrue(Game.objects.get(pk=game.pk).win)
+        self.assertEqual(len(self.saved_moves(game)), 2)
+
+    def test_eviction(self):
+        games = [self.game] + [Game._non_random_create(3, [(0, 0)]) for _ in range(2)]
+        for game in games:
+            Game.play(game.pk, Game.flag_cell, 0, 0)
+        self.assertEqual(len(self.saved_moves(games[0])), 1)  # the least recently played
+        self.assertEqual(len(self.saved_moves(games[1])), 0)
+
+    def test_eviction_outside_the_lock(self):
+        games = [self.game] + [Game._non_random_create(3, [(0, 0)]) for _ in range(2)]
+        stripes = []
+        flush_entry = self.hot_games._flush_entry
+
+        def recording_flush_entry(pk, *args, **kwargs):
+            stripes.append(set(self.hot_games._held.stripes))
+            return flush_entry(pk, *args, **kwargs)
+
+        with mock.patch.object(self.hot_games, '_flush_entry', recording_flush_entry):
+            for game in games:
+                Game.play(game.pk, Game.flag_cell, 0, 0)
+        self.assertEqual(stripes, [{games[0].pk % cache.LOCK_STRIPES}])  # not the caller's
+
+    def test_failed_eviction(self):
+        games = [self.game] + [Game._non_random_create(3, [(0, 0)]) for _ in range(2)]
+        Game.play(games[0].pk, Game.flag_cell, 0, 0)
+        Game.play(games[1].pk, Game.flag_cell, 0, 0)
+        save_moves = Game.save_moves
+
+        def failing_save_moves(game):
+            if game.pk == games[0].pk:
+                raise OperationalError('database is locked')
+            save_moves(game)
+
+        with mock.patch.object(Game, 'save_moves', failing_save_moves):
+            with self.assertLogs('game.cache', 'ERROR'):
+                game, _ = Game.play(games[2].pk, Game.flag_cell, 0, 0)  # still answered
+        self.assertEqual(game.flagged_mines, 1)
+        self.assertEqual(self.saved_moves(games[0]), [])
+        self.assertIn(games[0].pk, self.hot_games.dirty)  # the move is kept
+
+        self.hot_games.flush_all()
+        self.assertEqual(self.saved_moves(games[0]), [(MoveKind.flag, 0, 0)])
+        self.assertEqual(self.hot_games.evicted, {})
+
+    def test_shared_between_processes(self):
+        other = self.new_cache()
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        game, _ = other.play(self.game.pk, Game.flag_cell, 1, 2)
+        self.assertEqual(game.flagged_mines, 2)
+
+        self.hot_games.flush_all()  # the last move is not ours
+        self.assertEqual(self.saved_moves(game), [])
+        other.flush_all()
+        self.assertEqual(len(self.saved_moves(game)), 2)
+
+        game, _ = Game.play(self.game.pk, Game.flag_cell, 2, 2)
+        self.assertEqual((game.flagged_mines, game.move_count), (3, 3))
+
+    def test_expired_shared_copy(self):
+        other = self.new_cache()
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        self.hot_games.flush_all()
+        other.play(self.game.pk, Game.flag_cell, 1, 2)
+        other.flush_all()
+        self.backend.clear()  # our copy is older than the database now
+
+        game, _ = Game.play(self.game.pk, Game.flag_cell, 2, 2)
+        self.assertEqual((game.flagged_mines, game.move_count), (3, 3))
+        self.hot_games.flush_all()
+        self.assertEqual(len(self.saved_moves(game)), 3)
+
+    def test_moves_saved_behind_the_cache(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        with override_settings(GAME_CACHE_ENABLED=False):
+            Game.play(self.game.pk, Game.flag_cell, 1, 2)
+
+        self.hot_games.flush_all()  # applied again after the move in the database
+        self.assertEqual(
+            self.saved_moves(self.game), [(MoveKind.flag, 1, 2), (MoveKind.flag, 0, 2)]
+        )
+        game, _ = Game.play(self.game.pk, Game.flag_cell, 2, 2)
+        self.assertEqual((game.flagged_mines, game.move_count), (3, 3))
+
+    def test_expired_shared_copy_with_moves_to_flush(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        with override_settings(GAME_CACHE_ENABLED=False):
+            Game.play(self.game.pk, Game.flag_cell, 1, 2)
+        self.backend.clear()
+
+        game, _ = Game.play(self.game.pk, Game.flag_cell, 2, 2)
+        self.assertEqual((game.flagged_mines, game.move_count), (3, 3))
+        self.hot_games.flush_all()
+        self.assertEqual(self.saved_moves(self.game), [
+            (MoveKind.flag, 1, 2), (MoveKind.flag, 0, 2), (MoveKind.flag, 2, 2)
+        ])
+
+    def test_game_end_saved_behind_the_cache(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        with override_settings(GAME_CACHE_ENABLED=False):
+            Game.play(self.game.pk, Game.flag_cell, 1, 2)
+        with self.assertRaises(StaleGameError):  # our copy doesn't have that flag
+            Game.play(self.game.pk, Game.sweep_cell, 1, 2)
+
+        # the move answered before is kept, not the one which failed
+        self.assertEqual(
+            self.saved_moves(self.game), [(MoveKind.flag, 1, 2), (MoveKind.flag, 0, 2)]
+        )
+        game = Game.load(self.game.pk)
+        self.assertEqual((game.flagged_mines, game.game_over), (2, False))
+
+    def test_lock(self):
+        other = self.new_cache()
+        with other._locked(self.game.pk), mock.patch.object(cache, 'LOCK_TIMEOUT', 0.05):
+            with self.assertRaises(StaleGameError):
+                Game.play(self.game.pk, Game.flag_cell, 0, 2)
+            with other._locked(self.game.pk + cache.LOCK_STRIPES):  # same stripe, same thread
+                pass
+        game, _ = Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        self.assertEqual(game.flagged_mines, 1)
+
+    def test_failed_action(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+        with self.assertRaises(IndexError):
+            Game.play(self.game.pk, Game.apply_moves, [(MoveKind.flag, 1, 2), (MoveKind.flag, 9, 9)])
+        self.assertEqual(Game.load(self.game.pk).flagged_mines, 1)
+        self.hot_games.flush_all()
+        self.assertEqual(len(self.saved_moves(self.game)), 1)
+
+    def test_failed_action_without_shared_copy(self):
+        Game.play(self.game.pk, Game.flag_cell, 0, 2)
+
+        def failing_action(game):
+            self.backend.clear()
+            raise IndexError
+
+        with self.assertRaises(IndexError):
+            Game.play(self.game.pk, failing_action)
+        self.assertEqual(self.hot_games.dirty, set())
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        self.url = reverse('game:batch', args=(self.game.get_absolute_url().split('/')[-2],))
+
+    def post(self, data):
+        return self.client.post(
+            self.url, json.dumps(data), content_type='application/json',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    def test_apply_moves(self):
+        moves = [(MoveKind.sweep, 0, 0), (MoveKind.sweep, 1, 1), (MoveKind.flag, 0, 2)]
+        with CaptureQueriesContext(connection) as queries:
+            game_over, win, cells = self.game.apply_moves(moves)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)  # all the moves at once
+        self.assertEqual(len(cells), 11)  # the top two rows plus the flag
+        self.assertEqual(
+            [(move.kind, move.x, move.y) for move in Move.objects.filter(game=self.game)],
+            [(MoveKind.sweep, 0, 0), (MoveKind.flag, 0, 2)]  # (1, 1) changed nothing
+        )
+
+    def test_batch_view(self):
+        response = self.post({'moves': [
+            {'action': 'sweep', 'x': 0, 'y': 0},
+            {'action': 'flag', 'x': 0, 'y': 2},
+            {'action': 'flag', 'x': 0, 'y': 2},  # and unflag
+        ]})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertFalse(data['is_game_over'])
+        positions = [(cell['x'], cell['y']) for cell in data['cells']]
+        self.assertEqual(len(positions), len(set(positions)))
+        self.assertIn((0, 2), positions)
+        self.assertEqual(Move.objects.filter(game=self.game).count(), 3)
+
+    def test_diff_format(self):
+        self.url += '?format=diff'
+        response = self.post({'moves': [{'action': 'sweep', 'x': 0, 'y': 0}]})
+        self.assertEqual(response['Content-Type'], DIFF_MEDIA_TYPE)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['version'], 1)
+        self.assertNotIn('cells', data)
+        self.assertEqual(len(data['diff']), 10)
+        self.assertIn([0, 0, CellDisplay.cleared, 0], data['diff'])
+        self.assertIn([0, 1, CellDisplay.cleared, 2], data['diff'])
+
+        self.url = self.url.split('?')[0]  # now with the Accept header
+        response = self.client.post(
+            self.url, json.dumps({'moves': [{'action': 'flag', 'x': 0, 'y': 2}]}),
+            content_type='application/json', HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            HTTP_ACCEPT=DIFF_MEDIA_TYPE
+        )
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['diff'], [[0, 2, CellDisplay.flagged]])  # no counter
+
+    def test_invalid_batches(self):
+        for data in [
+            {},
+            {'moves': [{'action': 'explode', 'x': 0, 'y': 0}]},
+            {'moves': [{'action': 'sweep', 'x': 'a', 'y': 0}]},
+            {'moves': [{'action': 'sweep', 'x': 5, 'y': 0}]},
+            {'moves': [{'action': 'flag', 'x': 0, 'y': 0}] * 501},
+        ]:
+            self.assertEqual(self.post(data).status_code, 400)
+        self.assertFalse(Move.objects.filter(game=self.game).exists())
+
+    def test_invalid_actions(self):  # the single moves are checked the same way
+        url = reverse('game:sweep', args=(self.game.get_absolute_url().split('/')[-2],))
+        for data in [{'x': 0}, {'x': 'a', 'y': 0}, {'x': 5, 'y': 0}, {'x': -1, 'y': 0}]:
+            response = self.client.post(url, data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Move.objects.filter(game=self.game).exists())
+
+
+class InlineExecutor(futures.Executor):
+    '''Runs the ORM calls of the websocket server in the test's thread and transaction'''
+
+    def submit(self, fn, *args):
+        future = futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@mock.patch('django.db.close_old_connections')  # it would close the test's transaction
+class WebSocketTests(TestCase):
+    def setUp(self):
+        self.game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        self.signed_id = self.game.get_absolute_url().split('/')[-2]
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def talk(self, client):
+        '''Runs a server and the client coroutine, which gets the reader and writer'''
+        def connected(reader, writer):
+            return websocket.GameConnection(reader, writer, InlineExecutor()).run()
+
+        async def connect():
+            server = await asyncio.start_server(connected, '127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            try:
+                return await client(reader, writer)
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+        return self.loop.run_until_complete(connect())
+
+    def handshake(self, writer, signed_id):
+        writer.write((
+            'GET /ws/{}/ HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'
+        ).format(signed_id).encode('ascii'))
+
+    @staticmethod
+    async def read_frame(reader):
+        first, length = await reader.readexactly(2)
+        if length == 126:
+            length, = struct.unpack('!H', await reader.readexactly(2))
+        return first & 0x0F, await reader.readexactly(length)
+
+    def test_accept_key(self, close_old_connections):
+        # the example of the RFC
+        self.assertEqual(
+            websocket.accept_key('dGhlIHNhbXBsZSBub25jZQ=='), 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+        )
+
+    def test_frames(self, close_old_connections):
+        for size in [0, 125, 126, 60000, 70000]:
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(websocket.encode_frame(websocket.OP_TEXT, b'x' * size, mask=b'abcd'))
+            if size > websocket.MAX_MESSAGE_SIZE:
+                with self.assertRaises(websocket.ProtocolError):
+                    self.loop.run_until_complete(websocket.read_frame(reader))
+            else:
+                self.assertEqual(
+                    self.loop.run_until_complete(websocket.read_frame(reader)),
+                    (True, websocket.OP_TEXT, b'x' * size)
+                )
+
+    def test_play(self, close_old_connections):
+        async def client(reader, writer):
+            self.handshake(writer, self.signed_id)
+            response = await reader.readuntil(b'\r\n\r\n')
+            moves = {'moves': [{'action': 'sweep', 'x': 0, 'y': 0}]}
+            writer.write(websocket.encode_frame(
+                websocket.OP_TEXT, json.dumps(moves).encode('utf-8'), mask=b'\x01\x02\x03\x04'
+            ))
+            writer.write(websocket.encode_frame(websocket.OP_PING, b'hi', mask=b'abcd'))
+            writer.write(websocket.encode_frame(websocket.OP_CLOSE, b'\x03\xe8', mask=b'abcd'))
+            return response, [await self.read_frame(reader) for _ in range(3)]
+
+        response, frames = self.talk(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 101 '))
+        self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', response)
+        (opcode, data), pong, close = frames
+        self.assertEqual(opcode, websocket.OP_TEXT)
+        data = json.loads(data.decode('utf-8'))
+        self.assertEqual(len(data['diff']), 10)
+        self.assertFalse(data['is_game_over'])
+        self.assertEqual(pong, (websocket.OP_PONG, b'hi'))
+        self.assertEqual(close, (websocket.OP_CLOSE, b'\x03\xe8'))
+        self.assertEqual(Move.objects.filter(game=self.game).count(), 1)
+
+    def test_invalid_signature(self, close_old_connections):
+        async def client(reader, writer):
+            self.handshake(writer, self.signed_id + 'x')
+            return await reader.read()
+
+        self.assertTrue(self.talk(client).startswith(b'HTTP/1.1 403 '))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(GAME_METRICS_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(metrics, 'registry', metrics.Registry())
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        self.signed_id = self.game.get_absolute_url().split('/')[-2]
+
+    def sweep(self, x, y):
+        return self.client.post(
+            reverse('game:sweep', args=(self.signed_id,)), {'x': x, 'y': y},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    def test_phases(self):
+        self.assertEqual(self.sweep(0, 0).status_code, 200)
+        phases = {
+            dict(labels)['phase']: values
+            for (name, labels), values in self.registry.histograms.items()
+            if name == 'game_request_phase_seconds'
+        }
+        self.assertEqual(
+            set(phases), {'unsign', 'fetch', 'board_load', 'replay', 'logic', 'save', 'render',
+                          'other'}
+        )
+        total = self.registry.histograms[
+            ('game_request_seconds', (('endpoint', 'sweep'),))
+        ]
+        self.assertEqual(total[-1], 1)
+        self.assertAlmostEqual(sum(values[-2] for values in phases.values()), total[-2])
+
+    def test_nested_phases(self):
+        @metrics.timed('test')
+        def view():
+            with metrics.phase('outer'):
+                with metrics.phase('inner'):
+                    time.sleep(0.01)
+
+        view()
+        sums = {
+            dict(labels)['phase']: values[-2]
+            for (name, labels), values in self.registry.histograms.items()
+            if name == 'game_request_phase_seconds'
+        }
+        self.assertGreaterEqual(sums['inner'], 0.01)
+        self.assertLess(sums['outer'], 0.01)  # without the inner one
+
+    def test_metrics_view(self):
+        self.client.post(reverse('game:create'), {'difficulty': Difficulty.easy.value})
+        self.sweep(0, 2)  # a mine
+        # another process
+        other = metrics.Registry()
+        other.inc('game_games_created_total', {'difficulty': 'easy'})
+        other.dump()
+
+        response = self.client.get(reverse('game:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode('utf-8')
+        self.assertIn('game_games_created_total{difficulty="easy"} 2\n', content)
+        self.assertIn('game_games_lost_total{difficulty="normal"} 1\n', content)
+        self.assertIn('# TYPE game_request_seconds histogram\n', content)
+        self.assertIn('game_request_seconds_count{endpoint="sweep"} 1\n', content)
+        self.assertIn('game_request_seconds_bucket{endpoint="create",le="+Inf"} 1\n', content)
+
+    def test_retired_processes(self):
+        directory = settings.GAME_METRICS_DIR
+        for _ in range(2):
+            old = metrics.Registry()
+            old.inc('game_games_created_total', {'difficulty': 'easy'})
+            old.observe('game_request_seconds', {'endpoint': 'sweep'}, 0.1)
+            old.retire()
+        self.assertEqual(sorted(os.listdir(directory)), ['retired.json', 'retired.json.lock'])
+
+        self.registry.inc('game_games_created_total', {'difficulty': 'easy'})
+        counters, histograms = metrics.collect(directory)
+        self.assertEqual(counters[('game_games_created_total', (('difficulty', 'easy'),))], 3)
+        self.assertEqual(histograms[('game_request_seconds', (('endpoint', 'sweep'),))][-1], 2)
+
+        # a process being retired is counted once, before and after its file is removed
+        old = metrics.Registry()
+        old.inc('game_games_created_total', {'difficulty': 'easy'})
+        old.dump()
+        with mock.patch('os.remove'):
+            old.retire()
+        counters, _ = metrics.collect(directory)
+        self.assertEqual(counters[('game_games_created_total', (('difficulty', 'easy'),))], 4)
+
+    def test_disabled(self):
+        with override_settings(GAME_METRICS_DIR=None):
+            self.assertEqual(self.sweep(0, 0).status_code, 200)
+            self.assertEqual(self.client.get(reverse('game:metrics')).status_code, 404)
+        self.assertEqual(self.registry.histograms, {})
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(GAME_ARCHIVE_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def finished_game(self, days_ago):
+        '''Started long ago in any case, only the end counts'''
+        game = Game._non_random_create(5, [(0, 0), (4, 4)])
+        game.sweep_cell(0, 0)
+        Game.objects.filter(pk=game.pk).update(
+            creation_datetime=timezone.now() - timedelta(days=40),
+            last_action=timezone.now() - timedelta(days=days_ago),
+        )
+        return game
+
+    def test_archive_games(self):
+        old, recent = self.finished_game(40), self.finished_game(1)
+        playing = Game._non_random_create(5, [(0, 0)])
+        Game.objects.filter(pk=playing.pk).update(
+            creation_datetime=timezone.now() - timedelta(days=40),
+            last_action=timezone.now() - timedelta(days=40),
+        )
+        output = io.StringIO()
+        call_command('archive_games', days=30, batch_size=1, stdout=output)
+        self.assertIn('Archived 1 games', output.getvalue())
+        boards = Game.objects.order_by('pk').values_list('board', flat=True)
+        self.assertEqual([board is None for board in boards], [True, False, False])
+
+        archived = Game.load(old.pk)
+        self.assertIsNotNone(archived.archive_slot)
+        self.assertEqual(archived.board.to_bytes(), old.board.to_bytes())
+        response = self.client.get(old.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(re.findall(rb'<td id="cell\d+-\d+"', response.content)), 25)
+
+        call_command('archive_games', days=0, stdout=output)
+        self.assertIn('Archived 1 games', output.getvalue().splitlines()[-1])
+        self.assertEqual(Game.load(recent.pk).board.to_bytes(), recent.board.to_bytes())
+
+    def test_deferred_board(self):
+        game = self.finished_game(40)
+        call_command('archive_games', days=30, stdout=io.StringIO())
+        with mock.patch.object(archive.Archive, 'read', wraps=archive.archive().read) as read:
+            deferred = Game.objects.defer('board').get(pk=game.pk)
+            read.assert_not_called()
+            self.assertEqual(deferred.board.to_bytes(), game.board.to_bytes())
+            self.assertEqual(read.call_count, 1)
+
+    def test_grows_while_mapped(self):
+        store = archive.archive()
+        self.assertEqual(store.append([(1, b'first'), (2, b'second')]), [0, 1])
+        self.assertEqual(store.read(2, 1), b'second')
+        self.assertEqual(store.append([(3, b'third')]), [2])
+        self.assertEqual(store.read(3, 2), b'third')
+        with self.assertRaises(archive.ArchiveError):
+            store.read(1, 2)
+
+
+class ShardingTests(ShardedTestCase):
+
+    @override_settings(GAME_SHARDS=['default', 'games-1'])
+    def test_ids(self):
+        self.assertEqual(sharding.database(12), 'default')
+        self.assertEqual(sharding.database((1 << sharding.SHARD_SHIFT) + 12), 'games-1')
+        self.assertEqual(sharding.first_id('games-1'), 1 << sharding.SHARD_SHIFT)
+        with self.assertRaises(ValueError):
+            sharding.database(2 << sharding.SHARD_SHIFT)
+        shards = [sharding.next_database() for _ in range(4)]
+        self.assertEqual(sorted(shards), ['default', 'default', 'games-1', 'games-1'])
+
+    @override_settings(GAME_SHARDS=['default', 'games-1'])
+    def test_router(self):
+        router = sharding.ShardRouter()
+        self.assertIsNone(router.allow_migrate('default', 'auth', 'user'))
+        self.assertIsNone(router.allow_migrate('default', 'game'))
+        self.assertTrue(router.allow_migrate('games-1', 'game', 'move'))
+        self.assertTrue(router.allow_migrate('games-1', 'game', 'pooledboard'))
+        self.assertFalse(router.allow_migrate('games-1', 'auth', 'user'))
+        self.assertFalse(router.allow_migrate('games-1', 'game'))  # data migrations
+        self.assertTrue(router.allow_migrate('games-1', 'game', shards=True))
+
+        game_id = (1 << sharding.SHARD_SHIFT) + 12
+        self.assertEqual(router.db_for_write(Game, instance=Game(pk=game_id)), 'games-1')
+        self.assertEqual(router.db_for_read(Move, instance=Move(game_id=game_id)), 'games-1')
+        self.assertIsNone(router.db_for_write(Game, instance=Game()))
+        self.assertIsNone(router.db_for_read(PooledBoard, instance=PooledBoard()))
+
+    def test_unknown_shard(self):
+        signed_id = signer.sign(len(settings.GAME_SHARDS) << sharding.SHARD_SHIFT)
+        self.assertEqual(self.client.get(reverse('game:match', args=(signed_id,))).status_code, 404)
+        response = self.client.post(
+            reverse('game:flag', args=(signed_id,)), {'x': 0, 'y': 0},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(GAME_SHARDS=['default', 'games-1'])
+    def test_check_id(self):
+        sharding.check_id(1 << sharding.SHARD_SHIFT, 'games-1')
+        with self.assertRaises(sharding.ShardError):
+            sharding.check_id(12, 'games-1')
+
+    def test_check_backends(self):
+        databases = {alias: dict(settings.DATABASES['default']) for alias in ['default', 'games-1']}
+        databases['games-1']['ENGINE'] = 'django.db.backends.postgresql'
+        with override_settings(GAME_SHARDS=['default'], DATABASES=databases):
+            self.assertEqual(sharding.check_backends(None), [])
+        with override_settings(GAME_SHARDS=['default', 'games-1'], DATABASES=databases):
+            self.assertEqual([error.id for error in sharding.check_backends(None)], ['game.E001'])
+
+    @unittest.skipIf(len(settings.GAME_SHARDS) < 2, 'Needs GAME_SHARD_COUNT=2 or more')
+    def test_forgotten_ids(self):
+        Game.objects.using('games-1').all().delete()  # left by the tests out of ShardedTestCase
+        with connections['games-1'].cursor() as cursor:  # e.g. the table was rebuilt
+            cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'game_game'")
+        with self.assertRaises(sharding.ShardError):
+            for _ in settings.GAME_SHARDS:
+                Game.create(difficulty=Difficulty.easy)
+        self.assertFalse(Game.objects.using('games-1').exists())
+
+        sharding.start_ids('games-1')
+        games = [Game.create(difficulty=Difficulty.easy) for _ in settings.GAME_SHARDS]
+        self.assertTrue(all(sharding.database(game.pk) == game._state.db for game in games))
+
+    def test_merged(self):
+        self.assertEqual(sharding.merged([[1, 4, 6], [2, 3], []], None, 4), [1, 2, 3, 4])
+
+    @unittest.skipIf(len(settings.GAME_SHARDS) < 2, 'Needs GAME_SHARD_COUNT=2 or more')
+    def test_games_in_shards(self):
+        games = []
+        for _ in settings.GAME_SHARDS:
+            url = self.client.post(reverse('game:create'), {'difficulty': 2}).url
+            game = Game.load(int(signer.unsign(url.split('/')[-2])))
+            self.assertEqual(game._state.db, sharding.database(game.pk))
+            games.append(game)
+        self.assertEqual({game._state.db for game in games}, set(settings.GAME_SHARDS))
+
+        for end_timer, game in enumerate(reversed(games)):
+            mine = next(iter(game.board.mine_indices()))
+            response = self.client.post(
+                reverse('game:flag', args=(game.get_absolute_url().split('/')[-2],)),
+                {'x': mine % game.width, 'y': mine // game.width},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Move.objects.using(game._state.db).filter(game=game).count(), 1)
+            LeaderboardEntry.objects.using(game._state.db).create(
+                game=game, difficulty=game.difficulty, end_timer=end_timer
+            )
+
+        response = self.client.get(reverse('game:ranking', args=(Difficulty.normal.value,)))
+        ranking = response.context['finished_winning_games']
+        self.assertEqual([entry.game_id for entry in ranking], [g.pk for g in reversed(games)])
+        self.assertEqual([entry.rank() for entry in ranking], list(range(1, len(games) + 1)))
+
+    @unittest.skipIf(len(settings.GAME_SHARDS) < 2, 'Needs GAME_SHARD_COUNT=2 or more')
+    def test_admin(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        game = Game._non_random_create(3, [(0, 0)])
+        game.pk = None
+        game.save(using='games-1')
+        game.flag_cell(0, 0)
+
+        response = self.client.get(reverse('admin:game_game_change', args=(game.pk,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['inline_admin_formsets'][0].formset.forms), 1)
+        response = self.client.get(reverse('admin:game_game_changelist'), {'shard': 'games-1'})
+        listed = [g.pk for g in response.context['cl'].result_list]
+        self.assertIn(game.pk, listed)
+        self.assertTrue(all(sharding.database(pk) == 'games-1' for pk in listed))
+        response = self.client.get(reverse('admin:game_game_change', args=(1 << 60,)))
+        self.assertEqual(response.status_code, 404)  # in a shard which isn't configured
+
+
+class CommandTests(TestCase):
+    def test_loadtest(self):
+        output = io.StringIO()
+        call_command(
+            'loadtest', players=2, moves=5, workers=1, think_time=0,
+            difficulties=['super_easy'], stdout=output
+        )
+        summary = json.loads(output.getvalue())
+        endpoints = {name: values['requests'] for name, values in summary['endpoints'].items()}
+        self.assertEqual(endpoints['sweep'] + endpoints['flag'], 10)
+        self.assertEqual(endpoints['create'], endpoints['match'])
+        self.assertEqual(summary['total']['errors'], 0)
+        self.assertEqual(summary['lock_errors'], 0)
+        self.assertEqual(list(summary['difficulties']), ['super_easy'])
+        self.assertFalse(Game.objects.exists())  # cleaned up
+
+    def test_migrate_shards(self):
+        output = io.StringIO()
+        call_command('migrate_shards', stdout=output)
+        for database in settings.GAME_SHARDS:
+            self.assertIn('Migrating {}'.format(database), output.getvalue())
+
+    def test_collect_abandoned_games(self):
+        old = timezone.now() - timedelta(hours=30)
+        abandoned, played, finished, recent = (
+            Game._non_random_create(5, [(0, 0), (4, 4)]) for _ in range(4)
+        )
+        played.sweep_cell(2, 2)  # journaled now, but no snapshot yet
+        finished.sweep_cell(0, 0)
+        Game.objects.exclude(pk=recent.pk).update(last_action=old)
+
+        output = io.StringIO()
+        call_command('collect_abandoned_games', hours=24, batch_size=2, pause=0, stdout=output)
+        self.assertEqual(
+            output.getvalue(), 'Deleted 1 abandoned games: 1 rows with their moves, '
+            '{} bytes of boards\n'.format(len(abandoned.board.to_bytes()))
+        )
+        self.assertEqual(
+            list(Game.objects.order_by('pk').values_list('pk', flat=True)),
+            [played.pk, finished.pk, recent.pk]
+        )
+
+        Game.objects.update(last_action=old)
+        Move.objects.update(timestamp=old)
+        call_command('collect_abandoned_games', hours=24, pause=0, stdout=output)
+        self.assertIn('Deleted 2 abandoned games: 3 rows', output.getvalue())
+        self.assertEqual(list(Game.objects.values_list('pk', flat=True)), [finished.pk])
+
+    def test_benchmark(self):
+        output = io.StringIO()
+        call_command('benchmark', sizes=[9, 16], repeat=1, stdout=output)
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual(set(results['sweep_mine']), {'9', '16'})
+        self.assertGreater(results['create']['9']['peak_kib'], 0)
+        self.assertFalse(Game.objects.exists())  # the created games are rolled back
+
+        baseline = {
+            case: {size: {'best_s': 1e-9, 'peak_kib': 1e9} for size in sizes}
+            for case, sizes in results.items()
+        }
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as baseline_file:
+            json.dump({'results': baseline}, baseline_file)
+            baseline_file.flush()
+            with self.assertRaisesRegex(CommandError, 'create 9x9 best_s'):
+                call_command(
+                    'benchmark', sizes=[9], repeat=1, baseline=baseline_file.name,
+                    stdout=io.StringIO()
+                )
+
+
+class RenderingTests(TestCase):
+    def test_same_as_cell_template(self):
+        game = Game._non_random_create(5, [(x, 2) for x in range(5)])
+        game.flag_cell(0, 2)
+        game.flag_cell(0, 4)
+        game.sweep_cell(0, 0)
+        game.sweep_cell(1, 2)  # game over, shows every mine
+        for row, html in zip(game.board, rendering.board_rows(game.board)):
+            self.assertEqual(
+                html, '<tr>{}</tr>\n'.format(''.join(
+                    render_to_string('cell.html', {'cell': cell}) for cell in row
+                ))
+            )
+
+    def test_streamed_board(self):
+        game = Game.create(difficulty=Difficulty.custom, width=10, height=10, mine_count=5)
+        with self.settings(GAME_STREAMING_MIN_CELLS=100):
+            streamed = self.client.get(game.get_absolute_url())
+        with self.settings(GAME_STREAMING_MIN_CELLS=101):
+            response = self.client.get(game.get_absolute_url())
+        self.assertTrue(streamed.streaming)
+        self.assertFalse(response.streaming)
+        self.assertEqual(b''.join(streamed.streaming_content), response.content)
+        self.assertEqual(len(re.findall(rb'<td id="cell\d+-\d+"', response.content)), 100)
+
 
 class GameViewTests(TestCase):
     def test_create_game_get_view(self):
@@ -247,3 +1626,38 @@ class GameViewTests(TestCase):
             [g.end_timer for g in response.context['finished_winning_games']],
             [0, 1, 2, 3, 4]
         )
+
+    def test_ranking_pages(self):
+        for i in range(110):
+            Game.objects.create(game_over=True, win=True, difficulty=0, end_timer=i)
+
+        response = self.client.get(reverse('game:ranking'))
+        games = response.context['finished_winning_games']
+        self.assertEqual([g.end_timer for g in games], list(range(20)))
+        self.assertIsInstance(games[0], LeaderboardEntry)  # no Game rows
+        self.assertEqual(response.context['paginator'].num_pages, 5)  # only the best 100
+
+        response = self.client.get(reverse('game:ranking'), {'page': 5})
+        self.assertEqual(
+            [g.end_timer for g in response.context['finished_winning_games']],
+            list(range(80, 100))
+        )
+        self.assertContains(response, '<th scope="row">81</th>', html=True)
+
+    def test_rank(self):
+        for end_timer in [5, 10, 10, 20]:
+            Game.objects.create(game_over=True, win=True, difficulty=1, end_timer=end_timer)
+        Game.objects.create(game_over=True, win=False, difficulty=1, end_timer=1)
+        Game.objects.create(game_over=True, win=True, difficulty=2, end_timer=1)
+        self.assertEqual(
+            [entry.rank() for entry in LeaderboardEntry.objects.filter(difficulty=1)],
+            [1, 2, 2, 4]
+        )
+
+        game = Game._non_random_create(3, [(0, 0)], difficulty=Difficulty.easy)
+        game.flag_cell(0, 0)
+        game.sweep_cell(2, 2)  # win
+        LeaderboardEntry.objects.filter(game=game).update(end_timer=7)  # not up to the clock
+        response = self.client.get(game.get_absolute_url())
+        self.assertEqual(response.context['rank'], 2)
+        self.assertContains(response, 'Rank #2')
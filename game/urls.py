@@ -1,5 +1,5 @@
 from django.conf.urls import url
-from . import views, ajax_views
+from . import views, ajax_views, metrics
 
 
 app_name = 'game'
@@ -10,4 +10,8 @@ urlpatterns = [
     url(r'^match/(?P<signed_id>.+)/$', views.GameView.as_view(), name='match'),
     url(r'^sweep/(?P<signed_id>.+)/$', ajax_views.sweep_view, name='sweep'),
     url(r'^flag/(?P<signed_id>.+)/$', ajax_views.flag_view, name='flag'),
+    url(r'^chord/(?P<signed_id>.+)/$', ajax_views.chord_view, name='chord'),
+    url(r'^batch/(?P<signed_id>.+)/$', ajax_views.batch_view, name='batch'),
+    url(r'^hint/(?P<signed_id>.+)/$', ajax_views.hint_view, name='hint'),
+    url(r'^metrics$', metrics.metrics_view, name='metrics'),
 ]
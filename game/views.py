@@ -1,11 +1,16 @@
+import itertools
+
+from django.conf import settings
 from django.core import signing
 from django.core.urlresolvers import reverse
-from django.http import Http404
-from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.views import generic
 
-from .models import Game, Difficulty
+from . import metrics, rendering, sharding
+from .ajax_views import DIFF_MEDIA_TYPE
+from .models import Game, Difficulty, LeaderboardEntry
 from .forms import CreateGameForm
 
 
@@ -16,13 +21,20 @@ from .forms import CreateGameForm
 signer = signing.Signer()
 
 
+@method_decorator(metrics.timed('create'), name='dispatch')
 class CreateGameView(generic.FormView):
     form_class = CreateGameForm
     template_name = 'create_game.html'
 
     def form_valid(self, form):
         difficulty = Difficulty(int(form.cleaned_data['difficulty']))
-        self.object = Game.create(difficulty=difficulty)
+        self.object = Game.create(
+            difficulty=difficulty,
+            width=form.cleaned_data['width'],
+            height=form.cleaned_data['height'],
+            mine_count=form.cleaned_data['mine_count'],
+            no_guess=form.cleaned_data['no_guess'],
+        )
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -32,6 +44,10 @@ class CreateGameView(generic.FormView):
 class RankingView(generic.ListView):
     template_name = 'ranking.html'
     context_object_name = 'finished_winning_games'
+    # every custom game has its own board size, so they can't be ranked against each other
+    difficulties = [x for x in Difficulty if x != Difficulty.custom]
+    ranking_size = 100  # only the best games are ranked, so the page doesn't grow forever
+    paginate_by = 20
 
     def get_queryset(self):
         difficulty_value = self.kwargs.get('difficulty_value') or 0
@@ -39,12 +55,21 @@ class RankingView(generic.ListView):
             self.difficulty = Difficulty(int(difficulty_value))
         except ValueError:
             raise Http404
+        if self.difficulty not in self.difficulties:
+            raise Http404
 
-        return Game.objects.filter(
-            game_over=True,
-            win=True,
-            difficulty=self.difficulty.value
-        ).order_by('end_timer')
+        # the leaderboard has everything shown, so the rows of Game are never read. Every
+        # shard has the leaderboard of its games, their best ones are merged
+        return sharding.merged(
+            [
+                LeaderboardEntry.objects.using(database).filter(
+                    difficulty=self.difficulty.value
+                ).order_by('end_timer', 'game')
+                for database in settings.GAME_SHARDS
+            ],
+            key=lambda entry: (entry.end_timer, entry.game_id),
+            limit=self.ranking_size,
+        )
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
@@ -54,29 +79,66 @@ class RankingView(generic.ListView):
                 'title': x.name.title().replace('_', ' '),
                 'css_class': 'active' if x == self.difficulty else ''
             }
-            for x in Difficulty
+            for x in self.difficulties
         ]
         return context_data
 
 
+@method_decorator(metrics.timed('match'), name='dispatch')
 class GameView(generic.DetailView):
     object_name = 'game'
     template_name = 'game.html'
 
     def get_object(self, queryset=None):
-        game_id = signer.unsign(self.kwargs['signed_id'])
-        return get_object_or_404(Game, pk=int(game_id))
+        with metrics.phase('unsign'):
+            game_id = signer.unsign(self.kwargs['signed_id'])
+        try:
+            return Game.load(int(game_id))
+        except Game.DoesNotExist:
+            raise Http404
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
         context_data['signed_id'] = self.kwargs['signed_id']
+        context_data['diff_media_type'] = DIFF_MEDIA_TYPE
+        context_data['websocket_path'] = settings.GAME_WEBSOCKET_PATH
         context_data['form'] = CreateGameForm(
             action=reverse('game:create'),
-            initial={'difficulty': self.object.difficulty}
+            initial={
+                'difficulty': self.object.difficulty,
+                'width': self.object.width,
+                'height': self.object.height,
+                'mine_count': self.object.mine_count,
+                'no_guess': self.object.no_guess,
+            } if self.object.difficulty == Difficulty.custom else {
+                'difficulty': self.object.difficulty,
+                'no_guess': self.object.no_guess,
+            }
         )
         if self.object.game_over:
             context_data['initial_timer'] = self.object.end_timer
         else:
             timer_delta = (timezone.now() - self.object.creation_datetime)
             context_data['initial_timer'] = int(timer_delta.total_seconds())
+        context_data['board_marker'] = rendering.BOARD_MARKER
+        if self.object.win:
+            entry = LeaderboardEntry.objects.using(self.object._state.db).filter(
+                game=self.object
+            ).first()
+            context_data['rank'] = entry and entry.rank()
         return context_data
+
+    def render_to_response(self, context, **response_kwargs):
+        '''
+        The page is rendered without the board, which is built from pre-rendered cells
+        (see rendering.py) and put in place of the marker. Big boards are streamed.
+        '''
+        with metrics.phase('render'):
+            response = super().render_to_response(context, **response_kwargs)
+            head, tail = response.rendered_content.split(rendering.BOARD_MARKER)
+            rows = rendering.board_rows(self.object.board)
+            content_type = response['Content-Type']
+            if len(self.object.board.cells) >= settings.GAME_STREAMING_MIN_CELLS:
+                # the rows are rendered after the view returns, so they aren't timed
+                return StreamingHttpResponse(itertools.chain([head], rows, [tail]), content_type)
+            return HttpResponse(head + ''.join(rows) + tail, content_type)
@@ -77,6 +77,71 @@ TEMPLATES = [
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 CRISPY_FAIL_SILENTLY = not DEBUG
 
+# Cross-checks the running counters of every game against a full recount of its board
+# on every move. Slow, meant for the tests
+GAME_CHECK_COUNTERS = False
+
+# Every move is appended to a journal. The whole board is saved every this many moves
+# (and when the game ends)
+GAME_SNAPSHOT_INTERVAL = 10
+
+# Times a move is applied again when another request changed the same game meanwhile
+GAME_CONFLICT_RETRIES = 3
+
+# Boards with at least this many cells are streamed to the browser row by row
+GAME_STREAMING_MIN_CELLS = 10000
+
+# The board page plays through a WebSocket at this path when it's set (see
+# minesweeper/websocket.py). Otherwise, or if the socket fails, it uses the ajax views
+GAME_WEBSOCKET_PATH = None if DEBUG else '/ws/'
+
+# Keeps the games being played in memory and saves their moves every few seconds
+# instead of on every click (see game/cache.py). The games are shared by all the
+# processes through the 'games' cache below
+GAME_CACHE_ENABLED = not DEBUG
+GAME_CACHE_SIZE = 1000  # games per process
+GAME_CACHE_FLUSH_INTERVAL = 5  # seconds
+GAME_CACHE_TIMEOUT = 60 * 60  # seconds a game stays in the shared cache since its last move
+GAME_CACHE_LOCK_DIR = os.path.join(BASE_DIR, 'cache', 'locks')
+
+# Boards are generated ahead of time by the fill_board_pool command (see
+# game.models.PooledBoard). It keeps this many boards of every difficulty, and of every
+# (width, height, mine_count) custom size listed below, in every shard
+GAME_BOARD_POOL_DEPTH = 50
+GAME_BOARD_POOL_CUSTOM = []
+
+# No-guess games (see game/no_guess.py) are searched for in a pool of this many
+# processes (None is one per CPU, 0 searches in the request's process) for up to this
+# many seconds. A regular game is created when none is found in time
+GAME_NO_GUESS_PROCESSES = None
+GAME_NO_GUESS_TIME_BUDGET = 3
+
+# The archive_games command moves the boards of the games finished more than this many
+# days ago to files in this directory (see game/archive.py)
+GAME_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+GAME_ARCHIVE_AFTER_DAYS = 30
+
+# Unfinished games without moves for this long are deleted by the
+# collect_abandoned_games command
+GAME_ABANDONED_AFTER_HOURS = 24
+
+# Timings of the requests and counters of the games, exposed at /metrics (see game/metrics.py).
+# Every process writes its numbers to a file in this directory. None disables them
+GAME_METRICS_DIR = None if DEBUG else os.path.join(BASE_DIR, 'metrics')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'games': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'games'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 WSGI_APPLICATION = 'minesweeper.wsgi.application'
 
 
@@ -87,9 +152,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # connections are kept open by every process in production, instead of one per request
+        'CONN_MAX_AGE': 0 if DEBUG else None,
+        'OPTIONS': {
+            'timeout': 10,  # seconds a write waits for the lock before "database is locked"
+        },
     }
 }
 
+# Games are spread over this many SQLite files, so the writes of different games don't
+# wait for each other (see game/sharding.py). The first one is the default database.
+# `manage.py migrate_shards` migrates them all
+GAME_SHARD_COUNT = int(os.environ.get('GAME_SHARD_COUNT', 1 if DEBUG else 4))
+GAME_SHARDS = ['default'] + ['games-{}'.format(n) for n in range(1, GAME_SHARD_COUNT)]
+for alias in GAME_SHARDS[1:]:
+    DATABASES[alias] = dict(
+        DATABASES['default'], NAME=os.path.join(BASE_DIR, 'db-{}.sqlite3'.format(alias))
+    )
+DATABASE_ROUTERS = ['game.sharding.ShardRouter']
+
+# Run on every new SQLite connection (see game/database.py)
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('mmap_size', 256 * 1024 * 1024),
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -0,0 +1,271 @@
+'''
+WebSocket server to play games (RFC 6455), a lighter alternative to the ajax views.
+
+Every ajax click is a whole HTTP request going through the middleware stack, and it ties
+up a uwsgi worker meanwhile. Here the browser keeps a connection open per game instead.
+The signed id is checked once when it's opened, then every message is a batch of moves
+(the same JSON the batch view takes) which is answered with the changed cells in the diff
+format (see game/ajax_views.py). The game logic is still Game's, through Game.play, in a
+pool of threads since the ORM blocks. An idle connection only costs a coroutine, so one
+process can keep thousands of open games.
+
+Django 1.9 has no ASGI support, so this only uses the standard library. Run it with:
+    python -m minesweeper.websocket --port 8001
+nginx proxies settings.GAME_WEBSOCKET_PATH to it (see deployment/nginx.conf).
+'''
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'  # from the RFC
+MAX_MESSAGE_SIZE = 64 * 1024
+MAX_HEADER_LINES = 100
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# e.g. GET /ws/<signed_id>/ HTTP/1.1 (the prefix is settings.GAME_WEBSOCKET_PATH)
+_REQUEST_LINE = re.compile(r'^GET \S*/(?P<signed_id>[^/ ]+)/ HTTP/1\.1$')
+
+
+class ProtocolError(Exception):
+    '''The client didn't follow the protocol. The connection is dropped'''
+
+
+def accept_key(key):
+    '''Value of the Sec-WebSocket-Accept header for the client's Sec-WebSocket-Key'''
+    digest = hashlib.sha1((key + GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def apply_mask(payload, mask):
+    # xor against the key repeated to the length of the payload, as big integers
+    # so it doesn't loop in python over every byte
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    masked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return masked.to_bytes(len(payload), 'big')
+
+
+def encode_frame(opcode, payload, mask=None):
+    '''
+    A single final frame. Frames sent by the server are not masked, mask (4 bytes) is
+    only for clients (e.g. the tests).
+    '''
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        header.append(mask_bit | len(payload))
+    elif len(payload) < 1 << 16:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack('!H', len(payload)))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack('!Q', len(payload)))
+    if mask:
+        header.extend(mask)
+        payload = apply_mask(payload, mask)
+    return bytes(header) + payload
+
+
+async def read_frame(reader):
+    '''Returns (fin, opcode, payload) of the next frame sent by the client'''
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError('Frame of {} bytes'.format(length))
+    if not second & 0x80:
+        raise ProtocolError('Client frames must be masked')
+    mask = await reader.readexactly(4)
+    payload = await reader.readexactly(length)
+    return bool(first & 0x80), first & 0x0F, apply_mask(payload, mask)
+
+
+# The game modules are imported where they're used, since they can't be imported
+# until django.setup() is called (see main)
+
+
+def play_moves(game_id, moves):
+    '''Runs in the thread pool. Returns the message to send back'''
+    from django.db import close_old_connections
+    from game.ajax_views import diff_data
+    from game.models import Game, StaleGameError
+
+    close_old_connections()  # there are no requests to do this for us
+    try:
+        game, (is_game_over, win, cells) = Game.play(game_id, Game.apply_moves, moves)
+        return diff_data(is_game_over, win, cells)
+    except Game.DoesNotExist:
+        return {'error': 'not found'}
+    except StaleGameError:
+        return {'error': 'conflict'}
+    except IndexError:  # a cell out of the board
+        return {'error': 'bad request'}
+
+
+def game_exists(game_id):
+    from django.db import close_old_connections
+    from game.models import Game
+
+    close_old_connections()
+    try:
+        return Game.objects.using(Game.database(game_id)).filter(pk=game_id).exists()
+    except Game.DoesNotExist:  # in a shard which isn't configured
+        return False
+
+
+class GameConnection:
+    '''One open WebSocket, bound to a single game'''
+
+    def __init__(self, reader, writer, executor=None):
+        self.reader, self.writer = reader, writer
+        self.executor = executor
+        self.loop = asyncio.get_event_loop()
+
+    async def run(self):
+        try:
+            game_id = await self.handshake()
+            if game_id is None:
+                return
+            while True:
+                message = await self.read_message()
+                if message is None:
+                    break
+                response = await self.handle_message(game_id, message)
+                self.send(OP_TEXT, json.dumps(response, separators=(',', ':')).encode('utf-8'))
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError, ValueError):
+            pass  # the client is gone or it's not talking websocket
+        finally:
+            self.writer.close()
+
+    async def handshake(self):
+        '''
+        Checks the upgrade request and the signed id of the game. Returns the game id,
+        or None after answering with an error.
+        '''
+        from django.core import signing
+        from game.views import signer
+
+        request_line = (await self.reader.readline()).decode('latin-1').strip()
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            return self.reject(431, 'Request Header Fields Too Large')
+
+        match = _REQUEST_LINE.match(request_line)
+        is_upgrade = (
+            headers.get('upgrade', '').lower() == 'websocket' and
+            headers.get('sec-websocket-version') == '13' and
+            'sec-websocket-key' in headers
+        )
+        if not match or not is_upgrade:
+            return self.reject(400, 'Bad Request')
+        try:
+            game_id = signer.unsign(match.group('signed_id'))
+        except signing.BadSignature:
+            return self.reject(403, 'Forbidden')
+        if not await self.loop.run_in_executor(self.executor, game_exists, game_id):
+            return self.reject(404, 'Not Found')
+
+        self.writer.write((
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {}\r\n\r\n'
+        ).format(accept_key(headers['sec-websocket-key'])).encode('ascii'))
+        return game_id
+
+    def reject(self, status, reason):
+        self.writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\n\r\n'.format(
+            status, reason
+        ).encode('ascii'))
+        return None
+
+    async def read_message(self):
+        '''
+        Returns the payload of the next text message, answering pings on the way.
+        Returns None when the client closes the connection.
+        '''
+        fragments = []
+        while True:
+            fin, opcode, payload = await read_frame(self.reader)
+            if opcode == OP_CLOSE:
+                self.send(OP_CLOSE, payload[:2])  # echo the status code
+                return None
+            elif opcode == OP_PING:
+                self.send(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                pass
+            elif opcode in (OP_TEXT, OP_CONTINUATION):
+                if (opcode == OP_TEXT) == bool(fragments):
+                    raise ProtocolError('Unexpected opcode {}'.format(opcode))
+                fragments.append(payload)
+                if sum(len(fragment) for fragment in fragments) > MAX_MESSAGE_SIZE:
+                    raise ProtocolError('Message too big')
+                if fin:
+                    return b''.join(fragments)
+            else:
+                raise ProtocolError('Unsupported opcode {}'.format(opcode))
+
+    async def handle_message(self, game_id, message):
+        from game.ajax_views import parse_moves
+
+        try:
+            moves = parse_moves(message)
+        except ValueError:
+            return {'error': 'bad request'}
+        return await self.loop.run_in_executor(self.executor, play_moves, game_id, moves)
+
+    def send(self, opcode, payload):
+        self.writer.write(encode_frame(opcode, payload))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket server to play games')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--threads', type=int, default=4, help='Threads running the moves')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'minesweeper.settings')
+    django.setup()
+
+    executor = ThreadPoolExecutor(args.threads)
+    loop = asyncio.get_event_loop()
+
+    def connected(reader, writer):
+        return GameConnection(reader, writer, executor).run()
+
+    server = loop.run_until_complete(asyncio.start_server(connected, args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()